@@ -7,12 +7,10 @@
 # for persistent storage of our models.
 ##
 
-# for sending mail
-from google.appengine.api import mail
-
 # Used in conjunction with the geomodel library for doing
 # proximity based searches
 from google.appengine.ext.db import GeoPt
+from geo import geomath
 from geo import geotypes
 
 # HttpResponse is what all Django-based views must return
@@ -27,8 +25,21 @@ from django.utils import simplejson
 # Our datastore models
 from model import *
 
-# For handling user sessions
-from appengine_utilities.sessions import Session
+# Background data migrations, run as deferred tasks
+from google.appengine.ext import deferred
+import migrations
+
+# Background sweeper of expired sessions and cache entries
+from appengine_utilities import sweeper
+
+# In-process spatial index of the open questions
+import question_index
+
+# Cached responses of the questions API method
+import response_cache
+
+# Email notifications, delivered in the background
+import notifications
 
 # Provides the sha1 module we use for hashing passwords
 import hashlib
@@ -44,11 +55,12 @@ logging.basicConfig(level=logging.DEBUG)
 ##
 
 """
-The email address to send from. See the Notes section of the README
-for more information on what to set this to.
+The default and maximum number of questions returned per page by the
+viewport API method.
 """
 
-SENDER_EMAIL_ADDRESS = "VALID@APPENGINE_ADDRESS.COM"
+VIEWPORT_PAGE_SIZE = 50
+VIEWPORT_MAX_PAGE_SIZE = 200
 
 ##
 # UTILITY METHODS
@@ -151,7 +163,7 @@ def validate_session():
     def _dec(view_func):
         def _view(request, *args, **kwargs):
             # get the session and check for a user, fail if it doesn't exist
-            if Session().get("user") is None:
+            if request.session.get("user") is None:
                 # failed request
                 return _json_unauthorized_response()
             # return the original API call through 
@@ -181,7 +193,7 @@ def ask(request):
     """
 
     # authenticated user
-    user = Session().get("user")
+    user = request.session.get("user")
 
     # required parameters
     question = request.REQUEST.get("question")
@@ -201,6 +213,11 @@ def ask(request):
     q.update_location()
     q.put()
 
+    # make the new question visible to searches served from memory
+    # and to searches whose responses are cached
+    question_index.add(q)
+    response_cache.invalidate(q.location)
+
     # return stock JSON with the Question object details
     return _json_response(question=q.to_json(), user=user.to_json())
 
@@ -213,9 +230,9 @@ def answer(request):
     that the question exists and does not have an accepted answer before
     accepting the answer.
 
-    This method also takes care of sending the owner of the question
-    an email saying a new answer has been given with the answer in the
-    body of the message.
+    This method also takes care of notifying the owner of the question
+    by email that a new answer has been given, with the answer in the
+    body of the message. The email is sent in the background.
 
     @method POST
     @param question_id: id of an existing question
@@ -225,7 +242,7 @@ def answer(request):
     """
 
     # session and authenticated user
-    user = Session().get("user")
+    user = request.session.get("user")
 
     # required parameters
     question_id = int(request.REQUEST.get("question_id"))
@@ -248,26 +265,8 @@ def answer(request):
                answer=answer)
     a.put()
 
-    # send an email to the owner of the question
-    question_owner_email = question.user.email
-
-    mail.send_mail(sender=SENDER_EMAIL_ADDRESS,
-                   to=question_owner_email,
-                   subject="Your question has a new answer!",
-                   body="""
-This is to inform you that one of your questions has 
-received a new answer.
-
-Your question: 
-%s
-
-The answer: 
-%s
-
-Regards,
-
-Inquire Application
-""" % (question.question, answer))
+    # let the owner of the question know by email
+    notifications.notify_new_answer(question, a)
 
     # return stock JSON with details of the answer object
     return _json_response(answer=a.to_json())
@@ -281,9 +280,9 @@ def accept(request):
     current authenticated user accepting the question and not already
     have an accepted answer.
 
-    This method also takes care of sending the owner of the answer 
-    an email saying their answer was accepted. The accepted answer 
-    owner will also be given one karma point. 
+    This method also takes care of notifying the owner of the answer
+    by email that their answer was accepted, in the background. The
+    accepted answer owner will also be given one karma point. 
 
     @method POST
     @param answer_id: id of the answer being accepted
@@ -292,7 +291,7 @@ def accept(request):
     """
 
     # session and authenticated user
-    user = Session().get("user")
+    user = request.session.get("user")
 
     # required parameters
     answer_id = int(request.REQUEST.get("answer_id"))
@@ -308,46 +307,21 @@ def accept(request):
     question = answer.question
 
     # make sure the question for this answer is owned by this user
-    question = answer.question
-    if question.user.key().id() != user.key().id():
+    if reference_key(question, "user") != user.key():
         return _json_response(success=False, msg="You must be the owner of the question to accept an answer.")
 
-    # also make sure the question is not already answered
-    if question.closed:
+    # close the question if it is not already answered, and give the
+    # answer's owner their karma point
+    question = answer.accept()
+    if question is None:
         return _json_response(success=False, msg="Question already has an accepted answer.")
 
-    # change the accepted flag of the answer and save it. 
-    answer.accepted_answer = True
-    answer.put()
-
-    # close the question and save it
-    question.closed = True
-    question.put()
-
-    # update the answer owner's karma points 
-    answer.user.karma += 1
-    answer.user.put()
-
-    # send an email to the address assigned to the answer
-    answer_owner_email = answer.user.email
-    mail.send_mail(sender=SENDER_EMAIL_ADDRESS,
-                   to=answer_owner_email,
-                   subject="Your answer was accepted!",
-                   body="""
-This is to inform you that one of your answers has
-been accepted! You have been given one karma point.
-
-The question you answered: 
-%s
-
-Your answer: 
-%s
-
-Regards,
-
-Inquire Application
-""" % (question.question, answer.answer))
+    # closed questions are no longer returned by searches
+    question_index.remove(question)
+    response_cache.invalidate(question.location)
 
+    # let the owner of the answer know by email
+    notifications.notify_answer_accepted(question, answer)
 
     # return stock success JSON 
     return _json_response()
@@ -374,7 +348,7 @@ def answers(request):
         return _json_response(success=False,
                               msg="Question does not exist!")
 
-    return _json_response(answers=[a.to_json() for a in question.answer_set])
+    return _json_response(answers=to_json_list(question.answer_set))
          
 
 @validate_session()
@@ -409,15 +383,84 @@ def questions(request):
     # convert miles to kilometers
     max_distance = 1000*max_distance/0.621371192
 
+    # serve the response cached for nearby clients if nothing near
+    # has changed since
+    content, token = response_cache.lookup(center, max_results, max_distance)
+    if content is not None:
+        return HttpResponse(content, mimetype="application/json")
+
     # Get all unclosed questions within the proximity max_distance and
-    # limit to max_results 
-    base_query = Question.all().filter("closed =", False)
-    questions = Question.proximity_fetch(base_query,
-                                         center,
-                                         max_results=max_results,
-                                         max_distance=max_distance)
+    # limit to max_results. Serve from the in-memory index when it's warm,
+    # otherwise search the datastore; is_warm() schedules a rebuild of the
+    # index in the background for the requests that follow.
+    if question_index.is_warm():
+        questions = question_index.nearest(center, max_results, max_distance)
+    else:
+        # size the searched geocells by how many questions the area
+        # is known to hold
+        search_box = geomath.radius_box(center, max_distance)
+        base_query = Question.all().filter("closed =", False)
+        questions = Question.proximity_fetch(
+            base_query,
+            center,
+            max_results=max_results,
+            max_distance=max_distance,
+            cost_function=Question.density_cost_function(search_box),
+            estimate_function=Question.estimate_count)
+
+    response = _json_response(questions=to_json_list(questions))
+    response_cache.store(token, response.content)
+    return response
+
+@validate_session()
+@validate_request("GET", "north", "east", "south", "west")
+def viewport(request):
+    """
+    API Method - /viewport
+    Returns a page of the open questions inside a map viewport. Pass the
+    continuation from a response back, along with the same viewport, to
+    get the next page; it is null once there are no more questions.
+
+    @method GET
+    @param north: latitude of the north edge of the viewport
+    @param east: longitude of the east edge of the viewport
+    @param south: latitude of the south edge of the viewport
+    @param west: longitude of the west edge of the viewport
+
+    @optional page_size: max number of questions to return, default=50
+    @optional continuation: continuation from the previous page
 
-    return _json_response(questions=[q.to_json() for q in questions])
+    @returns list of question objects and a continuation
+    """
+    # required parameters
+    north = float(request.GET.get("north"))
+    east = float(request.GET.get("east"))
+    south = float(request.GET.get("south"))
+    west = float(request.GET.get("west"))
+
+    # optional parameters
+    page_size = int(request.GET.get("page_size", VIEWPORT_PAGE_SIZE))
+    page_size = max(1, min(page_size, VIEWPORT_MAX_PAGE_SIZE))
+    continuation = request.GET.get("continuation")
+
+    try:
+        bbox = geotypes.Box(north, east, south, west)
+        scan = Question.bounding_box_scan(
+            Question.all().filter("closed =", False),
+            bbox,
+            cost_function=Question.density_cost_function(bbox),
+            continuation=continuation)
+    except ValueError, e:
+        return _json_response(success=False, msg=str(e))
+
+    questions = []
+    for question in scan:
+        questions.append(question)
+        if len(questions) == page_size:
+            break
+
+    return _json_response(questions=to_json_list(questions),
+                          continuation=scan.continuation())
 
 @validate_request("POST", "email", "password")
 def register(request):
@@ -438,17 +481,11 @@ def register(request):
     email = request.POST.get("email")
     password = request.POST.get("password")
 
-    #
-    users = User.all()
-    users.filter("email =", email)
-
-    if users.count() != 0:
+    # create the user, unless the email address is already taken
+    new_user = User.register(email, _hash_password(password))
+    if new_user is None:
         return _json_response(success=False,
-                             msg="Email address already exists.", users=users.count())
-
-    password = _hash_password(password)
-    new_user = User(email=email, password=password)
-    new_user.put()
+                             msg="Email address already exists.")
 
     return _json_response()
 
@@ -465,8 +502,7 @@ def logout(request):
 
     # delete session and return stock JSON response with a msg
     # indicating the user has logged out
-    session = Session()
-    session.delete()
+    request.session.delete()
     return _json_response(msg="User has been logged out.")
 
 @validate_request("POST", "email", "password")
@@ -490,30 +526,17 @@ def auth(request):
     # hash the password
     password = _hash_password(password)
 
-    # Look up a User object that matches the email/password 
-    users = User.all()
-    users \
-        .filter("email =", email) \
-        .filter("password =", password)
+    # Look up the User registered with the email address and check
+    # the password
+    user = User.get_by_email(email)
 
     # No user found, return a failure message
-    if users.count() == 0:
+    if user is None or user.password != password:
         return _json_response(success=False,
                              msg="Email or password is invalid.")
 
-    # Somehow more than one client with the same user/password have
-    # been created, which should never happen. Error out here.
-    if users.count() > 1:
-        return _json_response(details=None,
-                             success=False,
-                             msg="Internal security error. Contact an administrator")
-
-    # Pull the User from the datastore
-    user = users.get()
-
     # Build a new session object and store the user
-    session = Session()
-    session["user"] = user
+    request.session["user"] = user
 
     # return stock JSON with user details
     return _json_response(user=user.to_json())
@@ -545,7 +568,7 @@ def randomize(request):
     # given email addresses
     users = []
     for email in email_accounts:
-        user = User.all().filter("email =", email).get()
+        user = User.get_by_email(email)
         if user is not None:
             users.append(user)
 
@@ -556,16 +579,51 @@ def randomize(request):
     # generate num_questions random questions around the given
     # point (near_lat, near_lon) within some distance dx and
     # assigning a random user to the question
+    questions = []
     for i in range(num_questions):
         lat = random.uniform(near_lat-dx, near_lat+dx)
         lon = random.uniform(near_lon-dx, near_lon+dx)
         user = random.sample(users, 1)[0]
 
-        q = Question(user=user, 
-                     question="Question %d" % i, 
-                     location=db.GeoPt(lat, lon))
-        q.update_location()
-        q.put()
+        questions.append(Question(user=user, 
+                                  question="Question %d" % i, 
+                                  location=db.GeoPt(lat, lon)))
+
+    # compute the geocells for every question at once and save
+    # them all in a single batch put
+    Question.update_locations(questions)
+    Question.put_all(questions)
+    response_cache.invalidate(*[q.location for q in questions])
     
     # return true
     return _json_response()
+
+# Utility method for starting the migration that rewrites the
+# stored geocells of every question after the geocell resolutions
+# of the Question model change. The migration runs in the
+# background as a chain of deferred tasks. app.yaml restricts
+# this URL to administrators.
+def migrate_geocells(request):
+    deferred.defer(migrations.rewrite_question_geocells)
+    return _json_response(msg="Migration started")
+
+# Utility method for reporting this instance's counters of the
+# cached responses of the questions API method. app.yaml restricts
+# this URL to administrators.
+def response_cache_stats(request):
+    return _json_response(stats=response_cache.stats())
+
+# Utility method for starting the migration that indexes the email
+# addresses of users registered before they were indexed. app.yaml
+# restricts this URL to administrators.
+def migrate_user_emails(request):
+    deferred.defer(migrations.index_user_emails)
+    return _json_response(msg="Migration started")
+
+# Utility method for starting a sweep of expired sessions and cache
+# entries. The sweep runs in the background as a chain of deferred
+# tasks; cron.yaml starts one regularly. app.yaml restricts this URL
+# to administrators.
+def sweep_expired(request):
+    deferred.defer(sweeper.sweep_expired)
+    return _json_response(msg="Sweep started")
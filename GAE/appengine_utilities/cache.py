@@ -28,7 +28,7 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 # main python imports
 import datetime
-import pickle
+import hashlib
 import random
 import __main__
 
@@ -36,14 +36,69 @@ import __main__
 from google.appengine.ext import db
 from google.appengine.api import memcache
 
+# appengine_utilities imports
+import serializers
+
 # settings
 try:
     import settings
 except:
     import settings_default as settings
     
+# The longest cache key stored as is in an entity key name; longer keys
+# are hashed. Datastore key names may be up to 500 bytes long.
+MAX_KEY_NAME_LENGTH = 400
+
+def _memcache_key(key):
+    """
+    Returns a cache key as used, after the 'cache-' prefix, in memcache.
+    """
+    return '%s' % (key)
+
+def _key_name(key):
+    """
+    Returns the key name of the entity storing a cache key, so entries
+    can be read and written with direct key gets and puts rather than
+    queries.
+    """
+    key_name = u"cache-%s" % (key)
+    if len(key_name.encode("utf-8")) > MAX_KEY_NAME_LENGTH:
+        key_name = u"cache-sha1-%s" % \
+            (hashlib.sha1(key_name.encode("utf-8")).hexdigest())
+    return key_name
+
+# The value memcache holds for a key known to be missing from the cache, so
+# repeated misses don't each cost a datastore get.
+_MISSING = '__appengine_utilities_cache_missing__'
+
+# Entities waiting to be written to the datastore by flush() in write behind
+# mode, by key name. A later write of a key replaces the earlier one.
+_pending = {}
+
+def flush():
+    """
+    Writes the cache entries buffered in write behind mode to the datastore
+    with a single batch put. Call this at the end of each request (see
+    middleware.CacheFlushMiddleware), or whenever other readers must see
+    the entries in the datastore.
+
+    Returns the number of entries written.
+    """
+    if not _pending:
+        return 0
+    entities = _pending.values()
+    _pending.clear()
+
+    # like a direct write, a failed datastore write should not break the
+    # application
+    try:
+        db.put(entities)
+    except:
+        pass
+    return len(entities)
+
 class _AppEngineUtilities_Cache(db.Model):
-    cachekey = db.StringProperty()
+    cachekey = db.StringProperty(indexed=False)
     createTime = db.DateTimeProperty(auto_now_add=True)
     timeout = db.DateTimeProperty()
     value = db.BlobProperty()
@@ -66,7 +121,11 @@ class Cache(object):
 
     def __init__(self, clean_check_percent = settings.cache["CLEAN_CHECK_PERCENT"],
       max_hits_to_clean = settings.cache["MAX_HITS_TO_CLEAN"],
-        default_timeout = settings.cache["DEFAULT_TIMEOUT"]):
+        default_timeout = settings.cache["DEFAULT_TIMEOUT"],
+        negative_timeout = settings.cache["NEGATIVE_TIMEOUT"],
+        write_behind = settings.cache["WRITE_BEHIND"],
+        write_behind_batch_size = settings.cache["WRITE_BEHIND_BATCH_SIZE"],
+        serializer = settings.cache["SERIALIZER"]):
         """
         Initializer
 
@@ -75,12 +134,27 @@ class Cache(object):
                 run the cache cleanup
             max_hits_to_clean: maximum number of stale hits to clean
             default_timeout: default length a cache item is good for
+            negative_timeout: number of seconds a miss is remembered in
+                memcache, 0 to not remember misses
+            write_behind: whether datastore writes are buffered in the
+                instance and written in batches by flush() rather than
+                on each set
+            write_behind_batch_size: the number of buffered writes that
+                triggers a flush
+            serializer: the name of the serializers module serializer
+                values are stored in the datastore with
         """
         self.clean_check_percent = clean_check_percent
         self.max_hits_to_clean = max_hits_to_clean
         self.default_timeout = default_timeout
-
-        if random.randint(1, 100) < self.clean_check_percent:
+        self.negative_timeout = negative_timeout
+        self.write_behind = write_behind
+        self.write_behind_batch_size = write_behind_batch_size
+        self.serializer = serializer
+
+        # expired entries are deleted by the sweeper when it is enabled
+        if not settings.cache.get("CLEAN_IN_BACKGROUND") and \
+                random.randint(1, 100) < self.clean_check_percent:
             self._clean_cache()
 
         if 'AEU_Events' in __main__.__dict__:
@@ -106,6 +180,39 @@ class Cache(object):
 
         return True
 
+    def _put(self, entities):
+        """
+        Internal method that writes cache entities to the datastore, or
+        buffers them for flush() in write behind mode.
+
+        Args:
+            entities: A list of _AppEngineUtilities_Cache entities
+        """
+        if not self.write_behind:
+            # try to put the entries, if it fails silently pass
+            # failures may happen due to timeouts, the datastore being read
+            # only for maintenance or other applications. However, cache
+            # not being able to write to the datastore should not
+            # break the application
+            try:
+                db.put(entities)
+            except:
+                pass
+            return
+
+        for entity in entities:
+            _pending[entity.key().name()] = entity
+        if len(_pending) >= self.write_behind_batch_size:
+            flush()
+
+    def flush(self):
+        """
+        Writes the entries buffered in write behind mode to the datastore.
+
+        Returns the number of entries written.
+        """
+        return flush()
+
     def _validate_key(self, key):
         """
         Internal method for key validation. This can be used by a superclass
@@ -176,28 +283,19 @@ class Cache(object):
         if key in self:
             raise KeyError
 
-        cacheEntry = _AppEngineUtilities_Cache()
+        cacheEntry = _AppEngineUtilities_Cache(key_name=_key_name(key))
         cacheEntry.cachekey = key
-        cacheEntry.value = pickle.dumps(value)
+        cacheEntry.value = serializers.dumps(value, self.serializer)
         cacheEntry.timeout = timeout
 
-        # try to put the entry, if it fails silently pass
-        # failures may happen due to timeouts, the datastore being read
-        # only for maintenance or other applications. However, cache
-        # not being able to write to the datastore should not
-        # break the application
-        try:
-            cacheEntry.put()
-        except:
-            pass
-
         memcache_timeout = timeout - datetime.datetime.now()
         memcache.set('cache-%s' % (key), value, int(memcache_timeout.seconds))
+        self._put([cacheEntry])
 
         if 'AEU_Events' in __main__.__dict__:
             __main__.AEU_Events.fire_event('cacheAdded')
 
-        return self.get(key)
+        return value
 
     def set(self, key = None, value = None, timeout = None):
         """
@@ -215,25 +313,21 @@ class Cache(object):
         self._validate_value(value)
         timeout = self._validate_timeout(timeout)
 
-        cacheEntry = self._read(key)
-        if not cacheEntry:
-            cacheEntry = _AppEngineUtilities_Cache()
-            cacheEntry.cachekey = key
-        cacheEntry.value = pickle.dumps(value)
+        # the entry is addressed by its key name, so an existing entry is
+        # simply overwritten
+        cacheEntry = _AppEngineUtilities_Cache(key_name=_key_name(key))
+        cacheEntry.cachekey = key
+        cacheEntry.value = serializers.dumps(value, self.serializer)
         cacheEntry.timeout = timeout
 
-        try:
-            cacheEntry.put()
-        except:
-            pass
-
         memcache_timeout = timeout - datetime.datetime.now()
         memcache.set('cache-%s' % (key), value, int(memcache_timeout.seconds))
+        self._put([cacheEntry])
 
         if 'AEU_Events' in __main__.__dict__:
             __main__.AEU_Events.fire_event('cacheSet')
 
-        return self.get(key)
+        return value
 
     def _read(self, key = None):
         """
@@ -246,11 +340,11 @@ class Cache(object):
 
         Returns the cache entity
         """
-        query = _AppEngineUtilities_Cache.all()
-        query.filter('cachekey', key)
-        query.filter('timeout > ', datetime.datetime.now())
-        results = query.fetch(1)
-        if len(results) is 0:
+        key_name = _key_name(key)
+        result = _pending.get(key_name)
+        if result is None:
+            result = _AppEngineUtilities_Cache.get_by_key_name(key_name)
+        if result is None or result.timeout <= datetime.datetime.now():
             return None
 
         if 'AEU_Events' in __main__.__dict__:
@@ -258,7 +352,37 @@ class Cache(object):
         if 'AEU_Events' in __main__.__dict__:
             __main__.AEU_Events.fire_event('cacheRead')
 
-        return results[0]
+        return result
+
+    def _read_many(self, keys):
+        """
+        _read_many is an internal method that gets the cache entries for a
+        number of keys directly from the datastore with a single batch get.
+
+        Args:
+            keys: The keys to retrieve
+
+        Returns a dictionary mapping each key with an unexpired entry to
+        its entity.
+        """
+        # entries still buffered in write behind mode need no datastore get
+        key_names = [_key_name(key) for key in keys]
+        entities = [_pending.get(key_name) for key_name in key_names]
+        unbuffered = [i for i in range(len(keys)) if entities[i] is None]
+        if unbuffered:
+            stored = _AppEngineUtilities_Cache.get_by_key_name(
+                [key_names[i] for i in unbuffered])
+            for i, entity in zip(unbuffered, stored):
+                entities[i] = entity
+
+        now = datetime.datetime.now()
+        results = {}
+        for key, entity in zip(keys, entities):
+            if entity is not None and entity.timeout > now:
+                results[key] = entity
+                if 'AEU_Events' in __main__.__dict__:
+                    __main__.AEU_Events.fire_event('cacheReadFromDatastore')
+        return results
 
     def delete(self, key = None):
         """
@@ -270,11 +394,11 @@ class Cache(object):
         Returns True.
         """
         memcache.delete('cache-%s' % (key))
-        result = self._read(key)
-        if result:
-            if 'AEU_Events' in __main__.__dict__:
-                __main__.AEU_Events.fire_event('cacheDeleted')
-            result.delete()
+        _pending.pop(_key_name(key), None)
+        db.delete(db.Key.from_path(_AppEngineUtilities_Cache.kind(),
+                                   _key_name(key)))
+        if 'AEU_Events' in __main__.__dict__:
+            __main__.AEU_Events.fire_event('cacheDeleted')
         return True
 
     def get(self, key):
@@ -287,7 +411,9 @@ class Cache(object):
         Returns the value of the cache item.
         """
         mc = memcache.get('cache-%s' % (key))
-        if mc:
+        if mc == _MISSING:
+            raise KeyError
+        if mc is not None:
             if 'AEU_Events' in __main__.__dict__:
                 __main__.AEU_Events.fire_event('cacheReadFromMemcache')
             if 'AEU_Events' in __main__.__dict__:
@@ -295,13 +421,16 @@ class Cache(object):
             return mc
         result = self._read(key)
         if result:
+            value = serializers.loads(result.value)
             timeout = result.timeout - datetime.datetime.now()
-            memcache.set('cache-%s' % (key), pickle.loads(result.value),
-               int(timeout.seconds))
+            memcache.set('cache-%s' % (key), value, int(timeout.seconds))
             if 'AEU_Events' in __main__.__dict__:
                 __main__.AEU_Events.fire_event('cacheRead')
-            return pickle.loads(result.value)
+            return value
         else:
+            if self.negative_timeout:
+                memcache.set('cache-%s' % (key), _MISSING,
+                             self.negative_timeout)
             raise KeyError
 
     def get_many(self, keys):
@@ -309,17 +438,111 @@ class Cache(object):
         Returns a dict mapping each key in keys to its value. If the given
         key is missing, it will be missing from the response dict.
 
+        All of the keys are looked up with a single memcache call, and the
+        keys missing from memcache with a single datastore batch get.
+
         Args:
             keys: A list of keys to retrieve.
 
         Returns a dictionary of key/value pairs.
         """
-        dict = {}
+        results = memcache.get_multi([_memcache_key(key) for key in keys],
+                                     key_prefix='cache-')
+        values = {}
+        missing = []
         for key in keys:
-            value = self.get(key)
+            value = results.get(_memcache_key(key))
+            if value == _MISSING:
+                continue
             if value is not None:
-                dict[key] = val
-        return dict
+                values[key] = value
+                if 'AEU_Events' in __main__.__dict__:
+                    __main__.AEU_Events.fire_event('cacheReadFromMemcache')
+            else:
+                missing.append(key)
+
+        if missing:
+            entities = self._read_many(missing)
+            refill = {}
+            min_timeout = None
+            for key, entity in entities.items():
+                value = serializers.loads(entity.value)
+                values[key] = refill[_memcache_key(key)] = value
+                if min_timeout is None or entity.timeout < min_timeout:
+                    min_timeout = entity.timeout
+            misses = [key for key in missing if key not in entities]
+            if misses and self.negative_timeout:
+                memcache.set_multi(dict([(_memcache_key(key), _MISSING)
+                                         for key in misses]),
+                                   self.negative_timeout, key_prefix='cache-')
+            if refill:
+                # set_multi takes a single expiry time, so refilled values
+                # expire from memcache with the earliest of their entries
+                timeout = min_timeout - datetime.datetime.now()
+                memcache.set_multi(refill, int(timeout.seconds),
+                                   key_prefix='cache-')
+
+        if 'AEU_Events' in __main__.__dict__:
+            for key in values:
+                __main__.AEU_Events.fire_event('cacheRead')
+        return values
+
+    def set_many(self, mapping, timeout = None):
+        """
+        Sets a number of entries in the cache, overwriting existing values,
+        with a single datastore batch put and a single memcache call.
+
+        Args:
+            mapping: A dictionary of key/value pairs to set.
+            timeout: timeout value for all of the cache objects.
+
+        Returns True.
+        """
+        for key, value in mapping.items():
+            self._validate_key(key)
+            self._validate_value(value)
+        timeout = self._validate_timeout(timeout)
+
+        entities = []
+        for key, value in mapping.items():
+            cacheEntry = _AppEngineUtilities_Cache(key_name=_key_name(key))
+            cacheEntry.cachekey = key
+            cacheEntry.value = serializers.dumps(value, self.serializer)
+            cacheEntry.timeout = timeout
+            entities.append(cacheEntry)
+
+        memcache_timeout = timeout - datetime.datetime.now()
+        memcache.set_multi(dict([(_memcache_key(key), value)
+                                 for key, value in mapping.items()]),
+                           int(memcache_timeout.seconds), key_prefix='cache-')
+        self._put(entities)
+
+        if 'AEU_Events' in __main__.__dict__:
+            for key in mapping:
+                __main__.AEU_Events.fire_event('cacheSet')
+
+        return True
+
+    def delete_many(self, keys):
+        """
+        Deletes a number of cache objects with a single memcache call and a
+        single datastore batch delete.
+
+        Args:
+            keys: The keys of the cache objects to delete.
+
+        Returns True.
+        """
+        memcache.delete_multi([_memcache_key(key) for key in keys],
+                              key_prefix='cache-')
+        for key in keys:
+            _pending.pop(_key_name(key), None)
+        db.delete([db.Key.from_path(_AppEngineUtilities_Cache.kind(),
+                                    _key_name(key)) for key in keys])
+        if 'AEU_Events' in __main__.__dict__:
+            for key in keys:
+                __main__.AEU_Events.fire_event('cacheDeleted')
+        return True
 
     def __getitem__(self, key):
         """
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2008, appengine-utilities project
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+- Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+- Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+- Neither the name of the appengine-utilities project nor the names of its
+  contributors may be used to endorse or promote products derived from this
+  software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+# main python imports
+import cPickle
+import marshal
+import pickle
+import time
+
+from django.utils import simplejson
+
+# The first byte of every tagged payload. Untagged payloads written before
+# serializers were introduced are pure-Python pickles, which never start
+# with it, so they can still be read while entries are rewritten.
+HEADER = '\x00'
+
+# The tag byte following the header, by serializer name.
+_TAGS = {
+    'pickle': 'p',
+    'json': 'j',
+    'marshal': 'm',
+}
+
+# The serializer names, by tag byte.
+_NAMES = dict([(tag, name) for name, tag in _TAGS.items()])
+
+# The (dumps, loads) functions of each serializer, by name.
+_SERIALIZERS = {
+    'pickle': (lambda value: cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL),
+               cPickle.loads),
+    'json': (lambda value: simplejson.dumps(value, separators=(',', ':')),
+             simplejson.loads),
+    'marshal': (marshal.dumps, marshal.loads),
+}
+
+# Counters of the calls to, bytes handled by and seconds spent in each
+# serializer, by name; see stats().
+_stats = {}
+
+
+def _count(name, counter, nbytes, seconds):
+    counts = _stats.setdefault(name, {
+        'dumps': 0, 'dumps_bytes': 0, 'dumps_seconds': 0.0,
+        'loads': 0, 'loads_bytes': 0, 'loads_seconds': 0.0,
+    })
+    counts[counter] += 1
+    counts[counter + '_bytes'] += nbytes
+    counts[counter + '_seconds'] += seconds
+
+
+def dumps(value, serializer='pickle'):
+    """
+    Serializes a value into a tagged payload.
+
+    Args:
+        value: The value to serialize. The json serializer handles only
+            dicts, lists, strings, numbers, booleans and None, and marshal
+            only built in types.
+        serializer: The name of the serializer; one of 'pickle' (cPickle
+            at the highest protocol), 'json' or 'marshal'.
+
+    Returns the payload as a str.
+    """
+    if serializer not in _SERIALIZERS:
+        raise ValueError(u"Unknown serializer %s" % (serializer))
+    start = time.time()
+    payload = _SERIALIZERS[serializer][0](value)
+    data = HEADER + _TAGS[serializer] + payload
+    _count(serializer, 'dumps', len(data), time.time() - start)
+    return data
+
+
+def loads(data):
+    """
+    Deserializes a payload written by dumps() with any serializer, or an
+    untagged pickle.
+
+    Args:
+        data: The payload.
+
+    Returns the value.
+    """
+    if data[:1] != HEADER:
+        serializer, payload = 'legacy', data
+    else:
+        serializer, payload = _NAMES.get(data[1:2]), data[2:]
+        if serializer is None:
+            raise ValueError(u"Unknown serializer tag %r" % (data[1:2]))
+
+    start = time.time()
+    if serializer == 'legacy':
+        value = pickle.loads(payload)
+    else:
+        value = _SERIALIZERS[serializer][1](payload)
+    _count(serializer, 'loads', len(data), time.time() - start)
+    return value
+
+
+def stats():
+    """
+    Returns the counters of each serializer used since the instance started
+    or reset_stats() was called, as a dict of dicts by serializer name. The
+    counters are dumps, dumps_bytes, dumps_seconds, loads, loads_bytes and
+    loads_seconds. Untagged pickles are counted as 'legacy'.
+    """
+    return dict([(name, dict(counts)) for name, counts in _stats.items()])
+
+
+def reset_stats():
+    """
+    Resets the counters returned by stats().
+    """
+    _stats.clear()
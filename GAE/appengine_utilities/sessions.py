@@ -33,7 +33,6 @@ import datetime
 import random
 import hashlib
 import Cookie
-import pickle
 import __main__
 from time import strftime
 
@@ -45,6 +44,7 @@ from django.utils import simplejson
 
 # appengine_utilities import
 from rotmodel import ROTModel
+import serializers
 
 # settings
 try:
@@ -68,6 +68,7 @@ class _AppEngineUtilities_Session(ROTModel):
     dirty = db.BooleanProperty(default=False)
     working = db.BooleanProperty(default=False)
     deleted = db.BooleanProperty(default=False) 
+    data = db.BlobProperty()        # all session data, for the blob writer
 
     def put(self):
         """
@@ -115,9 +116,16 @@ class _AppEngineUtilities_Session(ROTModel):
         if session_obj.sid == None:
             return None
         session_key = session_obj.sid.split(u'_')[0]
-        session = memcache.get(u"_AppEngineUtilities_Session_%s" % \
-            (unicode(session_key)))
+        # fetch the session and its data items in a single memcache round
+        # trip; the items are used by the first lookup of a session value
+        session_mc_key = u"_AppEngineUtilities_Session_%s" % \
+            (unicode(session_key))
+        data_mc_key = u"_AppEngineUtilities_SessionData_%s" % \
+            (unicode(session_key))
+        cached = memcache.get_multi([session_mc_key, data_mc_key])
+        session = cached.get(session_mc_key)
         if session:
+            session_obj._prefetched_items = cached.get(data_mc_key)
             if session.deleted == True:
                 session.delete()
                 return None
@@ -387,13 +395,58 @@ class _DatastoreWriter(object):
                 value.put()
             sessdata.model = value
         except:
-            sessdata.content = pickle.dumps(value)
+            sessdata.content = serializers.dumps(value,
+                settings.session["SERIALIZER"])
             sessdata.model = None
             
         session.cache[keyname] = value
         return sessdata.put()
 
 
+class _BlobWriter(object):
+
+    def put(self, keyname, value, session):
+        """
+        Insert a keyname/value pair into the session's data blob. The
+        session entity is written once, by Session.save(), at the end of
+        the request.
+
+        Args:
+            keyname: The keyname of the mapping.
+            value: The value of the mapping.
+
+        Returns True
+        """
+        keyname = session._validate_key(keyname)
+        if value is None:
+            raise ValueError(u"You must pass a value to put.")
+
+        # datestore write trumps cookie. If there is a cookie value
+        # with this keyname, delete it so we don't have conflicting
+        # entries.
+        if session.cookie_vals.has_key(keyname):
+            del(session.cookie_vals[keyname])
+            session.output_cookie["%s_data" % (session.cookie_name)] = \
+                simplejson.dumps(session.cookie_vals)
+            print session.output_cookie.output()
+
+        # models are stored by key, like the datastore writer's references,
+        # so they are read fresh from the datastore
+        blob = session._blob_items()
+        if isinstance(value, db.Model):
+            if not value.is_saved():
+                value.put()
+            blob[u"models"][keyname] = str(value.key())
+            blob[u"values"].pop(keyname, None)
+        else:
+            blob[u"values"][keyname] = value
+            blob[u"models"].pop(keyname, None)
+
+        session.cache[keyname] = value
+        session._dirty = True
+        return True
+
+
 class _CookieWriter(object):
     def put(self, keyname, value, session):
         """
@@ -427,7 +480,7 @@ class Session(object):
     Sessions can either be stored server side in the datastore/memcache, or
     be kept entirely as cookies. This is set either with the settings file
     or on initialization, using the writer argument/setting field. Valid
-    values are "datastore" or "cookie".
+    values are "datastore", "blob" or "cookie".
 
     Session can be used as a standard dictionary object.
         session = appengine_utilities.sessions.Session()
@@ -464,8 +517,8 @@ class Session(object):
         .appspot.com domain, and ssl requests are a finite resource. This is
         why such a thing is not currently implemented.
 
-        Session data objects are stored in the datastore pickled, so any
-        python object is valid for storage.
+        Session data objects are stored in the datastore pickled (see the
+        SERIALIZER setting), so any python object is valid for storage.
 
     Cookie Writer:
         Sessions using the cookie writer are stored entirely in the browser
@@ -477,6 +530,15 @@ class Session(object):
         Information is stored in a json format, as pickled data from the
         server is unreliable.
 
+    Blob Writer:
+        Sessions using the blob writer work like datastore writer sessions,
+        but keep all of their data in a single serialized blob on the
+        session entity rather than in one entity per key. The data is read
+        along with the session and changes are written once, with the
+        session entity, when save() is called at the end of the request
+        (see middleware.SessionMiddleware). Sessions that did not change
+        are not written.
+
         Note: There is no checksum validation of session data on this method,
         it's streamlined for pure performance. If you need to make sure data
         is not tampered with, use the datastore writer which stores the data
@@ -537,6 +599,11 @@ class Session(object):
         self.last_activity_update = last_activity_update
         self.writer = writer
 
+        # the decoded data blob and whether the session entity must be
+        # written by save(), for the blob writer
+        self._blob = None
+        self._dirty = False
+
         # make sure the page is not cached in the browser
         print self.no_cache_headers()
         # Check the cookie and, if necessary, create a new one.
@@ -621,7 +688,9 @@ class Session(object):
             self.cache[u"sid"] = self.sid
 
             if do_put:
-                if self.sid != None or self.sid != u"":
+                if writer == "blob":
+                    self._dirty = True
+                elif self.sid != None or self.sid != u"":
                     self.session.put()
 
         if self.set_cookie_expires:
@@ -637,8 +706,10 @@ class Session(object):
             self.flash = flash.Flash(cookie=self.cookie)
 
         # randomly delete old stale sessions in the datastore (see
-        # CLEAN_CHECK_PERCENT variable)
-        if random.randint(1, 100) < clean_check_percent:
+        # CLEAN_CHECK_PERCENT variable), unless the sweeper deletes them in
+        # the background (see CLEAN_IN_BACKGROUND)
+        if not settings.session.get("CLEAN_IN_BACKGROUND") and \
+                random.randint(1, 100) < clean_check_percent:
             self._clean_old_sessions() 
 
     def new_sid(self):
@@ -674,6 +745,13 @@ class Session(object):
         Returns a list of datastore entities.
         """
         if keyname != None:
+            # use the items prefetched along with the session, once; later
+            # lookups go back to memcache in case the items have changed
+            items = self.__dict__.pop("_prefetched_items", None)
+            if items:
+                for item in items:
+                    if item.keyname == keyname and item.deleted != True:
+                        return item
             return self.session.get_item(keyname)
         return self.session.get_items()
 
@@ -708,11 +786,67 @@ class Session(object):
         """
         if self.writer == "datastore":
             writer = _DatastoreWriter()
+        elif self.writer == "blob":
+            writer = _BlobWriter()
         else:
             writer = _CookieWriter()
 
         return writer.put(keyname, value, self)
 
+    def _blob_items(self):
+        """
+        private method
+
+        Returns the session data of a blob writer session, decoding the
+        session entity's data blob on first use. The data is a dictionary
+        with a "values" dictionary of keyname/value pairs and a "models"
+        dictionary of keynames and the keys of the models stored in them.
+
+        Sessions written before the blob writer was enabled have no data
+        blob; their SessionData items are copied into it, and the blob is
+        written at the end of the request so they are only read once. The
+        items themselves are deleted along with the session.
+        """
+        if self._blob is None:
+            self._blob = {u"values": {}, u"models": {}}
+            if self.session.data:
+                try:
+                    self._blob = serializers.loads(self.session.data)
+                except:
+                    pass
+            elif self.session.data is None:
+                for item in self._get() or []:
+                    if item.deleted == True:
+                        continue
+                    model_key = _AppEngineUtilities_SessionData.model. \
+                        get_value_for_datastore(item)
+                    if model_key is not None:
+                        self._blob[u"models"][item.keyname] = str(model_key)
+                        continue
+                    try:
+                        self._blob[u"values"][item.keyname] = \
+                            serializers.loads(item.content)
+                    except:
+                        pass
+                self._dirty = True
+        return self._blob
+
+    def save(self):
+        """
+        Writes the session entity if it changed during the request. Only
+        blob writer sessions defer their writes until save() is called.
+
+        Returns True if the session was written.
+        """
+        if not self._dirty or not hasattr(self, u"session"):
+            return False
+        if self._blob is not None:
+            self.session.data = serializers.dumps(self._blob,
+                settings.session["SERIALIZER"])
+        self.session.put()
+        self._dirty = False
+        return True
+
     def _delete_session(self):
         """
         private method
@@ -728,6 +862,8 @@ class Session(object):
             self.session.delete()
         self.cookie_vals = {}
         self.cache = {}
+        self._blob = None
+        self._dirty = False
         self.output_cookie["%s_data" % (self.cookie_name)] = \
             simplejson.dumps(self.cookie_vals)
         print self.output_cookie.output()
@@ -836,7 +972,12 @@ class Session(object):
 
         Returns True
         """
-        sessiondata = self._get()
+        if self.writer == "blob" and hasattr(self, u"session"):
+            self._blob = {u"values": {}, u"models": {}}
+            self._dirty = True
+            sessiondata = None
+        else:
+            sessiondata = self._get()
         # delete from datastore
         if sessiondata is not None:
             for sd in sessiondata:
@@ -1000,6 +1141,20 @@ class Session(object):
             return self.cache[keyname]
         if keyname in self.cookie_vals:
             return self.cookie_vals[keyname]
+        if self.writer == "blob" and hasattr(self, u"session"):
+            blob = self._blob_items()
+            if keyname in blob[u"values"]:
+                self.cache[keyname] = blob[u"values"][keyname]
+                return self.cache[keyname]
+            if keyname in blob[u"models"]:
+                model = db.get(blob[u"models"][keyname])
+                if model is not None:
+                    self.cache[keyname] = model
+                    return self.cache[keyname]
+                # the model has been deleted
+                del blob[u"models"][keyname]
+                self._dirty = True
+            raise KeyError(unicode(keyname))
         if hasattr(self, u"session"):
             data = self._get(keyname)
             if data:
@@ -1011,7 +1166,7 @@ class Session(object):
                         self.cache[keyname] = data.model
                         return self.cache[keyname]
                     else:
-                        self.cache[keyname] = pickle.loads(data.content)
+                        self.cache[keyname] = serializers.loads(data.content)
                         return self.cache[keyname]
                 except:
                     self.delete_item(keyname)
@@ -1064,11 +1219,20 @@ class Session(object):
             keyname: The keyname of the object to delete.
         """
         bad_key = False
-        sessdata = self._get(keyname = keyname)
-        if sessdata is None:
-            bad_key = True
+        if self.writer == "blob" and hasattr(self, u"session"):
+            blob = self._blob_items()
+            if keyname in blob[u"values"] or keyname in blob[u"models"]:
+                blob[u"values"].pop(keyname, None)
+                blob[u"models"].pop(keyname, None)
+                self._dirty = True
+            else:
+                bad_key = True
         else:
-            sessdata.delete()
+            sessdata = self._get(keyname = keyname)
+            if sessdata is None:
+                bad_key = True
+            else:
+                sessdata.delete()
         if keyname in self.cookie_vals:
             del self.cookie_vals[keyname]
             bad_key = False
@@ -1084,6 +1248,10 @@ class Session(object):
         """
         Return size of session.
         """
+        if self.writer == "blob" and hasattr(self, u"session"):
+            blob = self._blob_items()
+            return len(blob[u"values"]) + len(blob[u"models"]) + \
+                len(self.cookie_vals)
         # check memcache first
         if hasattr(self, u"session"):
             results = self._get()
@@ -1110,8 +1278,12 @@ class Session(object):
         """
         Iterate over the keys in the session data.
         """
+        if self.writer == "blob" and hasattr(self, u"session"):
+            blob = self._blob_items()
+            for k in blob[u"values"].keys() + blob[u"models"].keys():
+                yield k
         # try memcache first
-        if hasattr(self, u"session"):
+        elif hasattr(self, u"session"):
             vals = self._get()
             if vals is not None:
                 for k in vals:
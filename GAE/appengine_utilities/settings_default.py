@@ -39,15 +39,21 @@ session = {
     "SET_COOKIE_EXPIRES": True,     # Set to True to add expiration field to
                                     # cookie
     "WRITER":"datastore",           # Use the datastore writer by default. 
-                                    # cookie is the other option.
+                                    # cookie and blob are the other options.
     "CLEAN_CHECK_PERCENT": 50,      # By default, 50% of all requests will clean
                                     # the datastore of expired sessions
+    "CLEAN_IN_BACKGROUND": False,   # Set to True when sweeper.sweep_expired
+                                    # runs regularly; requests then no longer
+                                    # clean expired sessions themselves
     "CHECK_IP": True,               # validate sessions by IP
     "CHECK_USER_AGENT": True,       # validate sessions by user agent
     "SESSION_TOKEN_TTL": 5,         # Number of seconds a session token is valid
                                     # for.
     "UPDATE_LAST_ACTIVITY": 60,     # Number of seconds that may pass before
                                     # last_activity is updated
+    "SERIALIZER": "pickle",         # How session data is stored in the
+                                    # datastore: pickle, json or marshal (see
+                                    # serializers.py)
 }
 
 # Configuration settings for the cache class
@@ -55,6 +61,12 @@ cache = {
     "DEFAULT_TIMEOUT": 3600, # cache expires after one hour (3600 sec)
     "CLEAN_CHECK_PERCENT": 50, # 50% of all requests will clean the database
     "MAX_HITS_TO_CLEAN": 20, # the maximum number of cache hits to clean
+    "NEGATIVE_TIMEOUT": 5, # misses are remembered in memcache for 5 sec
+    "WRITE_BEHIND": False, # True to buffer datastore writes until flush()
+    "WRITE_BEHIND_BATCH_SIZE": 100, # flush once this many writes are buffered
+    "SERIALIZER": "pickle", # pickle, json or marshal (see serializers.py)
+    "CLEAN_IN_BACKGROUND": False, # True if sweeper.sweep_expired cleans the
+                                  # database instead of requests
 }
 
 # Configuration settings for the flash class
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2008, appengine-utilities project
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+- Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+- Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+- Neither the name of the appengine-utilities project nor the names of its
+  contributors may be used to endorse or promote products derived from this
+  software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+# main python imports
+import datetime
+import logging
+
+# google appengine imports
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.api import memcache
+
+# appengine_utilities imports
+from sessions import _AppEngineUtilities_Session
+from sessions import _AppEngineUtilities_SessionData
+from cache import _AppEngineUtilities_Cache
+
+# settings
+try:
+    import settings
+except:
+    import settings_default as settings
+
+# The number of expired entities each sweep step deletes.
+BATCH_SIZE = 100
+
+# The maximum number of values in a datastore IN filter.
+MAX_IN_VALUES = 30
+
+
+def sweep_sessions(cutoff=None, cursor=None, batch_size=BATCH_SIZE):
+    """
+    Deletes a batch of sessions whose last activity is older than cutoff,
+    along with their session data.
+
+    Expired sessions are paged through with a keys only query, so a sweep
+    never reads the session data it is about to delete; only the
+    session_key of each expired session is read, with one batch get, to
+    find its data.
+
+    Args:
+        cutoff: datetime.datetime before which sessions are expired, by
+            default SESSION_EXPIRE_TIME seconds ago. Pass the same cutoff
+            along with the cursor when continuing a sweep.
+        cursor: the cursor returned by the previous step of the sweep.
+        batch_size: the number of sessions to delete.
+
+    Returns a (num_deleted, cursor) tuple, where cursor is None once there
+    are no more expired sessions.
+    """
+    if cutoff is None:
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            seconds=settings.session["SESSION_EXPIRE_TIME"])
+
+    query = _AppEngineUtilities_Session.all(keys_only=True)
+    query.filter(u"last_activity <", cutoff)
+    if cursor:
+        query.with_cursor(cursor)
+    keys = query.fetch(batch_size)
+    if not keys:
+        return 0, None
+    next_cursor = query.cursor()
+
+    session_keys = [session.session_key for session in db.get(keys)
+                    if session is not None]
+    data_keys = []
+    for i in range(0, len(session_keys), MAX_IN_VALUES):
+        data_query = _AppEngineUtilities_SessionData.all(keys_only=True)
+        data_query.filter(u"session_key IN",
+                          session_keys[i:i + MAX_IN_VALUES])
+        data_keys.extend(data_query.fetch(1000))
+
+    db.delete(data_keys + keys)
+    memcache.delete_multi(
+        [u"_AppEngineUtilities_Session_%s" % (unicode(session_key))
+         for session_key in session_keys] +
+        [u"_AppEngineUtilities_SessionData_%s" % (unicode(session_key))
+         for session_key in session_keys])
+
+    if len(keys) < batch_size:
+        next_cursor = None
+    return len(keys), next_cursor
+
+
+def sweep_cache(cutoff=None, cursor=None, batch_size=BATCH_SIZE):
+    """
+    Deletes a batch of cache entries that timed out before cutoff.
+
+    Args:
+        cutoff: datetime.datetime before which entries are expired, by
+            default now. Pass the same cutoff along with the cursor when
+            continuing a sweep.
+        cursor: the cursor returned by the previous step of the sweep.
+        batch_size: the number of entries to delete.
+
+    Returns a (num_deleted, cursor) tuple, where cursor is None once there
+    are no more expired entries.
+    """
+    if cutoff is None:
+        cutoff = datetime.datetime.now()
+
+    query = _AppEngineUtilities_Cache.all(keys_only=True)
+    query.filter('timeout <', cutoff)
+    if cursor:
+        query.with_cursor(cursor)
+    keys = query.fetch(batch_size)
+    if not keys:
+        return 0, None
+    next_cursor = query.cursor()
+
+    db.delete(keys)
+
+    if len(keys) < batch_size:
+        next_cursor = None
+    return len(keys), next_cursor
+
+
+def sweep_expired(session_cutoff=None, session_cursor=None,
+                  cache_cutoff=None, cache_cursor=None, start=True):
+    """
+    Deferred task that sweeps expired sessions and cache entries, one
+    batch of each per task, deferring itself until both are done.
+
+    Schedule it regularly, e.g. from cron, and set CLEAN_IN_BACKGROUND in
+    the session and cache settings so requests no longer clean up:
+
+        deferred.defer(sweeper.sweep_expired)
+    """
+    now = datetime.datetime.now()
+    if start:
+        session_cutoff = now - datetime.timedelta(
+            seconds=settings.session["SESSION_EXPIRE_TIME"])
+        cache_cutoff = now
+
+    sessions_deleted = cache_deleted = 0
+    if session_cutoff is not None:
+        sessions_deleted, session_cursor = sweep_sessions(session_cutoff,
+                                                          session_cursor)
+        if session_cursor is None:
+            session_cutoff = None
+    if cache_cutoff is not None:
+        cache_deleted, cache_cursor = sweep_cache(cache_cutoff, cache_cursor)
+        if cache_cursor is None:
+            cache_cutoff = None
+
+    logging.info(u"swept %d expired sessions and %d expired cache entries" %
+                 (sessions_deleted, cache_deleted))
+
+    if session_cutoff is not None or cache_cutoff is not None:
+        deferred.defer(sweep_expired, session_cutoff, session_cursor,
+                       cache_cutoff, cache_cursor, False)
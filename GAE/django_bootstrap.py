@@ -33,8 +33,12 @@ from model import *
 # Google App Hosting imports.
 from google.appengine.ext.webapp import util
 
-import pickle
-sys.modules['cPickle'] = pickle
+# cPickle misbehaves under the development server's sandbox, so use the
+# pure-Python pickle module there. Production keeps cPickle, which is
+# several times faster for the datastore backend's pickled fields.
+if os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
+  import pickle
+  sys.modules['cPickle'] = pickle
 
 # Enable info logging by the app (this is separate from appserver's
 # logging).
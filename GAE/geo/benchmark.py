@@ -0,0 +1,431 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the geocell math and geo queries on synthetic datasets.
+
+Usage:
+  python benchmark.py [--sizes=1000,10000] [--datasets=uniform,clustered]
+                      [--queries=200] [--output=results.json]
+
+Each dataset is generated with a fixed seed, so runs are comparable:
+
+  uniform:    points spread uniformly over the globe's populated latitudes.
+  clustered:  points around a few hundred city centers whose populations
+              follow a power law, like real user locations.
+  edge:       points near the poles and the antimeridian, where geocells
+              are most distorted and searches wrap around.
+
+For each dataset and size the in-memory benchmarks time geocell and
+integer geocell computation, best_bbox_search_cells(), interpolate() and
+SpatialIndex nearest neighbor queries. If the App Engine SDK is importable
+the datastore benchmarks also load up to --max-datastore-points points into
+the SDK's in-memory datastore stub and time proximity_fetch() (with both
+search strategies), bounding_box_fetch() and polygon_fetch(), counting the
+datastore RPCs each query makes and the entities it scans per result.
+
+Latencies are reported as percentiles in milliseconds. The results, along
+with the peak memory use of the process, are written as JSON to --output so
+runs can be compared over time.
+"""
+
+import math
+import optparse
+import os
+import random
+import sys
+import time
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+import geocell
+import geomath
+import geotypes
+import intcell
+import region
+import spatialindex
+
+DATASETS = ('uniform', 'clustered', 'edge')
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+
+# Loading points into the datastore stub is slow, so larger datasets only
+# run the in-memory benchmarks by default.
+DEFAULT_MAX_DATASTORE_POINTS = 100000
+
+DEFAULT_QUERIES = 200
+
+# Proximity searches look for this many results within this many meters.
+PROXIMITY_MAX_RESULTS = 10
+PROXIMITY_MAX_DISTANCE = 10000
+
+# The half-size of the bounding boxes and polygons queried, in degrees.
+QUERY_BOX_SIZE = 0.1
+
+PERCENTILES = (50, 90, 99)
+
+SEED = 1
+
+_APP_ID = 'geo-benchmark'
+
+
+def uniform_points(rng, n):
+  """Returns n points spread uniformly over latitudes -60 to 70."""
+  return [geotypes.Point(rng.uniform(-60, 70), rng.uniform(-180, 180))
+          for i in xrange(n)]
+
+
+def clustered_points(rng, n, num_cities=300):
+  """Returns n points clustered around cities of power law populations."""
+  cities = []
+  for i in range(num_cities):
+    # Larger cities are also more spread out.
+    weight = 1.0 / (i + 1)
+    cities.append((weight, rng.uniform(-45, 60), rng.uniform(-180, 180),
+                   0.05 + 0.3 * math.sqrt(weight)))
+  total = sum([city[0] for city in cities])
+
+  points = []
+  for i in xrange(n):
+    pick = rng.uniform(0, total)
+    for weight, lat, lon, spread in cities:
+      pick -= weight
+      if pick <= 0:
+        break
+    points.append(geotypes.Point(
+        max(-90.0, min(90.0, rng.gauss(lat, spread))),
+        _wrap_lon(rng.gauss(lon, spread))))
+  return points
+
+
+def edge_points(rng, n):
+  """Returns n points near the poles and near the antimeridian."""
+  points = []
+  for i in xrange(n):
+    if i % 2:
+      lat = rng.choice((-1, 1)) * rng.uniform(85, 90)
+      lon = rng.uniform(-180, 180)
+    else:
+      lat = rng.uniform(-70, 70)
+      lon = _wrap_lon(180 + rng.uniform(-2, 2))
+    points.append(geotypes.Point(lat, lon))
+  return points
+
+
+def generate(dataset, n, seed=SEED):
+  """Generates a dataset of n points."""
+  rng = random.Random(seed)
+  if dataset == 'uniform':
+    return uniform_points(rng, n)
+  if dataset == 'clustered':
+    return clustered_points(rng, n)
+  if dataset == 'edge':
+    return edge_points(rng, n)
+  raise ValueError('Unknown dataset %r' % dataset)
+
+
+def _wrap_lon(lon):
+  return (lon + 180) % 360 - 180
+
+
+def _query_box(center):
+  """Returns the bounding box of size QUERY_BOX_SIZE around a point."""
+  return geotypes.Box(min(90.0, center.lat + QUERY_BOX_SIZE),
+                      min(180.0, center.lon + QUERY_BOX_SIZE),
+                      max(-90.0, center.lat - QUERY_BOX_SIZE),
+                      max(-180.0, center.lon - QUERY_BOX_SIZE))
+
+
+def _query_polygon(center):
+  """Returns a diamond of size QUERY_BOX_SIZE around a point."""
+  box = _query_box(center)
+  mid_lat = (box.north + box.south) / 2
+  mid_lon = (box.east + box.west) / 2
+  return region.Polygon([geotypes.Point(box.north, mid_lon),
+                         geotypes.Point(mid_lat, box.east),
+                         geotypes.Point(box.south, mid_lon),
+                         geotypes.Point(mid_lat, box.west)])
+
+
+def percentiles(values):
+  """Returns a dict of the nearest rank percentiles and mean of values."""
+  values = sorted(values)
+  if not values:
+    return {}
+  stats = {'mean': sum(values) / len(values)}
+  for pct in PERCENTILES:
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    stats['p%d' % pct] = values[max(rank, 0)]
+  return stats
+
+
+def time_calls(function, args_list):
+  """Calls function once per args tuple, returning the latencies in ms."""
+  latencies = []
+  for args in args_list:
+    start = time.time()
+    function(*args)
+    latencies.append((time.time() - start) * 1000)
+  return latencies
+
+
+def max_rss_kb():
+  """Returns the peak resident memory of the process in kB, if known."""
+  if resource is None:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    rss /= 1024
+  return rss
+
+
+def memory_benchmarks(dataset, points, queries):
+  """Runs the benchmarks that don't need a datastore.
+
+  Returns:
+    A list of result dicts.
+  """
+  results = []
+
+  def record(name, latencies, **extra):
+    result = {'dataset': dataset, 'size': len(points), 'benchmark': name,
+              'calls': len(latencies), 'latency_ms': percentiles(latencies),
+              'max_rss_kb': max_rss_kb()}
+    result.update(extra)
+    results.append(result)
+
+  res = geocell.MAX_GEOCELL_RESOLUTION
+  record('geocell.compute',
+         time_calls(geocell.compute, [(p, res) for p in queries]))
+  record('intcell.compute',
+         time_calls(intcell.compute, [(p, res) for p in queries]))
+
+  start = time.time()
+  geocell.compute_many(points, res)
+  elapsed = time.time() - start
+  record('geocell.compute_many', [elapsed * 1000],
+         points_per_second=len(points) / max(elapsed, 1e-9))
+
+  boxes = [(_query_box(p),) for p in queries]
+  cost_function = lambda num_cells, resolution: (
+      1e10000 if num_cells > geocell._GEOCELL_GRID_SIZE ** 2 else 0)
+  record('geocell.best_bbox_search_cells',
+         time_calls(lambda box: geocell.best_bbox_search_cells(
+             box, cost_function), boxes))
+  record('intcell.best_bbox_search_cells',
+         time_calls(lambda box: intcell.best_bbox_search_cells(
+             box, cost_function), boxes))
+
+  cell_pairs = [(geocell.compute(box.north_east, 6),
+                 geocell.compute(box.south_west, 6)) for (box,) in boxes]
+  record('geocell.interpolate', time_calls(geocell.interpolate, cell_pairs))
+  record('intcell.interpolate', time_calls(
+      intcell.interpolate, [(intcell.from_string(ne), intcell.from_string(sw))
+                            for ne, sw in cell_pairs]))
+
+  record('geomath.distances', time_calls(
+      lambda center: geomath.distances(center, points,
+                                       max_distance=PROXIMITY_MAX_DISTANCE),
+      [(p,) for p in queries[:10]]))
+
+  index = spatialindex.SpatialIndex()
+  start = time.time()
+  for i, point in enumerate(points):
+    index.add(i, point, i)
+  build_ms = (time.time() - start) * 1000
+
+  found = []
+  def nearest(center):
+    found.append(len(index.nearest(center, PROXIMITY_MAX_RESULTS,
+                                   PROXIMITY_MAX_DISTANCE)))
+  record('spatialindex.nearest', time_calls(nearest, [(p,) for p in queries]),
+         build_ms=build_ms,
+         results_per_query=float(sum(found)) / len(found))
+
+  return results
+
+
+class _DatastoreStats(object):
+  """Counts datastore RPCs and the entities returned by queries."""
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.rpcs = 0
+    self.scanned = 0
+
+  def pre_call_hook(self, service, call, request, response):
+    self.rpcs += 1
+
+  def post_call_hook(self, service, call, request, response):
+    if call in ('RunQuery', 'Next'):
+      self.scanned += response.result_size()
+
+
+def setup_datastore():
+  """Installs the SDK's in-memory datastore stub.
+
+  Returns:
+    A _DatastoreStats counting the datastore calls made from now on.
+  """
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.api import datastore_file_stub
+
+  os.environ['APPLICATION_ID'] = _APP_ID
+  os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'datastore_v3', datastore_file_stub.DatastoreFileStub(_APP_ID, None, None))
+
+  stats = _DatastoreStats()
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'benchmark_rpcs', stats.pre_call_hook, 'datastore_v3')
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+      'benchmark_scanned', stats.post_call_hook, 'datastore_v3')
+  return stats
+
+
+def datastore_benchmarks(dataset, points, queries):
+  """Loads points into a fresh datastore stub and times geo queries on it.
+
+  Returns:
+    A list of result dicts.
+  """
+  from google.appengine.ext import db
+  import geomodel
+
+  class BenchmarkPoint(geomodel.GeoModel):
+    pass
+
+  stats = setup_datastore()
+
+  start = time.time()
+  for i in xrange(0, len(points), 500):
+    batch = [BenchmarkPoint(location=db.GeoPt(p.lat, p.lon))
+             for p in points[i:i + 500]]
+    geomodel.GeoModel.update_locations(batch)
+    db.put(batch)
+  load_ms = (time.time() - start) * 1000
+
+  results = []
+
+  def run(name, fetch, args_list):
+    latencies = []
+    rpcs = []
+    scanned = 0
+    found = 0
+    for args in args_list:
+      stats.reset()
+      start = time.time()
+      num_results = len(fetch(*args))
+      latencies.append((time.time() - start) * 1000)
+      rpcs.append(stats.rpcs)
+      scanned += stats.scanned
+      found += num_results
+    results.append({
+        'dataset': dataset, 'size': len(points), 'benchmark': name,
+        'calls': len(latencies), 'latency_ms': percentiles(latencies),
+        'rpcs': percentiles(rpcs), 'load_ms': load_ms,
+        'results_per_query': float(found) / len(args_list),
+        'scanned_per_result': float(scanned) / max(found, 1),
+        'max_rss_kb': max_rss_kb()})
+
+  centers = [(p,) for p in queries]
+  for strategy in (geomodel.PLANNED_SEARCH, geomodel.GREEDY_SEARCH):
+    run('geomodel.proximity_fetch[%s]' % strategy,
+        lambda center: BenchmarkPoint.proximity_fetch(
+            BenchmarkPoint.all(), center,
+            max_results=PROXIMITY_MAX_RESULTS,
+            max_distance=PROXIMITY_MAX_DISTANCE, strategy=strategy),
+        centers)
+
+  run('geomodel.bounding_box_fetch',
+      lambda center: BenchmarkPoint.bounding_box_fetch(
+          BenchmarkPoint.all(), _query_box(center)),
+      centers)
+  run('geomodel.polygon_fetch',
+      lambda center: BenchmarkPoint.polygon_fetch(
+          BenchmarkPoint.all(), _query_polygon(center)),
+      centers)
+
+  return results
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--datasets', default=','.join(DATASETS),
+                    help='comma separated datasets to run [%default]')
+  parser.add_option('--sizes',
+                    default=','.join([str(size) for size in DEFAULT_SIZES]),
+                    help='comma separated dataset sizes [%default]')
+  parser.add_option('--queries', type='int', default=DEFAULT_QUERIES,
+                    help='queries per benchmark [%default]')
+  parser.add_option('--max-datastore-points', type='int',
+                    default=DEFAULT_MAX_DATASTORE_POINTS,
+                    help='largest dataset loaded into the datastore stub, '
+                         '0 to skip the datastore benchmarks [%default]')
+  parser.add_option('--output', default='benchmark_results.json',
+                    help='file to write the JSON results to [%default]')
+  options, args = parser.parse_args(argv[1:])
+
+  run_datastore = options.max_datastore_points > 0
+  if run_datastore:
+    try:
+      import google.appengine.api.datastore_file_stub
+    except ImportError:
+      sys.stderr.write('App Engine SDK not found, skipping the datastore '
+                       'benchmarks\n')
+      run_datastore = False
+
+  results = []
+  for dataset in options.datasets.split(','):
+    for size in [int(size) for size in options.sizes.split(',')]:
+      points = generate(dataset, size)
+      # Query around points of the dataset itself, so searches find results.
+      queries = random.Random(SEED).sample(points, min(options.queries, size))
+
+      sys.stderr.write('%s %d: in-memory\n' % (dataset, size))
+      results.extend(memory_benchmarks(dataset, points, queries))
+
+      if run_datastore and size <= options.max_datastore_points:
+        sys.stderr.write('%s %d: datastore\n' % (dataset, size))
+        results.extend(datastore_benchmarks(dataset, points, queries))
+
+  for result in results:
+    sys.stdout.write('%-10s %8d  %-40s p50=%.3fms p99=%.3fms\n' % (
+        result['dataset'], result['size'], result['benchmark'],
+        result['latency_ms']['p50'], result['latency_ms']['p99']))
+
+  output = open(options.output, 'w')
+  try:
+    json.dump({'timestamp': time.time(), 'python': sys.version.split()[0],
+               'platform': sys.platform, 'queries': options.queries,
+               'max_rss_kb': max_rss_kb(), 'results': results},
+              output, indent=2, sort_keys=True)
+  finally:
+    output.close()
+  sys.stderr.write('wrote %d results to %s\n' % (len(results), options.output))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
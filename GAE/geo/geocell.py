@@ -72,6 +72,12 @@ import sys
 
 import geomath
 import geotypes
+import lru
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 # Geocell algorithm constants.
 _GEOCELL_GRID_SIZE = 4
@@ -80,6 +86,12 @@ _GEOCELL_ALPHABET = '0123456789abcdef'
 # The maximum *practical* geocell resolution.
 MAX_GEOCELL_RESOLUTION = 13
 
+# The maximum resolution whose interleaved x/y bits fit in a 64-bit integer.
+_MAX_VECTORIZED_RESOLUTION = 16
+
+# The maximum number of geocell boxes to keep memoized by compute_box.
+BOX_CACHE_SIZE = 10000
+
 # The maximum number of geocells to consider for a bounding box search.
 MAX_FEASIBLE_BBOX_SEARCH_CELLS = 300
 
@@ -405,6 +417,96 @@ def compute(point, resolution=MAX_GEOCELL_RESOLUTION):
   return cell
 
 
+def compute_many(points, resolution=MAX_GEOCELL_RESOLUTION):
+  """Computes the geocells containing each of the given points.
+
+  Rather than walking the 16-tree one level at a time for each point, this
+  scales each point onto the integer grid at the given resolution and
+  interleaves the x and y bits; every 4 bits of the interleaved integer
+  are then exactly one geocell character. When NumPy is available the whole
+  batch is computed using array operations, otherwise a pure-Python
+  implementation of the same algorithm is used.
+
+  Args:
+    points: A sequence of geotypes.Point or db.GeoPt objects.
+    resolution: An int indicating the resolution of the cells to compute.
+
+  Returns:
+    A list of geocell strings of length <resolution>, in the same order as the
+    given points.
+  """
+  if not points:
+    return []
+  if resolution <= 0:
+    return ['' for point in points]
+
+  if numpy is not None and resolution <= _MAX_VECTORIZED_RESOLUTION:
+    return _compute_many_numpy(points, resolution)
+
+  grid_size = _GEOCELL_GRID_SIZE ** resolution
+  cell_format = '%%0%dx' % resolution
+  return [cell_format % _interleave(
+              _grid_coord(point.lon, -180.0, 360.0, grid_size),
+              _grid_coord(point.lat, -90.0, 180.0, grid_size))
+          for point in points]
+
+
+def _compute_many_numpy(points, resolution):
+  """Vectorized implementation of compute_many using NumPy arrays."""
+  grid_size = _GEOCELL_GRID_SIZE ** resolution
+
+  lats = numpy.array([point.lat for point in points], dtype=numpy.float64)
+  lons = numpy.array([point.lon for point in points], dtype=numpy.float64)
+
+  x = numpy.minimum((grid_size * (lons + 180.0) / 360.0).astype(numpy.uint64),
+                    numpy.uint64(grid_size - 1))
+  y = numpy.minimum((grid_size * (lats + 90.0) / 180.0).astype(numpy.uint64),
+                    numpy.uint64(grid_size - 1))
+  codes = _spread_bits_numpy(x) | (_spread_bits_numpy(y) << numpy.uint64(1))
+
+  # Pull out one 4-bit geocell character per resolution level, most
+  # significant first, and view each row of ASCII bytes as a single string.
+  shifts = numpy.arange(4 * (resolution - 1), -1, -4, dtype=numpy.uint64)
+  nibbles = (codes[:, numpy.newaxis] >> shifts) & numpy.uint64(0xf)
+  alphabet = numpy.frombuffer(_GEOCELL_ALPHABET, dtype=numpy.uint8)
+  chars = numpy.ascontiguousarray(alphabet[nibbles.astype(numpy.intp)])
+  return [str(cell) for cell in chars.view('S%d' % resolution).ravel()]
+
+
+def _spread_bits_numpy(values):
+  """Spreads the low 32 bits of each uint64 value out to the even bits."""
+  values = values & numpy.uint64(0x00000000ffffffff)
+  for shift, mask in ((16, 0x0000ffff0000ffff),
+                      (8,  0x00ff00ff00ff00ff),
+                      (4,  0x0f0f0f0f0f0f0f0f),
+                      (2,  0x3333333333333333),
+                      (1,  0x5555555555555555)):
+    values = (values | (values << numpy.uint64(shift))) & numpy.uint64(mask)
+  return values
+
+
+def _grid_coord(value, origin, span, grid_size):
+  """Returns the integer grid coordinate of value along one dimension."""
+  return min(int(grid_size * (value - origin) / span), grid_size - 1)
+
+
+# Lookup table mapping a byte to its bits spread out to the even bit positions.
+_SPREAD_BYTE = [sum([((b >> i) & 1) << (2 * i) for i in range(8)])
+                for b in range(256)]
+
+
+def _interleave(x, y):
+  """Interleaves the bits of x (even positions) and y (odd positions)."""
+  code = 0
+  shift = 0
+  while x or y:
+    code |= (_SPREAD_BYTE[x & 0xff] | _SPREAD_BYTE[y & 0xff] << 1) << shift
+    x >>= 8
+    y >>= 8
+    shift += 16
+  return code
+
+
 def compute_box(cell):
   """Computes the rectangular boundaries (bounding box) of the given geocell.
 
@@ -413,26 +515,38 @@ def compute_box(cell):
 
   Returns:
     A geotypes.Box corresponding to the rectangular boundaries of the geocell.
+    Boxes are memoized in BOX_CACHE and shared between callers, so they must
+    not be modified.
   """
   if cell is None:
     return None
 
-  bbox = geotypes.Box(90.0, 180.0, -90.0, -180.0)
+  bbox = BOX_CACHE.get(cell)
+  if bbox is None:
+    bbox = _compute_box(cell)
+    BOX_CACHE.put(cell, bbox)
+  return bbox
 
-  while len(cell) > 0:
-    subcell_lon_span = (bbox.east - bbox.west) / _GEOCELL_GRID_SIZE
-    subcell_lat_span = (bbox.north - bbox.south) / _GEOCELL_GRID_SIZE
 
-    x, y = _subdiv_xy(cell[0])
+def _compute_box(cell):
+  """Walks the 16-tree to compute the (uncached) bounding box of a geocell."""
+  north = 90.0
+  east = 180.0
+  south = -90.0
+  west = -180.0
 
-    bbox = geotypes.Box(bbox.south + subcell_lat_span * (y + 1),
-                        bbox.west  + subcell_lon_span * (x + 1),
-                        bbox.south + subcell_lat_span * y,
-                        bbox.west  + subcell_lon_span * x)
+  for char in cell:
+    subcell_lon_span = (east - west) / _GEOCELL_GRID_SIZE
+    subcell_lat_span = (north - south) / _GEOCELL_GRID_SIZE
 
-    cell = cell[1:]
+    x, y = _subdiv_xy(char)
 
-  return bbox
+    north = south + subcell_lat_span * (y + 1)
+    east  = west  + subcell_lon_span * (x + 1)
+    south = south + subcell_lat_span * y
+    west  = west  + subcell_lon_span * x
+
+  return geotypes.Box(north, east, south, west)
 
 
 def is_valid(cell):
@@ -449,6 +563,10 @@ def children(cell):
   return [cell + chr for chr in _GEOCELL_ALPHABET]
 
 
+# Process-wide cache of geocell string -> geotypes.Box.
+BOX_CACHE = lru.LRUCache(BOX_CACHE_SIZE)
+
+
 def _subdiv_xy(char):
   """Returns the (x, y) of the geocell character in the 4x4 alphabet grid."""
   # NOTE: This only works for grid size 4.
@@ -44,6 +44,26 @@ class GeocellTests(unittest.TestCase):
     self.assertEqual(0, len(cell))
     self.assertFalse(geocell.is_valid(cell))
 
+  def test_compute_many(self):
+    points = [geotypes.Point(37, -122), geotypes.Point(-33.86, 151.2),
+              geotypes.Point(0, 0), geotypes.Point(90, 180),
+              geotypes.Point(-90, -180), geotypes.Point(45, 90)]
+
+    # batch cells should match the ones computed one point at a time, using
+    # both the vectorized and the pure-Python implementations
+    saved_numpy = geocell.numpy
+    try:
+      for numpy in set([saved_numpy, None]):
+        geocell.numpy = numpy
+        for resolution in [1, 8, 13, 14]:
+          self.assertEquals([geocell.compute(p, resolution) for p in points],
+                            geocell.compute_many(points, resolution))
+    finally:
+      geocell.numpy = saved_numpy
+
+    self.assertEquals([], geocell.compute_many([]))
+    self.assertEquals([''], geocell.compute_many([geotypes.Point(0, 0)], 0))
+
   def test_compute_box(self):
     cell = geocell.compute(geotypes.Point(37, -122), 14)
     box = geocell.compute_box(cell)
@@ -22,6 +22,11 @@ import math
 
 import geotypes
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 RADIUS = 6378135
 
 
@@ -37,5 +42,181 @@ def distance(p1, p2):
   """
   p1lat, p1lon = math.radians(p1.lat), math.radians(p1.lon)
   p2lat, p2lon = math.radians(p2.lat), math.radians(p2.lon)
-  return RADIUS * math.acos(math.sin(p1lat) * math.sin(p2lat) +
-      math.cos(p1lat) * math.cos(p2lat) * math.cos(p2lon - p1lon))
+  # Rounding can push the cosine of tiny angles just past 1.
+  return RADIUS * math.acos(min(1.0, math.sin(p1lat) * math.sin(p2lat) +
+      math.cos(p1lat) * math.cos(p2lat) * math.cos(p2lon - p1lon)))
+
+
+def distances(center, points, max_distance=None, haversine=True):
+  """Calculates the great circle distances from a center to many points.
+
+  The distances are computed for the whole batch at once using NumPy arrays
+  when NumPy is available, or one point at a time otherwise.
+
+  If a max_distance is given, points are first run through a cheap
+  equirectangular pre-filter: no path of length max_distance from the center
+  can leave the band of latitudes within max_distance of it, so the flat
+  distance with longitudes scaled by the cosine of the band's highest
+  latitude is a lower bound of the true distance. Points whose lower bound
+  exceeds max_distance are rejected without computing their exact distance.
+
+  Args:
+    center: A geotypes.Point or db.GeoPt indicating the center point.
+    points: A sequence of geotypes.Point or db.GeoPt objects.
+    max_distance: An optional maximum distance, in meters.
+    haversine: Whether to use the haversine formula, which is numerically
+        stable for short distances, rather than the law of cosines.
+
+  Returns:
+    A list of distances from the center to each of the given points, in
+    meters, with None in place of each point rejected by the pre-filter.
+  """
+  if not points:
+    return []
+  if numpy is not None:
+    return _distances_numpy(center, points, max_distance, haversine)
+
+  lat1 = math.radians(center.lat)
+  lon1 = math.radians(center.lon)
+  cos_lat1 = math.cos(lat1)
+  sin_lat1 = math.sin(lat1)
+  if max_distance is not None:
+    band_cos = _band_cos(center, max_distance)
+    max_angle_sq = (float(max_distance) / RADIUS) ** 2
+
+  results = []
+  for point in points:
+    lat2 = math.radians(point.lat)
+    dlat = lat2 - lat1
+    dlon = math.radians(point.lon) - lon1
+
+    if max_distance is not None:
+      dlon_wrapped = abs(dlon) % (2 * math.pi)
+      dlon_wrapped = min(dlon_wrapped, 2 * math.pi - dlon_wrapped)
+      if dlat * dlat + (band_cos * dlon_wrapped) ** 2 > max_angle_sq:
+        results.append(None)
+        continue
+
+    if haversine:
+      a = (math.sin(dlat / 2) ** 2 +
+           cos_lat1 * math.cos(lat2) * math.sin(dlon / 2) ** 2)
+      angle = 2 * math.asin(math.sqrt(min(1.0, a)))
+    else:
+      angle = math.acos(min(1.0, sin_lat1 * math.sin(lat2) +
+                                 cos_lat1 * math.cos(lat2) * math.cos(dlon)))
+    results.append(RADIUS * angle)
+
+  return results
+
+
+def _distances_numpy(center, points, max_distance, haversine):
+  """Vectorized implementation of distances using NumPy arrays."""
+  lat1 = math.radians(center.lat)
+  lon1 = math.radians(center.lon)
+  lat2 = numpy.radians(numpy.array([point.lat for point in points],
+                                   dtype=numpy.float64))
+  dlon = numpy.radians(numpy.array([point.lon for point in points],
+                                   dtype=numpy.float64)) - lon1
+  dlat = lat2 - lat1
+
+  keep = None
+  if max_distance is not None:
+    dlon_wrapped = numpy.abs(dlon) % (2 * math.pi)
+    dlon_wrapped = numpy.minimum(dlon_wrapped, 2 * math.pi - dlon_wrapped)
+    band_cos = _band_cos(center, max_distance)
+    keep = (dlat * dlat + (band_cos * dlon_wrapped) ** 2 <=
+            (float(max_distance) / RADIUS) ** 2)
+    lat2 = lat2[keep]
+    dlat = dlat[keep]
+    dlon = dlon[keep]
+
+  if haversine:
+    a = (numpy.sin(dlat / 2) ** 2 +
+         math.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2) ** 2)
+    angles = 2 * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+  else:
+    angles = numpy.arccos(numpy.minimum(
+        math.sin(lat1) * numpy.sin(lat2) +
+        math.cos(lat1) * numpy.cos(lat2) * numpy.cos(dlon), 1.0))
+  kept_distances = (RADIUS * angles).tolist()
+
+  if keep is None:
+    return kept_distances
+
+  results = [None] * len(points)
+  for i, dist in zip(numpy.flatnonzero(keep).tolist(), kept_distances):
+    results[i] = dist
+  return results
+
+
+def _band_cos(center, max_distance):
+  """Returns the cosine of the highest latitude within max_distance of center.
+  """
+  band_lat = abs(math.radians(center.lat)) + float(max_distance) / RADIUS
+  return math.cos(min(band_lat, math.pi / 2))
+
+
+def radius_box(center, radius):
+  """Calculates the smallest bounding box containing a circle.
+
+  Args:
+    center: A geotypes.Point or db.GeoPt indicating the circle's center.
+    radius: The circle's radius, in meters.
+
+  Returns:
+    A geotypes.Box containing every point within <radius> meters of the
+    center. The box spans all longitudes if the circle reaches a pole, and its
+    east longitude is west of its west longitude if it crosses the
+    antimeridian.
+  """
+  angular_radius = float(radius) / RADIUS
+  dlat = math.degrees(angular_radius)
+  north = center.lat + dlat
+  south = center.lat - dlat
+
+  if (north >= 90 or south <= -90 or
+      math.sin(angular_radius) >= math.cos(math.radians(center.lat))):
+    return geotypes.Box(min(north, 90.0), 180.0, max(south, -90.0), -180.0)
+
+  dlon = math.degrees(math.asin(math.sin(angular_radius) /
+                                math.cos(math.radians(center.lat))))
+  if dlon >= 180:
+    return geotypes.Box(north, 180.0, south, -180.0)
+
+  return geotypes.Box(north, _wrap_lon(center.lon + dlon),
+                      south, _wrap_lon(center.lon - dlon))
+
+
+def meridian_distance(point, lon, south=-90.0, north=90.0):
+  """Calculates the distance from a point to a segment of a meridian.
+
+  Args:
+    point: A geotypes.Point or db.GeoPt.
+    lon: The longitude of the meridian.
+    south: The latitude of the southern end of the segment.
+    north: The latitude of the northern end of the segment.
+
+  Returns:
+    The great circle distance from the point to the nearest point of the
+    meridian segment, in meters.
+  """
+  cos_dlon = math.cos(math.radians(lon - point.lon))
+  if cos_dlon <= 0:
+    # The nearest point of the meridian is past a pole, so the nearest point
+    # of the segment is one of its ends.
+    return min(distance(point, geotypes.Point(south, lon)),
+               distance(point, geotypes.Point(north, lon)))
+
+  # Latitude of the foot of the great circle through the point perpendicular
+  # to the meridian.
+  lat = math.degrees(math.atan(math.tan(math.radians(point.lat)) / cos_dlon))
+  return distance(point, geotypes.Point(min(max(lat, south), north), lon))
+
+
+def _wrap_lon(lon):
+  """Wraps the given longitude into the [-180,180] range."""
+  if lon > 180:
+    return lon - 360
+  if lon < -180:
+    return lon + 360
+  return lon
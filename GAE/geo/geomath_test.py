@@ -34,6 +34,62 @@ class GeomathTests(unittest.TestCase):
     # make sure the calculated distance is within +/- 1% of known distance
     self.assertTrue(abs((calc_dist - known_dist) / known_dist) <= 0.01)
 
+  def test_distances(self):
+    center = geotypes.Point(37, -122)
+    points = [geotypes.Point(42, -75), geotypes.Point(37, -122),
+              geotypes.Point(37.001, -122.001), geotypes.Point(-37, 58)]
+
+    saved_numpy = geomath.numpy
+    try:
+      for numpy in set([saved_numpy, None]):
+        geomath.numpy = numpy
+        for haversine in [True, False]:
+          calc_dists = geomath.distances(center, points, haversine=haversine)
+          for point, calc_dist in zip(points, calc_dists):
+            self.assertAlmostEquals(geomath.distance(center, point),
+                                    calc_dist, 0)
+
+        # the pre-filter rejects far away points, but not near ones
+        calc_dists = geomath.distances(center, points, max_distance=1000)
+        self.assertEquals([None, 0, calc_dists[2], None], calc_dists)
+        self.assertTrue(0 < calc_dists[2] < 1000)
+    finally:
+      geomath.numpy = saved_numpy
+
+    self.assertEquals([], geomath.distances(center, []))
+
+  def test_radius_box(self):
+    center = geotypes.Point(37, -122)
+    box = geomath.radius_box(center, 10000)
+
+    # the box edges are at least the radius away from the center
+    for edge in [geotypes.Point(box.north, center.lon),
+                 geotypes.Point(box.south, center.lon),
+                 geotypes.Point(center.lat, box.east),
+                 geotypes.Point(center.lat, box.west)]:
+      self.assertTrue(geomath.distance(center, edge) >= 10000 - 1)
+
+    # boxes wrap around the antimeridian...
+    box = geomath.radius_box(geotypes.Point(0, 179.9), 50000)
+    self.assertTrue(box.east < 0 < box.west)
+
+    # ...and span all longitudes near the poles
+    box = geomath.radius_box(geotypes.Point(89.9, 0), 50000)
+    self.assertEquals((90, 180, -180), (box.north, box.east, box.west))
+
+  def test_meridian_distance(self):
+    point = geotypes.Point(10, 0)
+    self.assertAlmostEquals(geomath.distance(point, geotypes.Point(10, 0)),
+                            geomath.meridian_distance(point, 0), 3)
+
+    # near a pole the nearest point of a meridian is closer to the pole
+    point = geotypes.Point(89, 0)
+    self.assertTrue(geomath.meridian_distance(point, 90) <
+                    geomath.distance(point, geotypes.Point(89, 90)))
+    self.assertAlmostEquals(
+        geomath.distance(point, geotypes.Point(90, 0)),
+        geomath.meridian_distance(point, 180), 3)
+
 
 if __name__ == '__main__':
   unittest.main()
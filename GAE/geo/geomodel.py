@@ -22,26 +22,206 @@ TODO(romannurik): document how bounding box and proximity queries work.
 
 __author__ = 'api.roman.public@gmail.com (Roman Nurik)'
 
+import base64
 import copy
 import logging
 import math
+import os.path
 import sys
+import time
 
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
 import geocell
 import geomath
 import geotypes
+import intcell
+import lru
+import planner
+import region
 import util
 
 DEBUG = False
 
+# Proximity search strategies; see GeoModel.proximity_fetch().
+GREEDY_SEARCH = 'greedy'
+PLANNED_SEARCH = 'planned'
+
 
 def default_cost_function(num_cells, resolution):
   """The default cost function, used if none is provided by the developer."""
   return 1e10000 if num_cells > pow(geocell._GEOCELL_GRID_SIZE, 2) else 0
 
 
+# The highest geocell resolution for which per-cell entity counts are
+# maintained for models that track density.
+DENSITY_MAX_RESOLUTION = 8
+
+# The number of seconds geocell counts are cached in-process before they are
+# read from the datastore again.
+DENSITY_CACHE_SECONDS = 600
+
+# The cost of querying one more geocell in a density-aware search, relative
+# to the cost of scanning one entity.
+DENSITY_CELL_COST = 20
+
+# The maximum number of geocells a density-aware search will query at once;
+# this is the datastore's limit on the values of an IN filter.
+MAX_QUERY_CELLS = 30
+
+
+# The number of entities a bounding box scan fetches per datastore RPC.
+BBOX_SCAN_BATCH_SIZE = 100
+
+# The number of entities or keys a planned proximity search fetches per
+# datastore query. A query that returns this many may have more to return;
+# see _fetch_cells().
+PROXIMITY_PAGE_SIZE = 1000
+
+
+def _box_contains(bbox, point):
+  """Returns whether a point is inside a bounding box.
+
+  The box crosses the antimeridian if its east longitude is west of its west
+  longitude.
+  """
+  if point.lat < bbox.south or point.lat > bbox.north:
+    return False
+  if bbox.west <= bbox.east:
+    return point.lon >= bbox.west and point.lon <= bbox.east
+  return point.lon >= bbox.west or point.lon <= bbox.east
+
+
+# A storage mode for GeoModel.geocell_resolutions that indexes every other
+# resolution, roughly halving the size of the location_geocells index.
+COMPACT_GEOCELL_RESOLUTIONS = (1, 3, 5, 7, 9, 11, 13)
+
+
+def _geocell_prefixes(max_res_geocell, resolutions=None):
+  """Returns the geocells containing a point, from resolution 1 upwards.
+
+  If resolutions is given, only the geocells of those resolutions are
+  returned.
+  """
+  if resolutions is None:
+    resolutions = range(1, geocell.MAX_GEOCELL_RESOLUTION + 1)
+  return [max_res_geocell[:res] for res in resolutions]
+
+
+def _density_cells(geocells):
+  """Returns the geocells whose counts include an entity with the given
+  location_geocells, whichever resolutions they are stored at.
+  """
+  if not geocells:
+    return []
+  longest = max(geocells, key=len)
+  return [longest[:res] for res in
+          range(1, min(len(longest), DENSITY_MAX_RESOLUTION) + 1)]
+
+
+def _geocell_count_deltas(entities):
+  """Returns the changes to the geocell counts for entities whose geocells
+  changed since they were last counted, as a dictionary of geocell -> delta,
+  and marks the entities as counted.
+  """
+  deltas = {}
+  for entity in entities:
+    old_cells = getattr(entity, '_counted_geocells', None)
+    if old_cells is None:
+      continue  # Geocells haven't changed since they were last counted.
+    for cell in _density_cells(old_cells):
+      deltas[cell] = deltas.get(cell, 0) - 1
+    for cell in _density_cells(entity.location_geocells):
+      deltas[cell] = deltas.get(cell, 0) + 1
+    del entity._counted_geocells
+
+  return dict([(cell, delta) for cell, delta in deltas.items() if delta])
+
+
+def _apply_geocell_count_deltas(deltas):
+  """Task that adds deltas to geocell counts, with one batch get and one
+  batch put.
+
+  Args:
+    deltas: A dictionary of GeocellCount key name -> delta.
+  """
+  key_names = deltas.keys()
+  counts = GeocellCount.get_by_key_name(key_names)
+  now = time.time()
+  for i in range(len(key_names)):
+    if counts[i] is None:
+      counts[i] = GeocellCount(key_name=key_names[i])
+    counts[i].count = max(0, counts[i].count + deltas[key_names[i]])
+    _COUNT_CACHE.put(key_names[i], (counts[i].count, now))
+  db.put(counts)
+
+
+def _query_copy(query, keys_only=False):
+  """Returns a copy of a db.Query that can be filtered further, optionally
+  returning only the keys of the matching entities.
+  """
+  query = copy.deepcopy(query)
+  if keys_only:
+    query._keys_only = True
+  return query
+
+
+def _fetch_cells(query, int_cells, keys_only=False):
+  """Fetches every entity, or key, matching a query in the given geocells.
+
+  Cells are queried MAX_QUERY_CELLS at a time with an IN filter. IN queries
+  can't be continued from a cursor, so the cells of a query that returns a
+  full page are fetched again one at a time, paging with cursors.
+  """
+  results = []
+  cells = [intcell.to_string(cell) for cell in int_cells]
+  for i in range(0, len(cells), MAX_QUERY_CELLS):
+    temp_query = _query_copy(query, keys_only)
+    temp_query.filter('location_geocells IN', cells[i:i + MAX_QUERY_CELLS])
+    page = temp_query.fetch(PROXIMITY_PAGE_SIZE)
+    if len(page) < PROXIMITY_PAGE_SIZE:
+      results.extend(page)
+      continue
+
+    for cell in cells[i:i + MAX_QUERY_CELLS]:
+      cursor = None
+      while True:
+        temp_query = _query_copy(query, keys_only)
+        temp_query.filter('location_geocells =', cell)
+        if cursor:
+          temp_query.with_cursor(cursor)
+        page = temp_query.fetch(PROXIMITY_PAGE_SIZE)
+        results.extend(page)
+        if len(page) < PROXIMITY_PAGE_SIZE:
+          break
+        cursor = temp_query.cursor()
+  return results
+
+
+def _cell_area(resolution):
+  """Returns the area of a geocell at the resolution, in square degrees."""
+  grid_size = geocell._GEOCELL_GRID_SIZE ** resolution
+  return (360.0 / grid_size) * (180.0 / grid_size)
+
+
+class GeocellCount(db.Model):
+  """The number of entities of a kind located in a geocell.
+
+  Counts are maintained for models that track density, for geocells of up to
+  DENSITY_MAX_RESOLUTION. GeoModel.put(), delete() and put_all() don't write
+  them; they defer one task per call that applies the changes to every
+  affected count with one batch get and one batch put. The counts are
+  updated without transactions, after the entities, so they are estimates
+  rather than exact counts. The key name is '<kind>:<geocell>'.
+  """
+  count = db.IntegerProperty(default=0)
+
+
+# Process-wide cache of GeocellCount key name -> (count, time read).
+_COUNT_CACHE = lru.LRUCache(10000)
+
+
 class GeoModel(db.Model):
   """A base model class for single-point geographically located entities.
 
@@ -52,6 +232,17 @@ class GeoModel(db.Model):
   location = db.GeoPtProperty()
   location_geocells = db.StringListProperty()
 
+  # Whether to maintain GeocellCount entities for this kind; see
+  # density_cost_function() and estimate_count().
+  track_density = False
+
+  # The sorted geocell resolutions stored in location_geocells, or None to
+  # store all of them. Searches only query cells of the stored resolutions.
+  # Entities stored with more resolutions still match, so the resolutions
+  # can be reduced at any time and existing entities rewritten afterwards
+  # with rewrite_geocells().
+  geocell_resolutions = None
+
   def update_location(self):
     """Syncs underlying geocell properties with the entity's location.
 
@@ -59,15 +250,238 @@ class GeoModel(db.Model):
     entity's location property. A put() must occur after this call to save
     the changes to App Engine."""
     if self.location:
-      max_res_geocell = geocell.compute(self.location)
-      self.location_geocells = [max_res_geocell[:res]
-                                for res in
-                                range(1, geocell.MAX_GEOCELL_RESOLUTION + 1)]
+      self._set_geocells(_geocell_prefixes(geocell.compute(self.location),
+                                           self.geocell_resolutions))
     else:
-      self.location_geocells = []
+      self._set_geocells([])
+
+  def _set_geocells(self, geocells):
+    """Sets location_geocells, remembering the cells last counted."""
+    if not hasattr(self, '_counted_geocells'):
+      self._counted_geocells = list(self.location_geocells or [])
+    self.location_geocells = geocells
+
+  def put(self, **kwargs):
+    """Writes the entity, and defers the update of the geocell counts if
+    density is tracked.
+    """
+    key = super(GeoModel, self).put(**kwargs)
+    if self.track_density:
+      type(self)._update_geocell_counts([self])
+    return key
+
+  def delete(self, **kwargs):
+    """Deletes the entity, and defers the update of the geocell counts if
+    density is tracked.
+    """
+    super(GeoModel, self).delete(**kwargs)
+    if self.track_density:
+      self._set_geocells([])
+      type(self)._update_geocell_counts([self])
+
+  @classmethod
+  def put_all(cls, entities):
+    """Writes a batch of entities in a single db.put() call.
+
+    Unlike calling db.put() directly, this updates the geocell counts of
+    models that track density, with one deferred task for all of the
+    entities.
+    """
+    keys = db.put(entities)
+    if cls.track_density:
+      cls._update_geocell_counts(entities)
+    return keys
+
+  @classmethod
+  def count_geocells(cls, entities):
+    """Adds already stored entities to the geocell counts.
+
+    Use this to backfill the counts of entities written before density
+    tracking was enabled for their kind.
+    """
+    for entity in entities:
+      entity._counted_geocells = []
+    cls._update_geocell_counts(entities)
+
+  @classmethod
+  def _update_geocell_counts(cls, entities):
+    """Defers a task applying the changes in the entities' geocells to the
+    geocell counts.
+    """
+    deltas = _geocell_count_deltas(entities)
+    if deltas:
+      deferred.defer(_apply_geocell_count_deltas,
+                     dict([(cls._count_key_name(cell), delta)
+                           for cell, delta in deltas.items()]))
+
+  @classmethod
+  def _count_key_name(cls, cell):
+    return '%s:%s' % (cls.kind(), cell)
+
+  @classmethod
+  def geocell_counts(cls, cells):
+    """Returns the number of entities of this kind in each of the geocells.
+
+    Counts are read with a single batch get for the cells not already cached
+    in-process, and are only available for cells of up to
+    DENSITY_MAX_RESOLUTION.
+
+    Args:
+      cells: A list of geocell strings.
+
+    Returns:
+      A list of ints, the count for each of the given cells.
+    """
+    now = time.time()
+    key_names = [cls._count_key_name(cell) for cell in cells]
+    counts = [None] * len(cells)
+
+    missing = []
+    for i in range(len(cells)):
+      cached = _COUNT_CACHE.get(key_names[i])
+      if cached is not None and now - cached[1] < DENSITY_CACHE_SECONDS:
+        counts[i] = cached[0]
+      else:
+        missing.append(i)
+
+    if missing:
+      entities = GeocellCount.get_by_key_name([key_names[i] for i in missing])
+      for i, entity in zip(missing, entities):
+        counts[i] = entity and entity.count or 0
+        _COUNT_CACHE.put(key_names[i], (counts[i], now))
+
+    return counts
+
+  @classmethod
+  def estimate_count(cls, int_cells):
+    """Estimates the number of entities of this kind in the integer geocells.
+
+    Cells finer than DENSITY_MAX_RESOLUTION are assumed to hold an even share
+    of the count of their ancestor at that resolution. Suitable as the
+    estimate_function of proximity_fetch().
+    """
+    if not int_cells:
+      return 0
+
+    ancestors = []
+    shares = []
+    for int_cell in int_cells:
+      res = intcell.resolution(int_cell)
+      if res > DENSITY_MAX_RESOLUTION:
+        ancestors.append(intcell.ancestor(int_cell, DENSITY_MAX_RESOLUTION))
+        shares.append(_cell_area(res) / _cell_area(DENSITY_MAX_RESOLUTION))
+      else:
+        ancestors.append(int_cell)
+        shares.append(1.0)
+
+    counts = cls.geocell_counts([intcell.to_string(cell)
+                                 for cell in ancestors])
+    return sum([count * share for count, share in zip(counts, shares)])
+
+  @classmethod
+  def density_cost_function(cls, bbox):
+    """Returns a density-aware cost function for searching the given box.
+
+    The returned function estimates the cost of a search as the number of
+    cells queried, weighted by DENSITY_CELL_COST, plus the number of entities
+    those cells are expected to hold. The entity density is read from the
+    count of the smallest counted geocell containing the whole box, so dense
+    areas are searched at fine resolutions and sparse areas at coarse ones.
+    Until any entities of this kind have been counted, default_cost_function
+    is returned instead.
+
+    Args:
+      bbox: A geotypes.Box indicating the region that will be searched.
+
+    Returns:
+      A function suitable as the cost_function of bounding_box_fetch() and
+      proximity_fetch().
+    """
+    total_count = sum(cls.geocell_counts(geocell.children('')))
+    if not total_count:
+      return default_cost_function
+
+    cell_ne = geocell.compute(bbox.north_east, DENSITY_MAX_RESOLUTION)
+    cell_sw = geocell.compute(bbox.south_west, DENSITY_MAX_RESOLUTION)
+    region_cell = os.path.commonprefix([cell_ne, cell_sw])
+
+    if region_cell:
+      density = (cls.geocell_counts([region_cell])[0] /
+                 _cell_area(len(region_cell)))
+    else:
+      density = total_count / _cell_area(0)
+
+    def cost_function(num_cells, resolution):
+      if num_cells > MAX_QUERY_CELLS:
+        return 1e10000
+      return num_cells * (DENSITY_CELL_COST + _cell_area(resolution) * density)
+    return cost_function
+
+  @classmethod
+  def update_locations(cls, entities):
+    """Syncs underlying geocell properties for a batch of entities.
+
+    Equivalent to calling update_location() on each of the given entities, but
+    computes the geocells for all located entities in a single
+    geocell.compute_many() call. A put() must occur after this call to save
+    the changes to App Engine.
+
+    Args:
+      entities: A sequence of GeoModel entities to update.
+
+    Returns:
+      The given entities.
+    """
+    located = [entity for entity in entities if entity.location]
+    max_res_geocells = geocell.compute_many(
+        [entity.location for entity in located])
 
-  @staticmethod
-  def bounding_box_fetch(query, bbox, max_results=1000,
+    for entity, max_res_geocell in zip(located, max_res_geocells):
+      entity._set_geocells(_geocell_prefixes(max_res_geocell,
+                                             cls.geocell_resolutions))
+
+    for entity in entities:
+      if not entity.location:
+        entity._set_geocells([])
+
+    return entities
+
+  @classmethod
+  def rewrite_geocells(cls, cursor=None, batch_size=100):
+    """Rewrites the stored geocells of a batch of entities of this kind.
+
+    Brings the location_geocells of existing entities in line with
+    geocell_resolutions, e.g. after switching the model to
+    COMPACT_GEOCELL_RESOLUTIONS. Only entities whose geocells change are
+    written. Call repeatedly with the returned cursor to rewrite every
+    entity.
+
+    Args:
+      cursor: The cursor returned by the previous call, if any.
+      batch_size: The number of entities to read.
+
+    Returns:
+      A (num_rewritten, cursor) tuple, where cursor is None once every
+      entity has been visited.
+    """
+    query = cls.all()
+    if cursor:
+      query.with_cursor(cursor)
+    entities = query.fetch(batch_size)
+
+    old_geocells = [list(entity.location_geocells) for entity in entities]
+    cls.update_locations(entities)
+    changed = [entity for entity, geocells in zip(entities, old_geocells)
+               if entity.location_geocells != geocells]
+    if changed:
+      cls.put_all(changed)
+
+    if len(entities) < batch_size:
+      return len(changed), None
+    return len(changed), query.cursor()
+
+  @classmethod
+  def bounding_box_fetch(cls, query, bbox, max_results=1000,
                          cost_function=None):
     """Performs a bounding box fetch on the given query.
 
@@ -98,16 +512,15 @@ class GeoModel(db.Model):
 
     if cost_function is None:
       cost_function = default_cost_function
-    query_geocells = geocell.best_bbox_search_cells(bbox, cost_function)
+    query_geocells = [intcell.to_string(cell) for cell in
+                      intcell.best_bbox_search_cells(
+                          bbox, cost_function, cls.geocell_resolutions) or []]
 
     if query_geocells:
       for entity in query.filter('location_geocells IN', query_geocells):
         if len(results) == max_results:
           break
-        if (entity.location.lat >= bbox.south and
-            entity.location.lat <= bbox.north and
-            entity.location.lon >= bbox.west and
-            entity.location.lon <= bbox.east):
+        if _box_contains(bbox, entity.location):
           results.append(entity)
 
     if DEBUG:
@@ -115,18 +528,107 @@ class GeoModel(db.Model):
 
     return results
 
-  @staticmethod
-  def proximity_fetch(query, center, max_results=10, max_distance=0):
+  @classmethod
+  def bounding_box_scan(cls, query, bbox, cost_function=None, continuation=None,
+                        batch_size=BBOX_SCAN_BATCH_SIZE):
+    """Streams the entities matching the given query inside a bounding box.
+
+    Unlike bounding_box_fetch(), the scan queries the geocells covering the
+    box one at a time and pages through each one with a datastore cursor, so
+    entities are yielded as they are fetched and an interrupted scan can be
+    resumed from a continuation token later on, e.g. in the next request of
+    a paged map viewport.
+
+    Args:
+      query: A db.Query on entities of this kind that should be additionally
+          filtered by bounding box and subsequently fetched. It must not have
+          an IN or != filter, which datastore cursors don't support.
+      bbox: A geotypes.Box indicating the bounding box to filter entities by.
+      cost_function: An optional cost function; see bounding_box_fetch().
+      continuation: An optional token returned by the continuation() method
+          of an earlier scan of the same query and bounding box, to resume
+          that scan from.
+      batch_size: The number of entities fetched per datastore RPC.
+
+    Returns:
+      A BoundingBoxScan, which is iterated to get the entities and whose
+      continuation() method returns the token to resume the scan from.
+
+    Raises:
+      ValueError: If the continuation token is malformed or was issued for
+          a different bounding box.
+    """
+    return BoundingBoxScan(query, bbox, cost_function=cost_function,
+                           continuation=continuation, batch_size=batch_size,
+                           resolutions=cls.geocell_resolutions)
+
+  @classmethod
+  def polygon_fetch(cls, query, polygon, max_results=1000,
+                    max_cells=MAX_QUERY_CELLS):
+    """Performs a polygon fetch on the given query.
+
+    Fetches entities matching the given query with an additional filter
+    matching only those entities that are inside of the given polygon,
+    outside of its holes. The polygon is covered with geocells of mixed
+    resolutions (see region.cover()) and only entities in the cells on the
+    polygon's boundary are checked against the polygon itself.
+
+    Args:
+      query: A db.Query on entities of this kind that should be additionally
+          filtered by polygon and subsequently fetched.
+      polygon: A region.Polygon or region.MultiPolygon to filter entities by.
+      max_results: An optional int indicating the maximum number of desired
+          results.
+      max_cells: The maximum number of geocells to query.
+
+    Returns:
+      The fetched entities.
+
+    Raises:
+      Any exceptions that google.appengine.ext.db.Query.fetch() can raise.
+    """
+    results = []
+
+    interior_cells, boundary_cells = region.cover(
+        polygon, max_cells=max_cells, resolutions=cls.geocell_resolutions)
+    interior_cells = set([intcell.to_string(cell) for cell in interior_cells])
+    query_geocells = list(interior_cells) + [intcell.to_string(cell)
+                                             for cell in boundary_cells]
+
+    if query_geocells:
+      for entity in query.filter('location_geocells IN', query_geocells):
+        if len(results) == max_results:
+          break
+        if (interior_cells.intersection(entity.location_geocells) or
+            polygon.contains(entity.location)):
+          results.append(entity)
+
+    if DEBUG:
+      logging.info('polygon query looked in %d geocells' % len(query_geocells))
+
+    return results
+
+  @classmethod
+  def proximity_fetch(cls, query, center, max_results=10, max_distance=0,
+                      strategy=None, cost_function=None,
+                      estimate_function=None):
     """Performs a proximity/radius fetch on the given query.
 
     Fetches at most <max_results> entities matching the given query,
     ordered by ascending distance from the given center point, and optionally
     limited by the given maximum distance.
 
-    This method uses a greedy algorithm that starts by searching high-resolution
-    geocells near the center point and gradually looking in lower and lower
-    resolution cells until max_results entities have been found matching the
-    given query and no closer possible entities can be found.
+    Two search strategies are available:
+
+    * GREEDY_SEARCH starts by searching high-resolution geocells near the
+      center point and gradually looks in lower and lower resolution cells
+      until max_results entities have been found matching the given query and
+      no closer possible entities can be found. Each step is a separate fetch.
+
+    * PLANNED_SEARCH (the default when max_distance is given) plans a few
+      concentric rings of geocells covering the max_distance radius upfront
+      (see planner.py) and fetches one ring per query, stopping as soon as
+      max_results entities closer than the last ring's radius have been found.
 
     Args:
       query: A db.Query on entities of this kind.
@@ -136,7 +638,15 @@ class GeoModel(db.Model):
           The default is 10, and the larger this number, the longer the fetch
           will take.
       max_distance: An optional number indicating the maximum distance to
-          search, in meters.
+          search, in meters. Required for PLANNED_SEARCH.
+      strategy: An optional search strategy, either GREEDY_SEARCH or
+          PLANNED_SEARCH.
+      cost_function: An optional function used by PLANNED_SEARCH to choose
+          the resolution of each ring's cells; see bounding_box_fetch().
+      estimate_function: An optional function used by PLANNED_SEARCH that
+          accepts a list of integer geocells and returns the estimated number
+          of entities in them, letting the search skip rings too small to
+          hold max_results entities.
 
     Returns:
       The fetched entities, sorted in ascending order by distance to the search
@@ -145,13 +655,87 @@ class GeoModel(db.Model):
     Raises:
       Any exceptions that google.appengine.ext.db.Query.fetch() can raise.
     """
+    if strategy is None:
+      strategy = max_distance and PLANNED_SEARCH or GREEDY_SEARCH
+
+    if strategy == PLANNED_SEARCH:
+      if not max_distance:
+        raise ValueError('A planned proximity search requires a max_distance')
+      return cls._planned_proximity_fetch(query, center, max_results,
+                                          max_distance, cost_function,
+                                          estimate_function)
+    elif strategy == GREEDY_SEARCH:
+      return cls._greedy_proximity_fetch(query, center, max_results,
+                                         max_distance)
+    raise ValueError('Unknown proximity search strategy %r' % (strategy,))
+
+  @classmethod
+  def _planned_proximity_fetch(cls, query, center, max_results, max_distance,
+                               cost_function, estimate_function):
+    """Performs a proximity fetch over a search planned ring by ring."""
+    results = util.NearestResults(max_results)
+
+    if cost_function is None:
+      cost_function = default_cost_function
+    rings = planner.plan_rings(center, max_distance, max_results,
+                               cost_function, estimate_function,
+                               cls.geocell_resolutions)
+
+    # A ring's cells may contain cells of the inner rings. Only the keys of
+    # the entities in those cells are queried, and only the entities that
+    # weren't fetched by an inner ring are then read.
+    searched_cells = set()
+    fetched_keys = set()
+    for radius, cells in rings:
+      overlapping = [cell for cell in cells
+                     if planner.contains_searched(cell, searched_cells)]
+      entities = _fetch_cells(query, [cell for cell in cells
+                                      if cell not in overlapping])
+      if overlapping:
+        keys = [key for key in _fetch_cells(query, overlapping, keys_only=True)
+                if key not in fetched_keys]
+        for i in range(0, len(keys), PROXIMITY_PAGE_SIZE):
+          entities.extend([entity for entity in
+                           db.get(keys[i:i + PROXIMITY_PAGE_SIZE])
+                           if entity is not None])
+      searched_cells.update(cells)
+      fetched_keys.update([entity.key() for entity in entities])
+
+      dists = geomath.distances(center,
+                                [entity.location for entity in entities],
+                                max_distance=max_distance)
+      for entity, dist in zip(entities, dists):
+        if dist is not None and dist < max_distance:
+          results.add(entity, dist)
+
+      if DEBUG:
+        logging.info('ring fetch complete for %d geocells out to %f' %
+                     (len(cells), radius))
+
+      # Every entity within this ring's radius has now been seen.
+      if results.is_full() and results.farthest_distance() <= radius:
+        break
+
+    return [entity for (entity, dist) in results.sorted_results()]
+
+  @classmethod
+  def _greedy_proximity_fetch(cls, query, center, max_results, max_distance):
+    """Performs a proximity fetch by greedily widening the searched cells."""
     # TODO(romannurik): check for GqlQuery
-    results = []
+    results = util.NearestResults(max_results)
 
+    # Cells are tracked as integer geocells (see intcell.py) and only
+    # converted to strings when building each datastore query.
     searched_cells = set()
 
+    # The stored resolutions, finest first; the search moves from one to the
+    # next whenever it moves to the parents of the searched cells.
+    resolutions = list(cls.geocell_resolutions or
+                       range(1, geocell.MAX_GEOCELL_RESOLUTION + 1))
+    resolutions.reverse()
+
     # The current search geocell containing the lat,lon.
-    cur_containing_geocell = geocell.compute(center)
+    cur_containing_geocell = intcell.compute(center, resolutions.pop(0))
 
     # The currently-being-searched geocells.
     # NOTES:
@@ -163,14 +747,6 @@ class GeoModel(db.Model):
 
     closest_possible_next_result_dist = 0
 
-    # Assumes both a and b are lists of (entity, dist) tuples, *sorted by dist*.
-    # NOTE: This is an in-place merge, and there are guaranteed
-    # no duplicates in the resulting list.
-    def _merge_results_in_place(a, b):
-      util.merge_in_place(a, b,
-                        cmp_fn=lambda x, y: cmp(x[1], y[1]),
-                        dup_fn=lambda x, y: x[0].key() == y[0].key())
-
     sorted_edges = [(0,0)]
     sorted_edge_distances = [0]
 
@@ -179,60 +755,64 @@ class GeoModel(db.Model):
       if max_distance and closest_possible_next_result_dist > max_distance:
         break
 
-      cur_geocells_unique = list(set(cur_geocells).difference(searched_cells))
+      cur_geocells_unique = [
+          intcell.to_string(cell) for cell in
+          set(cur_geocells).difference(searched_cells) if cell is not None]
 
       # Run query on the next set of geocells.
-      cur_resolution = len(cur_geocells[0])
       temp_query = copy.deepcopy(query)  # TODO(romannurik): is this safe?
       temp_query.filter('location_geocells IN', cur_geocells_unique)
 
-      # Update results and sort.
+      # Update results.
       new_results = temp_query.fetch(1000)
       if DEBUG:
         logging.info('fetch complete for %s' % (','.join(cur_geocells_unique),))
 
       searched_cells.update(cur_geocells)
 
-      # Begin storing distance from the search result entity to the
-      # search center along with the search result itself, in a tuple.
-      new_results = [(entity, geomath.distance(center, entity.location))
-                     for entity in new_results]
-      new_results = sorted(new_results, lambda dr1, dr2: cmp(dr1[1], dr2[1]))
-      new_results = new_results[:max_results]
-
-      # Merge new_results into results or the other way around, depending on
-      # which is larger.
-      if len(results) > len(new_results):
-        _merge_results_in_place(results, new_results)
-      else:
-        _merge_results_in_place(new_results, results)
-        results = new_results
-
-      results = results[:max_results]
+      # Offer each new entity, along with its distance to the search center,
+      # to the nearest results; duplicates and entities farther than the
+      # current max_results'th result are rejected, as are entities the
+      # distance pre-filter places outside max_distance.
+      new_distances = geomath.distances(
+          center, [entity.location for entity in new_results],
+          max_distance=max_distance or None)
+      for entity, dist in zip(new_results, new_distances):
+        if dist is not None:
+          results.add(entity, dist)
 
       sorted_edges, sorted_edge_distances = \
-          util.distance_sorted_edges(cur_geocells, center)
+          intcell.distance_sorted_edges(cur_geocells, center)
 
       if len(results) == 0 or len(cur_geocells) == 4:
         # Either no results (in which case we optimize by not looking at
         # adjacents, go straight to the parent) or we've searched 4 adjacent
         # geocells, in which case we should now search the parents of those
         # geocells.
-        cur_containing_geocell = cur_containing_geocell[:-1]
-        cur_geocells = list(set([cell[:-1] for cell in cur_geocells]))
-        if not cur_geocells or not cur_geocells[0]:
-          break  # Done with search, we've searched everywhere.
+        if not resolutions:
+          # These are the coarsest cells there are, but a search radius
+          # reaching over a pole or beyond them covers others of the same
+          # resolution; search those that may hold a nearer result.
+          cls._search_remaining_cells(query, center, results, max_distance,
+                                      searched_cells,
+                                      intcell.resolution(cur_geocells[0]))
+          break
+        parent_res = resolutions.pop(0)
+        cur_containing_geocell = intcell.ancestor(cur_containing_geocell,
+                                                  parent_res)
+        cur_geocells = list(set([intcell.ancestor(cell, parent_res)
+                                 for cell in cur_geocells]))
 
       elif len(cur_geocells) == 1:
-        # Get adjacent in one direction.
-        # TODO(romannurik): Watch for +/- 90 degree latitude edge case geocells.
+        # Get adjacent in one direction. Edges on the poles aren't among the
+        # sorted edges, so there is always a cell in that direction.
         nearest_edge = sorted_edges[0]
-        cur_geocells.append(geocell.adjacent(cur_geocells[0], nearest_edge))
+        cur_geocells.append(intcell.adjacent(cur_geocells[0], nearest_edge))
 
       elif len(cur_geocells) == 2:
         # Get adjacents in perpendicular direction.
-        nearest_edge = util.distance_sorted_edges([cur_containing_geocell],
-                                                   center)[0][0]
+        nearest_edge = intcell.distance_sorted_edges([cur_containing_geocell],
+                                                      center)[0][0]
         if nearest_edge[0] == 0:
           # Was vertical, perpendicular is horizontal.
           perpendicular_nearest_edge = [x for x in sorted_edges if x[0] != 0][0]
@@ -241,7 +821,7 @@ class GeoModel(db.Model):
           perpendicular_nearest_edge = [x for x in sorted_edges if x[0] == 0][0]
 
         cur_geocells.extend(
-            [geocell.adjacent(cell, perpendicular_nearest_edge)
+            [intcell.adjacent(cell, perpendicular_nearest_edge)
              for cell in cur_geocells])
 
       # We don't have enough items yet, keep searching.
@@ -256,8 +836,7 @@ class GeoModel(db.Model):
 
       # If the currently max_results'th closest item is closer than any
       # of the next test geocells, we're done searching.
-      current_farthest_returnable_result_dist = \
-          geomath.distance(center, results[max_results - 1][0].location)
+      current_farthest_returnable_result_dist = results.farthest_distance()
       if (closest_possible_next_result_dist >=
           current_farthest_returnable_result_dist):
         if DEBUG:
@@ -277,5 +856,132 @@ class GeoModel(db.Model):
       logging.info('proximity query looked '
                    'in %d geocells' % len(searched_cells))
 
-    return [entity for (entity, dist) in results[:max_results]
+    return [entity for (entity, dist) in results.sorted_results()
             if not max_distance or dist < max_distance]
+
+
+  @classmethod
+  def _search_remaining_cells(cls, query, center, results, max_distance,
+                              searched_cells, res):
+    """Ends a greedy proximity fetch that has run out of parent cells.
+
+    Fetches the cells of the given resolution that haven't been searched
+    and are nearer to the center than both max_distance and the current
+    max_results'th result.
+    """
+    bound = max_distance or None
+    if results.is_full():
+      bound = results.farthest_distance()
+    cells = [cell for cell in intcell.descendants(0, res)
+             if cell not in searched_cells and
+             (bound is None or planner.min_distance(cell, center) < bound)]
+
+    entities = _fetch_cells(query, cells)
+    dists = geomath.distances(center,
+                              [entity.location for entity in entities],
+                              max_distance=max_distance or None)
+    for entity, dist in zip(entities, dists):
+      if dist is not None:
+        results.add(entity, dist)
+
+    searched_cells.update(cells)
+    if DEBUG:
+      logging.info('fetch complete for %d remaining geocells' % len(cells))
+
+
+class BoundingBoxScan(object):
+  """A resumable scan of the entities inside a bounding box.
+
+  Iterating the scan yields the matching entities cell by cell. The scan
+  remembers which geocell it is in, the cursor the current batch of that cell
+  was fetched from and how many entities of the batch have been consumed, so
+  continuation() can describe the exact position after the last entity
+  yielded, however far into a batch iteration stopped. Don't iterate a scan
+  more than once; create a new one from its continuation instead.
+  """
+
+  def __init__(self, query, bbox, cost_function=None, continuation=None,
+               batch_size=BBOX_SCAN_BATCH_SIZE, resolutions=None):
+    self._query = query
+    self._bbox = bbox
+    self._batch_size = batch_size
+
+    if continuation:
+      (self._cells, self._cell_index,
+       self._offset, self._cursor) = self._decode(continuation)
+    else:
+      if cost_function is None:
+        cost_function = default_cost_function
+      self._cells = [intcell.to_string(cell) for cell in
+                     intcell.best_bbox_search_cells(bbox, cost_function,
+                                                    resolutions) or []]
+      self._cell_index = 0
+      self._offset = 0
+      self._cursor = None
+
+  def __iter__(self):
+    while self._cell_index < len(self._cells):
+      cell_query = copy.deepcopy(self._query)
+      cell_query.filter('location_geocells =', self._cells[self._cell_index])
+      if self._cursor:
+        cell_query.with_cursor(self._cursor)
+      batch = cell_query.fetch(self._batch_size)
+
+      for i in range(self._offset, len(batch)):
+        # Count the entity as consumed before yielding it, in case the caller
+        # stops iterating here.
+        self._offset = i + 1
+        if _box_contains(self._bbox, batch[i].location):
+          yield batch[i]
+
+      if len(batch) < self._batch_size:
+        self._cell_index += 1
+        self._cursor = None
+      else:
+        self._cursor = cell_query.cursor()
+      self._offset = 0
+
+      if DEBUG:
+        logging.info('bbox scan fetched %d entities' % len(batch))
+
+  def is_done(self):
+    """Returns whether every geocell of the scan has been exhausted."""
+    return self._cell_index >= len(self._cells)
+
+  def continuation(self):
+    """Returns an opaque token to resume the scan from, or None if done.
+
+    The token encodes the bounding box, the geocells covering it and the
+    position reached in them, and is safe to use in URLs.
+    """
+    if self.is_done():
+      return None
+    return base64.urlsafe_b64encode('|'.join([
+        self._bbox_key(),
+        ','.join(self._cells),
+        str(self._cell_index),
+        str(self._offset),
+        self._cursor or '']))
+
+  def _bbox_key(self):
+    return ','.join([repr(float(coord)) for coord in
+                     (self._bbox.north, self._bbox.east,
+                      self._bbox.south, self._bbox.west)])
+
+  def _decode(self, continuation):
+    """Decodes a continuation token into (cells, index, offset, cursor)."""
+    try:
+      (bbox_key, cells, cell_index, offset,
+       cursor) = base64.urlsafe_b64decode(str(continuation)).split('|')
+      cells = cells.split(',')
+      cell_index = int(cell_index)
+      offset = int(offset)
+    except (TypeError, ValueError):
+      raise ValueError('Malformed bounding box continuation token.')
+
+    if bbox_key != self._bbox_key():
+      raise ValueError('Continuation token is for a different bounding box.')
+    if not 0 <= cell_index < len(cells) or offset < 0:
+      raise ValueError('Malformed bounding box continuation token.')
+
+    return cells, cell_index, offset, cursor or None
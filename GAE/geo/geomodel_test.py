@@ -0,0 +1,214 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for geomodel.py. Requires the App Engine SDK on the path."""
+
+import math
+import random
+import unittest
+
+import geocell
+import geomath
+import geomodel
+import geotypes
+import intcell
+
+
+def _offset(point, bearing, meters):
+  """Returns the point roughly <meters> away from a point in a direction."""
+  dlat = meters * math.cos(math.radians(bearing)) / 111320.0
+  dlon = meters * math.sin(math.radians(bearing)) / (
+      111320.0 * math.cos(math.radians(point.lat)))
+  return geotypes.Point(point.lat + dlat, point.lon + dlon)
+
+
+class _Entity(object):
+  """A stand-in for a stored GeoModel entity."""
+  def __init__(self, key, location, resolutions):
+    self._key = key
+    self.location = location
+    self.location_geocells = geomodel._geocell_prefixes(
+        geocell.compute(location), resolutions)
+
+  def key(self):
+    return self._key
+
+
+class _Query(object):
+  """An in-memory stand-in for a db.Query filtered by location_geocells.
+
+  Counts the entities it reads in reads, a dictionary of entity key -> count
+  shared by its copies.
+  """
+  def __init__(self, entities, reads=None):
+    self.entities = entities
+    self.reads = reads
+    if reads is None:
+      self.reads = {}
+    self.cells = None
+    self.offset = 0
+    self._keys_only = False
+
+  def __deepcopy__(self, memo):
+    return _Query(self.entities, self.reads)
+
+  def filter(self, property_operator, value):
+    if property_operator.endswith('IN'):
+      self.cells = set(value)
+    else:
+      self.cells = set([value])
+    return self
+
+  def with_cursor(self, cursor):
+    self.offset = cursor
+
+  def cursor(self):
+    return self.offset
+
+  def fetch(self, limit):
+    matches = [entity for entity in self.entities
+               if self.cells.intersection(entity.location_geocells)]
+    page = matches[self.offset:self.offset + limit]
+    self.offset += len(page)
+    if self._keys_only:
+      return [entity.key() for entity in page]
+    for entity in page:
+      self.reads[entity.key()] = self.reads.get(entity.key(), 0) + 1
+    return page
+
+
+class _Model(geomodel.GeoModel):
+  pass
+
+
+class _CompactModel(geomodel.GeoModel):
+  geocell_resolutions = geomodel.COMPACT_GEOCELL_RESOLUTIONS
+
+
+class GeoModelTests(unittest.TestCase):
+  def setUp(self):
+    self.db_get = geomodel.db.get
+    self.page_size = geomodel.PROXIMITY_PAGE_SIZE
+
+  def tearDown(self):
+    geomodel.db.get = self.db_get
+    geomodel.PROXIMITY_PAGE_SIZE = self.page_size
+
+  def stubGet(self, query):
+    """Makes db.get() read the query's entities, counting the reads."""
+    by_key = dict([(entity.key(), entity) for entity in query.entities])
+    def get(keys):
+      for key in keys:
+        query.reads[key] = query.reads.get(key, 0) + 1
+      return [by_key.get(key) for key in keys]
+    geomodel.db.get = get
+
+  def assertNearest(self, model, entities, center, max_results, max_distance,
+                    strategy):
+    query = _Query(entities)
+    self.stubGet(query)
+    results = model.proximity_fetch(query, center,
+                                    max_results=max_results,
+                                    max_distance=max_distance,
+                                    strategy=strategy)
+    dists = sorted([(geomath.distance(center, entity.location), entity.key())
+                    for entity in entities])
+    expected = [key for dist, key in dists
+                if not max_distance or dist < max_distance][:max_results]
+    self.assertEquals(expected, [entity.key() for entity in results])
+    return query
+
+  def test_geocell_count_deltas(self):
+    old = _Entity(1, geotypes.Point(37, -122), None)
+    moved = _Entity(2, geotypes.Point(37.001, -122.001), None)
+    moved._counted_geocells = old.location_geocells
+    added = _Entity(3, geotypes.Point(-33, 151), None)
+    added._counted_geocells = []
+    unchanged = _Entity(4, geotypes.Point(0, 0), None)
+
+    deltas = geomodel._geocell_count_deltas([moved, added, unchanged])
+
+    # a move only changes the counts of the cells it left and entered, all
+    # of a batch's changes are in one dictionary, and the entities are
+    # marked as counted
+    for cell in old.location_geocells[:geomodel.DENSITY_MAX_RESOLUTION]:
+      if cell not in moved.location_geocells:
+        self.assertEquals(-1, deltas[cell])
+    for cell in added.location_geocells[:geomodel.DENSITY_MAX_RESOLUTION]:
+      self.assertEquals(1, deltas[cell])
+    self.assertEquals(0, len([cell for cell in deltas if cell.startswith(
+        unchanged.location_geocells[0])]))
+    self.assertFalse(hasattr(moved, '_counted_geocells'))
+    self.assertEquals({}, geomodel._geocell_count_deltas([moved, added]))
+
+  def test_greedy_proximity_fetch_near_pole(self):
+    # the nearest results lie across the pole, in resolution 1 cells that
+    # aren't adjacent to the center's
+    rand = random.Random(3)
+    for model in (_Model, _CompactModel):
+      entities = [_Entity(i, geotypes.Point(rand.uniform(-90, -86),
+                                            rand.uniform(-180, 180)),
+                          model.geocell_resolutions)
+                  for i in range(40)]
+      for max_distance in (0, 500000):
+        self.assertNearest(model, entities, geotypes.Point(-87.854, -41.181),
+                           10, max_distance, geomodel.GREEDY_SEARCH)
+
+  def test_planned_proximity_fetch_reads_each_entity_once(self):
+    rand = random.Random(5)
+    center = geotypes.Point(37, -122)
+    for model in (_Model, _CompactModel):
+      entities = [_Entity(i, geotypes.Point(37 + rand.uniform(-0.5, 0.5),
+                                            -122 + rand.uniform(-0.5, 0.5)),
+                          model.geocell_resolutions)
+                  for i in range(300)]
+      query = self.assertNearest(model, entities, center, 25, 50000,
+                                 geomodel.PLANNED_SEARCH)
+      self.assertEquals([1], list(set(query.reads.values())))
+
+  def test_fetch_cells_pages_through_full_queries(self):
+    geomodel.PROXIMITY_PAGE_SIZE = 7
+    rand = random.Random(11)
+    cell = intcell.compute(geotypes.Point(37, -122), 5)
+    entities = [_Entity(i, geotypes.Point(37 + rand.uniform(-0.1, 0.1),
+                                          -122 + rand.uniform(-0.1, 0.1)),
+                        None)
+                for i in range(40)]
+    cells = [intcell.compute(entity.location, 7) for entity in entities]
+    cells = list(set(cells))[:5] + [cell]
+    expected = [entity.key() for entity in entities
+                if set([intcell.to_string(c) for c in cells]).intersection(
+                    entity.location_geocells)]
+    self.assertTrue(len(expected) > geomodel.PROXIMITY_PAGE_SIZE)
+
+    keys = geomodel._fetch_cells(_Query(entities), cells, keys_only=True)
+    self.assertEquals(sorted(expected), sorted(set(keys)))
+
+  def test_planned_proximity_fetch_pages_through_dense_rings(self):
+    # every ring query returns more than a page of entities
+    geomodel.PROXIMITY_PAGE_SIZE = 7
+    rand = random.Random(11)
+    center = geotypes.Point(37, -122)
+    for model in (_Model, _CompactModel):
+      entities = [_Entity(i, _offset(center, rand.uniform(0, 360),
+                                     rand.uniform(0, 20000)),
+                          model.geocell_resolutions)
+                  for i in range(200)]
+      self.assertNearest(model, entities, center, 25, 20000,
+                         geomodel.PLANNED_SEARCH)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,392 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines an integer encoding of geocells and methods to operate on them.
+
+Each character of a geocell string is 4 bits: the low and high bit of the
+cell's column (x) interleaved with the low and high bit of its row (y), as
+described in geocell.py. The hexadecimal digits of a geocell string are
+therefore exactly the bits of the cell's x and y grid coordinates
+interleaved together (a Morton code), with x in the even bit positions.
+
+An integer geocell packs that Morton code together with the cell's
+resolution, which is needed to distinguish e.g. '0' from '00':
+
+    int_cell = (int(cell, 16) << 4) | len(cell)
+
+Resolutions of up to MAX_RESOLUTION fit in a 64-bit integer. Integer
+geocells of the same resolution sort in the same order as their string
+counterparts, and the parent, children and neighbors of a cell are found
+with a few bitwise operations instead of rebuilding the string one
+character at a time.
+"""
+
+import geocell
+import geotypes
+import lru
+import util
+
+# The maximum resolution that can be packed into a 64-bit integer.
+MAX_RESOLUTION = 15
+
+# The number of Morton code bits per geocell character.
+_CHAR_BITS = 4
+
+_RESOLUTION_BITS = 4
+_RESOLUTION_MASK = (1 << _RESOLUTION_BITS) - 1
+
+# The maximum number of cell regions whose sorted edges are memoized by
+# distance_sorted_edges, per search point.
+EDGE_CACHE_SIZE = 1000
+
+# Process-wide caches of integer geocell -> geotypes.Box, and of
+# (cells, point) -> distance sorted edges.
+BOX_CACHE = lru.LRUCache(geocell.BOX_CACHE_SIZE)
+EDGE_CACHE = lru.LRUCache(EDGE_CACHE_SIZE)
+
+# Lookup table mapping a byte of interleaved bits to its (x, y) nibbles.
+_COMPACT_BYTE = [(sum([((b >> (2 * i)) & 1) << i for i in range(4)]),
+                  sum([((b >> (2 * i + 1)) & 1) << i for i in range(4)]))
+                 for b in range(256)]
+
+
+def from_string(cell):
+  """Returns the integer geocell for the given geocell string."""
+  if cell is None:
+    return None
+  if len(cell) > MAX_RESOLUTION:
+    raise ValueError('Geocell resolution must be at most %d but was %d' %
+                     (MAX_RESOLUTION, len(cell)))
+  if not cell:
+    return 0
+  return (int(cell, 16) << _RESOLUTION_BITS) | len(cell)
+
+
+def to_string(int_cell):
+  """Returns the geocell string for the given integer geocell."""
+  if int_cell is None:
+    return None
+  res = resolution(int_cell)
+  if not res:
+    return ''
+  return '%0*x' % (res, int_cell >> _RESOLUTION_BITS)
+
+
+def resolution(int_cell):
+  """Returns the resolution of the given integer geocell."""
+  return int(int_cell & _RESOLUTION_MASK)
+
+
+def compute(point, resolution=geocell.MAX_GEOCELL_RESOLUTION):
+  """Computes the integer geocell containing the given point.
+
+  Args:
+    point: The geotypes.Point or db.GeoPt to compute the cell for.
+    resolution: An int indicating the resolution of the cell to compute.
+
+  Returns:
+    The integer geocell containing the given point, at the given resolution.
+  """
+  grid_size = _grid_size(resolution)
+  return _pack(geocell._grid_coord(point.lon, -180.0, 360.0, grid_size),
+               geocell._grid_coord(point.lat, -90.0, 180.0, grid_size),
+               resolution)
+
+
+def compute_box(int_cell):
+  """Computes the rectangular boundaries (bounding box) of the given cell.
+
+  Args:
+    int_cell: The integer geocell whose boundaries are to be computed.
+
+  Returns:
+    A geotypes.Box corresponding to the rectangular boundaries of the geocell.
+    Boxes are memoized in BOX_CACHE and shared between callers, so they must
+    not be modified.
+  """
+  if int_cell is None:
+    return None
+
+  bbox = BOX_CACHE.get(int_cell)
+  if bbox is None:
+    bbox = _compute_box(int_cell)
+    BOX_CACHE.put(int_cell, bbox)
+  return bbox
+
+
+def _compute_box(int_cell):
+  """Computes the (uncached) bounding box of an integer geocell."""
+  x, y = xy(int_cell)
+  grid_size = _grid_size(resolution(int_cell))
+  lon_span = 360.0 / grid_size
+  lat_span = 180.0 / grid_size
+
+  return geotypes.Box(-90.0 + lat_span * (y + 1),
+                      -180.0 + lon_span * (x + 1),
+                      -90.0 + lat_span * y,
+                      -180.0 + lon_span * x)
+
+
+def parent(int_cell):
+  """Returns the immediate parent of the given integer geocell."""
+  res = resolution(int_cell)
+  if not res:
+    return None
+  code = (int_cell >> _RESOLUTION_BITS) >> _CHAR_BITS
+  return (code << _RESOLUTION_BITS) | (res - 1)
+
+
+def children(int_cell):
+  """Returns the 16 immediate children of the given integer geocell."""
+  base = (int_cell >> _RESOLUTION_BITS) << _CHAR_BITS
+  res = resolution(int_cell) + 1
+  return [((base | c) << _RESOLUTION_BITS) | res for c in range(16)]
+
+
+def descendants(int_cell, res):
+  """Returns the descendants of the given cell at the given (higher)
+  resolution, in sorted order.
+  """
+  shift = _CHAR_BITS * (res - resolution(int_cell))
+  base = (int_cell >> _RESOLUTION_BITS) << shift
+  return [((base | c) << _RESOLUTION_BITS) | res for c in range(1 << shift)]
+
+
+def adjacent(int_cell, dir):
+  """Calculates the cell adjacent to the given cell in the given direction.
+
+  Horizontal neighbors wrap around the antimeridian, as with
+  geocell.adjacent().
+
+  Args:
+    int_cell: The integer geocell whose neighbor is being calculated.
+    dir: An (x, y) tuple indicating direction; see geocell.adjacent().
+
+  Returns:
+    The integer geocell adjacent to the given cell in the given direction, or
+    None if there is no such cell.
+  """
+  if int_cell is None:
+    return None
+
+  res = resolution(int_cell)
+  x_mask = _x_mask(res)
+  y_mask = x_mask << 1
+
+  code = int_cell >> _RESOLUTION_BITS
+  x_bits = code & x_mask
+  y_bits = code & y_mask
+
+  # Incrementing or decrementing a dilated integer only needs the carries or
+  # borrows to skip over the bits of the other dimension.
+  if dir[0] == 1:
+    x_bits = ((x_bits | y_mask) + 1) & x_mask
+  elif dir[0] == -1:
+    x_bits = (x_bits - 1) & x_mask
+
+  if dir[1] == 1:
+    if y_bits == y_mask:
+      return None  # At the top edge of the world.
+    y_bits = ((y_bits | x_mask) + 1) & y_mask
+  elif dir[1] == -1:
+    if y_bits == 0:
+      return None  # At the bottom edge of the world.
+    y_bits = (y_bits - 1) & y_mask
+
+  return ((x_bits | y_bits) << _RESOLUTION_BITS) | res
+
+
+def interpolate(cell_ne, cell_sw):
+  """Calculates the grid of cells formed between the two given cells.
+
+  Assumes the Northeast cell is actually Northeast of the Southwest cell,
+  wrapping around the antimeridian if it is West of it.
+
+  Arguments:
+    cell_ne: The Northeast integer geocell.
+    cell_sw: The Southwest integer geocell.
+
+  Returns:
+    A list of integer geocells in the interpolation, row by row from the
+    South, each row from West to East.
+  """
+  res = resolution(cell_sw)
+  ne_x, ne_y = xy(cell_ne)
+  sw_x, sw_y = xy(cell_sw)
+
+  columns = _column_range(sw_x, ne_x, _grid_size(res))
+  return [_pack(x, y, res) for y in range(sw_y, ne_y + 1) for x in columns]
+
+
+def interpolation_count(cell_ne, cell_sw):
+  """Computes the number of cells in the grid formed between two given cells.
+
+  Arguments:
+    cell_ne: The Northeast integer geocell.
+    cell_sw: The Southwest integer geocell.
+
+  Returns:
+    An int, indicating the number of geocells in the interpolation.
+  """
+  ne_x, ne_y = xy(cell_ne)
+  sw_x, sw_y = xy(cell_sw)
+
+  num_cols = (ne_x - sw_x) % _grid_size(resolution(cell_sw)) + 1
+  num_rows = max(ne_y - sw_y + 1, 0)
+  return num_cols * num_rows
+
+
+def best_bbox_search_cells(bbox, cost_function, resolutions=None):
+  """Returns an efficient set of integer geocells to search in a bbox query.
+
+  This is the integer counterpart of geocell.best_bbox_search_cells(); the
+  returned cells all have the same resolution and are sorted.
+
+  Args:
+    bbox: A geotypes.Box indicating the bounding box being searched.
+    cost_function: A function that accepts num_cells and resolution keyword
+        arguments and returns the 'cost' of querying against this number of
+        cells at the given resolution.
+    resolutions: An optional sorted sequence of the only resolutions the
+        returned cells may have, e.g. the resolutions a model stores.
+
+  Returns:
+    A list of integer geocells that contain the given box.
+  """
+  max_res = geocell.MAX_GEOCELL_RESOLUTION
+  cell_ne = compute(bbox.north_east, max_res)
+  cell_sw = compute(bbox.south_west, max_res)
+
+  # The length of the common prefix of the two cell strings is the number of
+  # leading hex digits that their Morton codes share.
+  diff = (cell_ne ^ cell_sw) >> _RESOLUTION_BITS
+  min_resolution = max_res
+  while diff:
+    diff >>= _CHAR_BITS
+    min_resolution -= 1
+
+  if resolutions is None:
+    search_resolutions = range(min_resolution, max_res + 1)
+  else:
+    # A single cell of the finest resolution coarser than min_resolution
+    # contains the whole box.
+    coarser = [res for res in resolutions if res <= min_resolution]
+    search_resolutions = coarser[-1:] + [res for res in resolutions
+                                         if res > min_resolution]
+
+  min_cost = 1e10000
+  min_cost_cell_set = None
+
+  for cur_resolution in search_resolutions:
+    cur_ne = ancestor(cell_ne, cur_resolution)
+    cur_sw = ancestor(cell_sw, cur_resolution)
+
+    num_cells = interpolation_count(cur_ne, cur_sw)
+    if num_cells > geocell.MAX_FEASIBLE_BBOX_SEARCH_CELLS:
+      continue
+
+    cell_set = sorted(interpolate(cur_ne, cur_sw))
+
+    cost = cost_function(num_cells=len(cell_set), resolution=cur_resolution)
+
+    if cost <= min_cost:
+      min_cost = cost
+      min_cost_cell_set = cell_set
+    else:
+      # Once the cost starts rising, we won't be able to do better, so abort.
+      break
+
+  return min_cost_cell_set
+
+
+def ancestor(int_cell, res):
+  """Returns the ancestor of the given cell at the given (lower) resolution."""
+  shift = _CHAR_BITS * (resolution(int_cell) - res)
+  return (((int_cell >> _RESOLUTION_BITS) >> shift) << _RESOLUTION_BITS) | res
+
+
+def distance_sorted_edges(int_cells, point):
+  """Integer geocell counterpart of util.distance_sorted_edges().
+
+  The rectangular region containing the given (adjacent) cells is computed
+  directly from their grid coordinates rather than from one box per cell,
+  and may wrap around the antimeridian.
+  Results are memoized in EDGE_CACHE, keyed by the cells and the point.
+  """
+  cache_key = (tuple(sorted(int_cells)), point.lat, point.lon)
+  sorted_edges = EDGE_CACHE.get(cache_key)
+  if sorted_edges is None:
+    sorted_edges = tuple(_distance_sorted_edges(int_cells, point))
+    EDGE_CACHE.put(cache_key, sorted_edges)
+  return sorted_edges
+
+
+def _distance_sorted_edges(int_cells, point):
+  """Computes the (uncached) distance sorted edges of the cells' region."""
+  res = resolution(int_cells[0])
+  coords = [xy(int_cell) for int_cell in int_cells]
+  xs = [x for x, y in coords]
+  ys = [y for x, y in coords]
+
+  grid_size = _grid_size(res)
+  lon_span = 360.0 / grid_size
+  lat_span = 180.0 / grid_size
+
+  west_x, east_x = util.circular_span(xs, 1, grid_size)
+  if east_x > grid_size:
+    east_x -= grid_size
+
+  max_box = geotypes.Box(-90.0 + lat_span * (max(ys) + 1),
+                         -180.0 + lon_span * east_x,
+                         -90.0 + lat_span * min(ys),
+                         -180.0 + lon_span * west_x)
+  return util.box_distance_sorted_edges(max_box, point)
+
+
+def xy(int_cell):
+  """Returns the (x, y) grid coordinates of the given integer geocell."""
+  code = int_cell >> _RESOLUTION_BITS
+  x = y = 0
+  shift = 0
+  while code:
+    cx, cy = _COMPACT_BYTE[code & 0xff]
+    x |= cx << shift
+    y |= cy << shift
+    code >>= 8
+    shift += 4
+  return x, y
+
+
+def _pack(x, y, res):
+  """Returns the integer geocell at grid coordinates (x, y)."""
+  return (geocell._interleave(x, y) << _RESOLUTION_BITS) | res
+
+
+def _grid_size(res):
+  """Returns the number of cells along each dimension at the resolution."""
+  return geocell._GEOCELL_GRID_SIZE ** res
+
+
+def _x_mask(res):
+  """Returns the mask of the x bits of a Morton code at the resolution."""
+  return int('5' * res or '0', 16)
+
+
+def _column_range(west_x, east_x, grid_size):
+  """Returns the columns from west_x to east_x, wrapping at the antimeridian."""
+  if east_x >= west_x:
+    return range(west_x, east_x + 1)
+  return range(west_x, grid_size) + range(0, east_x + 1)
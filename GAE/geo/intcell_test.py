@@ -0,0 +1,125 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for intcell.py."""
+
+import unittest
+
+import geocell
+import geotypes
+import intcell
+import util
+
+
+class IntcellTests(unittest.TestCase):
+  def test_string_conversion(self):
+    cell = geocell.compute(geotypes.Point(37, -122), 13)
+    int_cell = intcell.from_string(cell)
+    self.assertEquals(13, intcell.resolution(int_cell))
+    self.assertEquals(cell, intcell.to_string(int_cell))
+    self.assertEquals(int_cell, intcell.compute(geotypes.Point(37, -122), 13))
+
+    # leading zeros must survive the round trip
+    self.assertEquals('000', intcell.to_string(intcell.from_string('000')))
+    self.assertNotEquals(intcell.from_string('0'), intcell.from_string('00'))
+    self.assertEquals('', intcell.to_string(intcell.from_string('')))
+
+    self.assertRaises(ValueError, intcell.from_string,
+                      '0' * (intcell.MAX_RESOLUTION + 1))
+
+  def test_parent_children(self):
+    cell = geocell.compute(geotypes.Point(37, -122), 8)
+    int_cell = intcell.from_string(cell)
+
+    self.assertEquals(cell[:-1], intcell.to_string(intcell.parent(int_cell)))
+    self.assertEquals(cell[:5],
+                      intcell.to_string(intcell.ancestor(int_cell, 5)))
+    self.assertEquals(geocell.children(cell),
+                      [intcell.to_string(c)
+                       for c in intcell.children(int_cell)])
+    self.assertEquals(None, intcell.parent(intcell.from_string('')))
+
+    self.assertEquals(intcell.children(int_cell),
+                      intcell.descendants(int_cell, 9))
+    grandchildren = intcell.descendants(int_cell, 10)
+    self.assertEquals(256, len(grandchildren))
+    self.assertEquals(int_cell, intcell.ancestor(grandchildren[-1], 8))
+
+  def test_adjacent(self):
+    cell = geocell.compute(geotypes.Point(37, -122), 14)
+    int_cell = intcell.from_string(cell)
+
+    for dir in [geocell.NORTHWEST, geocell.NORTH, geocell.NORTHEAST,
+                geocell.EAST, geocell.SOUTHEAST, geocell.SOUTH,
+                geocell.SOUTHWEST, geocell.WEST]:
+      self.assertEquals(geocell.adjacent(cell, dir),
+                        intcell.to_string(intcell.adjacent(int_cell, dir)))
+
+    # wraps horizontally, but not vertically
+    east_edge = intcell.compute(geotypes.Point(0, 180), 5)
+    self.assertEquals(intcell.compute(geotypes.Point(0, -180), 5),
+                      intcell.adjacent(east_edge, geocell.EAST))
+    north_edge = intcell.compute(geotypes.Point(90, 0), 5)
+    self.assertEquals(None, intcell.adjacent(north_edge, geocell.NORTH))
+
+  def test_distance_sorted_edges(self):
+    point = geotypes.Point(-17, 179.99)
+    east_edge = intcell.compute(point, 5)
+    cells = [east_edge, intcell.adjacent(east_edge, geocell.EAST)]
+    self.assertEquals(
+        util.distance_sorted_edges([intcell.to_string(cell) for cell in cells],
+                                   point),
+        list(intcell.distance_sorted_edges(cells, point)))
+
+  def test_compute_box(self):
+    int_cell = intcell.compute(geotypes.Point(37, -122), 14)
+    box = intcell.compute_box(int_cell)
+
+    self.assertTrue(box.south <= 37 and 37 <= box.north and
+                    box.west <= -122 and -122 <= box.east)
+    self.assertEquals(box.north, intcell.compute_box(
+        intcell.adjacent(int_cell, geocell.NORTH)).south)
+
+  def test_interpolation(self):
+    cell = geocell.compute(geotypes.Point(37, -122), 14)
+    sw_adjacent2 = geocell.adjacent(geocell.adjacent(cell, (-1, -1)),
+                                    (-1, -1))
+
+    int_cells = intcell.interpolate(intcell.from_string(cell),
+                                    intcell.from_string(sw_adjacent2))
+    self.assertEquals(geocell.interpolate(cell, sw_adjacent2),
+                      [intcell.to_string(c) for c in int_cells])
+    self.assertEquals(9, intcell.interpolation_count(
+        intcell.from_string(cell), intcell.from_string(sw_adjacent2)))
+
+  def test_best_bbox_search_cells(self):
+    bbox = geotypes.Box(37.1, -121.9, 36.9, -122.1)
+    cost_function = lambda num_cells, resolution: num_cells > 16 and 1 or 0
+
+    self.assertEquals(
+        geocell.best_bbox_search_cells(bbox, cost_function),
+        [intcell.to_string(c) for c in
+         intcell.best_bbox_search_cells(bbox, cost_function)])
+
+    # only the given resolutions are used
+    cells = intcell.best_bbox_search_cells(bbox, cost_function, (1, 3, 6, 7))
+    self.assertTrue(cells)
+    self.assertEquals(set([3]),
+                      set([intcell.resolution(cell) for cell in cells]))
+
+
+if __name__ == '__main__':
+  unittest.main()
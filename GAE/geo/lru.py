@@ -0,0 +1,116 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines a bounded, process-local LRU cache used to memoize geocell math."""
+
+import threading
+
+
+class LRUCache(object):
+  """A dictionary-like cache that evicts its least recently used entries.
+
+  Attributes:
+    max_size: The maximum number of entries held by the cache.
+    hits: The number of get() calls that found a cached value.
+    misses: The number of get() calls that did not find a cached value.
+    evictions: The number of entries evicted to stay within max_size.
+  """
+
+  def __init__(self, max_size):
+    if max_size < 1:
+      raise ValueError('LRU cache size must be positive but was %d' % max_size)
+
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+    self._lock = threading.Lock()
+    self._entries = {}
+
+    # Circular doubly linked list of [prev, next, key, value] links, most
+    # recently used first, with self._root as the sentinel.
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None]
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default=None):
+    """Returns the value cached for key, or default if there is none."""
+    self._lock.acquire()
+    try:
+      link = self._entries.get(key)
+      if link is None:
+        self.misses += 1
+        return default
+      self.hits += 1
+      self._unlink(link)
+      self._link_first(link)
+      return link[3]
+    finally:
+      self._lock.release()
+
+  def put(self, key, value):
+    """Caches value for key, evicting the least recently used entry if full."""
+    self._lock.acquire()
+    try:
+      link = self._entries.get(key)
+      if link is not None:
+        link[3] = value
+        self._unlink(link)
+      else:
+        if len(self._entries) >= self.max_size:
+          oldest = self._root[0]
+          self._unlink(oldest)
+          del self._entries[oldest[2]]
+          self.evictions += 1
+        link = [None, None, key, value]
+        self._entries[key] = link
+      self._link_first(link)
+    finally:
+      self._lock.release()
+
+  def clear(self):
+    """Removes all entries and resets the counters."""
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+      self._root[:] = [self._root, self._root, None, None]
+      self.hits = self.misses = self.evictions = 0
+    finally:
+      self._lock.release()
+
+  def stats(self):
+    """Returns a dict of the cache's size and hit/miss counters."""
+    return {'size': len(self._entries), 'max_size': self.max_size,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
+  def _unlink(self, link):
+    prev, next = link[0], link[1]
+    prev[1] = next
+    next[0] = prev
+
+  def _link_first(self, link):
+    first = self._root[1]
+    link[0] = self._root
+    link[1] = first
+    first[0] = link
+    self._root[1] = link
@@ -0,0 +1,63 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for lru.py."""
+
+import unittest
+
+import geocell
+import geotypes
+import lru
+
+
+class LRUCacheTests(unittest.TestCase):
+  def test_eviction(self):
+    cache = lru.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+
+    # touching 'a' makes 'b' the least recently used entry
+    self.assertEquals(1, cache.get('a'))
+    cache.put('c', 3)
+
+    self.assertEquals(2, len(cache))
+    self.assertTrue('a' in cache)
+    self.assertFalse('b' in cache)
+    self.assertEquals(None, cache.get('b'))
+    self.assertEquals(3, cache.get('c'))
+
+    self.assertEquals({'size': 2, 'max_size': 2, 'hits': 2, 'misses': 1,
+                       'evictions': 1}, cache.stats())
+
+    cache.clear()
+    self.assertEquals(0, len(cache))
+    self.assertEquals(0, cache.hits)
+
+    self.assertRaises(ValueError, lru.LRUCache, 0)
+
+  def test_compute_box_cache(self):
+    cell = geocell.compute(geotypes.Point(37, -122), 13)
+    geocell.BOX_CACHE.clear()
+
+    box = geocell.compute_box(cell)
+    self.assertTrue(geocell.compute_box(cell) is box)
+    self.assertEquals(1, geocell.BOX_CACHE.hits)
+    self.assertEquals(1, geocell.BOX_CACHE.misses)
+    self.assertEquals(geocell._compute_box(cell), box)
+
+
+if __name__ == '__main__':
+  unittest.main()
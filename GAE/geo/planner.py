@@ -0,0 +1,135 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Plans the geocells searched by a proximity query ahead of time.
+
+Rather than growing the search one adjacent cell at a time, a planned search
+splits the circle of radius max_distance around the search center into a few
+concentric rings. Each ring is the set of cells covering the bounding box of
+its radius, at whatever resolution the cost function prefers for a box of
+that size, minus the cells already searched by an inner ring. A coarser
+outer cell may still contain an inner ring's cells; see contains_searched().
+Once every
+ring up to radius r has been fetched, all entities within r meters of the
+center have been seen, so a search can stop as soon as it has max_results
+entities closer than the radius of the last ring fetched.
+"""
+
+import geomath
+import geotypes
+import intcell
+
+# The maximum number of concentric rings a planned search is split into.
+MAX_RINGS = 4
+
+# The ratio between the radii of two consecutive rings.
+RING_GROWTH = 4.0
+
+
+def plan_rings(center, max_distance, max_results, cost_function,
+               estimate_function=None, resolutions=None):
+  """Plans the rings of geocells to search around a center point.
+
+  Args:
+    center: A geotypes.Point or db.GeoPt indicating the search center.
+    max_distance: The maximum distance to search, in meters.
+    max_results: The number of entities the search is looking for.
+    cost_function: A function that accepts num_cells and resolution keyword
+        arguments and returns the 'cost' of querying against this number of
+        cells at the given resolution; see geocell.best_bbox_search_cells().
+    estimate_function: An optional function that accepts a list of integer
+        geocells and returns the estimated number of entities in them. When
+        given, rings that are too small to be expected to hold max_results
+        entities are merged into the first ring that is.
+    resolutions: An optional sorted sequence of the only resolutions the
+        planned cells may have; see intcell.best_bbox_search_cells().
+
+  Returns:
+    A list of (radius, int_cells) tuples, innermost ring first, where
+    int_cells is the list of integer geocells to fetch for that ring and
+    radius is the distance from the center, in meters, within which all
+    entities have been seen once the ring and the rings inside it have been
+    fetched.
+  """
+  radii = [max_distance / RING_GROWTH ** i
+           for i in range(MAX_RINGS - 1, -1, -1)]
+  covers = [intcell.best_bbox_search_cells(
+                geomath.radius_box(center, radius), cost_function,
+                resolutions) or []
+            for radius in radii]
+
+  if estimate_function is not None:
+    start = len(covers) - 1
+    for i in range(len(covers)):
+      if estimate_function(covers[i]) >= max_results:
+        start = i
+        break
+    radii = radii[start:]
+    covers = covers[start:]
+
+  rings = []
+  searched_cells = set()
+  for radius, cells in zip(radii, covers):
+    cells = [cell for cell in cells
+             if not _is_searched(cell, searched_cells) and
+             min_distance(cell, center) <= max_distance]
+
+    if cells:
+      rings.append((radius, cells))
+      searched_cells.update(cells)
+    elif rings:
+      # The inner ring's cells already cover this ring's bounding box.
+      rings[-1] = (radius, rings[-1][1])
+
+  return rings
+
+
+def min_distance(int_cell, point):
+  """Returns the distance from a point to the nearest point of a geocell.
+
+  Returns:
+    The shortest distance from the point to the geocell's rectangle, in
+    meters, or 0 if the point is inside the geocell.
+  """
+  box = intcell.compute_box(int_cell)
+
+  if (point.lon - box.west) % 360 <= box.east - box.west:
+    if point.lat > box.north:
+      return geomath.distance(point, geotypes.Point(box.north, point.lon))
+    if point.lat < box.south:
+      return geomath.distance(point, geotypes.Point(box.south, point.lon))
+    return 0
+
+  return min(geomath.meridian_distance(point, box.west, box.south, box.north),
+             geomath.meridian_distance(point, box.east, box.south, box.north))
+
+
+def contains_searched(int_cell, searched_cells):
+  """Returns whether one of the cell's descendants has been searched."""
+  res = intcell.resolution(int_cell)
+  for cell in searched_cells:
+    if (intcell.resolution(cell) > res and
+        intcell.ancestor(cell, res) == int_cell):
+      return True
+  return False
+
+
+def _is_searched(int_cell, searched_cells):
+  """Returns whether the cell or one of its ancestors has been searched."""
+  for res in range(intcell.resolution(int_cell), 0, -1):
+    if intcell.ancestor(int_cell, res) in searched_cells:
+      return True
+  return False
@@ -0,0 +1,106 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for planner.py."""
+
+import unittest
+
+import geomath
+import geotypes
+import intcell
+import planner
+
+
+def _cost_function(num_cells, resolution):
+  return num_cells > 16 and 1e10000 or 0
+
+
+class PlannerTests(unittest.TestCase):
+  def test_plan_rings(self):
+    center = geotypes.Point(37, -122)
+    rings = planner.plan_rings(center, 80000, 25, _cost_function)
+
+    self.assertTrue(0 < len(rings) <= planner.MAX_RINGS)
+    self.assertEquals(80000, rings[-1][0])
+
+    # rings grow outwards, at decreasing resolution
+    for (inner_radius, inner_cells), (radius, cells) in zip(rings, rings[1:]):
+      self.assertTrue(inner_radius < radius)
+      self.assertTrue(intcell.resolution(inner_cells[0]) >=
+                      intcell.resolution(cells[0]))
+
+    # no cell is searched twice
+    all_cells = [cell for radius, cells in rings for cell in cells]
+    self.assertEquals(len(all_cells), len(set(all_cells)))
+
+    # every point within a ring's radius is in a cell of that ring or an
+    # inner one
+    searched = set()
+    for radius, cells in rings:
+      searched.update(cells)
+      box = geomath.radius_box(center, radius * 0.99)
+      for point in [geotypes.Point(box.north, center.lon),
+                    geotypes.Point(box.south, center.lon),
+                    geotypes.Point(center.lat, box.east),
+                    geotypes.Point(center.lat, box.west)]:
+        self.assertTrue(planner._is_searched(intcell.compute(point),
+                                             searched))
+
+  def test_plan_rings_estimate(self):
+    center = geotypes.Point(37, -122)
+    all_rings = planner.plan_rings(center, 80000, 25, _cost_function)
+
+    # a dense area needs no outer rings to be skipped...
+    rings = planner.plan_rings(center, 80000, 25, _cost_function,
+                               estimate_function=lambda cells: 1000)
+    self.assertEquals(all_rings[0][0], rings[0][0])
+
+    # ...but an empty one goes straight to the outermost ring
+    rings = planner.plan_rings(center, 80000, 25, _cost_function,
+                               estimate_function=lambda cells: 0)
+    self.assertEquals(1, len(rings))
+    self.assertEquals(80000, rings[0][0])
+
+  def test_contains_searched(self):
+    cell = intcell.compute(geotypes.Point(37, -122), 5)
+    child = intcell.children(cell)[3]
+    grandchild = intcell.children(child)[7]
+    self.assertTrue(planner.contains_searched(cell, set([grandchild])))
+    self.assertTrue(planner.contains_searched(child, set([grandchild])))
+    self.assertFalse(planner.contains_searched(grandchild, set([grandchild])))
+    self.assertFalse(planner.contains_searched(child, set([cell])))
+    self.assertFalse(planner.contains_searched(
+        intcell.children(cell)[4], set([grandchild])))
+
+  def test_min_distance(self):
+    center = geotypes.Point(37, -122)
+    cell = intcell.compute(center, 8)
+    self.assertEquals(0, planner.min_distance(cell, center))
+
+    north = intcell.adjacent(intcell.adjacent(cell, (0, 1)), (0, 1))
+    box = intcell.compute_box(north)
+    self.assertAlmostEquals(
+        geomath.distance(center, geotypes.Point(box.south, center.lon)),
+        planner.min_distance(north, center), 3)
+
+    # distances are measured across the antimeridian
+    east_edge = intcell.compute(geotypes.Point(0, 179.99), 6)
+    self.assertTrue(planner.min_distance(
+        east_edge, geotypes.Point(0, -179.99)) < 3000)
+
+
+if __name__ == '__main__':
+  unittest.main()
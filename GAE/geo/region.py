@@ -0,0 +1,318 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines polygonal regions and covers them with mixed-resolution geocells.
+
+A region is a Polygon, optionally with holes, or a MultiPolygon. Like
+geocells themselves, polygons are planar in latitude/longitude space: their
+edges are straight lines on an equirectangular map, not great circles, and
+they may not cross the antimeridian.
+
+cover() turns a region into a small set of geocells of mixed resolutions
+whose union contains the region. It starts from the coarsest cells of the
+region's bounding box and repeatedly splits the largest cell straddling the
+region's boundary into its children, dropping children that are entirely
+outside the region, for as long as the result stays within max_cells. Since
+an entity stores its geocells at every resolution, a single IN filter
+matches entities in cells of any mix of resolutions.
+"""
+
+import heapq
+
+import geocell
+import geotypes
+import intcell
+import lru
+
+# The default maximum number of cells in a covering; this is the
+# datastore's limit on the values of an IN filter.
+DEFAULT_MAX_CELLS = 30
+
+# The maximum number of coverings memoized by cover().
+COVERING_CACHE_SIZE = 1000
+
+# The maximum number of cells the covering starts from before refining.
+_MAX_START_CELLS = 4
+
+# Process-wide cache of (region, max_cells, resolutions) -> covering.
+COVERING_CACHE = lru.LRUCache(COVERING_CACHE_SIZE)
+
+# The relations of a geocell to a region; see Polygon.classify_box().
+OUTSIDE = 0
+BOUNDARY = 1
+INSIDE = 2
+
+
+def _ring(points):
+  """Returns a polygon ring as a tuple of (lat, lon) tuples, open-ended."""
+  ring = [(float(point.lat), float(point.lon)) for point in points]
+  if len(ring) > 1 and ring[0] == ring[-1]:
+    ring.pop()
+  if len(ring) < 3:
+    raise ValueError('A polygon ring needs at least 3 points but had %d' %
+                     len(ring))
+  return tuple(ring)
+
+
+def _segment_intersects_box(a, b, box):
+  """Returns whether the segment from a to b touches the given box.
+
+  Uses Liang-Barsky clipping, with longitude as x and latitude as y.
+  """
+  t0, t1 = 0.0, 1.0
+  d_lat = b[0] - a[0]
+  d_lon = b[1] - a[1]
+  for p, q in ((-d_lon, a[1] - box.west), (d_lon, box.east - a[1]),
+               (-d_lat, a[0] - box.south), (d_lat, box.north - a[0])):
+    if p == 0:
+      if q < 0:
+        return False
+    else:
+      t = q / p
+      if p < 0:
+        if t > t1:
+          return False
+        t0 = max(t0, t)
+      else:
+        if t < t0:
+          return False
+        t1 = min(t1, t)
+  return True
+
+
+class Polygon(object):
+  """A simple polygon, optionally with holes.
+
+  Polygons are immutable and hashable, so they can be used as cache keys.
+
+  Attributes:
+    outer: The outer ring, a tuple of (lat, lon) tuples.
+    holes: A tuple of hole rings, each a tuple of (lat, lon) tuples.
+    bounding_box: A geotypes.Box bounding the outer ring.
+  """
+
+  def __init__(self, outer, holes=()):
+    """Creates a polygon.
+
+    Args:
+      outer: A list of geotypes.Point or db.GeoPt vertices of the outer
+          ring. The ring may be given closed or open.
+      holes: An optional list of rings, each a list of vertices, of the
+          holes in the polygon. Holes must lie inside the outer ring and
+          not overlap each other.
+    """
+    self.outer = _ring(outer)
+    self.holes = tuple([_ring(hole) for hole in holes])
+
+    lats = [lat for lat, lon in self.outer]
+    lons = [lon for lat, lon in self.outer]
+    self.bounding_box = geotypes.Box(max(lats), max(lons),
+                                     min(lats), min(lons))
+
+    self._edges = []
+    for ring in (self.outer,) + self.holes:
+      for i in range(len(ring)):
+        self._edges.append((ring[i - 1], ring[i]))
+
+  def __eq__(self, other):
+    return (isinstance(other, Polygon) and
+            self.outer == other.outer and self.holes == other.holes)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash((self.outer, self.holes))
+
+  def contains(self, point):
+    """Returns whether a point is inside the polygon and not in a hole."""
+    lat, lon = point.lat, point.lon
+    box = self.bounding_box
+    if lat < box.south or lat > box.north or lon < box.west or lon > box.east:
+      return False
+
+    # Even-odd rule: count the edges, holes included, crossed by a ray
+    # running East from the point.
+    inside = False
+    for (lat1, lon1), (lat2, lon2) in self._edges:
+      if (lat1 > lat) != (lat2 > lat):
+        if lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+          inside = not inside
+    return inside
+
+  def classify_box(self, box):
+    """Returns whether a box is INSIDE, OUTSIDE or on the BOUNDARY of the
+    polygon.
+    """
+    bbox = self.bounding_box
+    if (box.south > bbox.north or box.north < bbox.south or
+        box.west > bbox.east or box.east < bbox.west):
+      return OUTSIDE
+
+    for a, b in self._edges:
+      if _segment_intersects_box(a, b, box):
+        return BOUNDARY
+
+    # No edge crosses the box, so it is either entirely inside or entirely
+    # outside; its center tells which.
+    center = geotypes.Point((box.north + box.south) / 2,
+                            (box.east + box.west) / 2)
+    if self.contains(center):
+      return INSIDE
+    return OUTSIDE
+
+
+class MultiPolygon(object):
+  """The union of a number of non-overlapping polygons.
+
+  Attributes:
+    polygons: A tuple of Polygons.
+    bounding_box: A geotypes.Box bounding all of the polygons.
+  """
+
+  def __init__(self, polygons):
+    if not polygons:
+      raise ValueError('A multi-polygon needs at least one polygon')
+
+    self.polygons = tuple(polygons)
+    self.bounding_box = geotypes.Box(
+        max([p.bounding_box.north for p in self.polygons]),
+        max([p.bounding_box.east for p in self.polygons]),
+        min([p.bounding_box.south for p in self.polygons]),
+        min([p.bounding_box.west for p in self.polygons]))
+
+  def __eq__(self, other):
+    return (isinstance(other, MultiPolygon) and
+            self.polygons == other.polygons)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.polygons)
+
+  def contains(self, point):
+    """Returns whether a point is inside any of the polygons."""
+    for polygon in self.polygons:
+      if polygon.contains(point):
+        return True
+    return False
+
+  def classify_box(self, box):
+    """Returns whether a box is INSIDE, OUTSIDE or on the BOUNDARY of the
+    multi-polygon.
+    """
+    result = OUTSIDE
+    for polygon in self.polygons:
+      relation = polygon.classify_box(box)
+      if relation == INSIDE:
+        return INSIDE
+      result = max(result, relation)
+    return result
+
+
+def cover(region, max_cells=DEFAULT_MAX_CELLS,
+          max_resolution=geocell.MAX_GEOCELL_RESOLUTION, resolutions=None):
+  """Computes a mixed-resolution set of geocells covering a region.
+
+  Coverings are memoized, so covering the same region again is cheap.
+
+  Args:
+    region: A Polygon or MultiPolygon.
+    max_cells: The maximum number of cells in the covering. The covering may
+        exceed this only if the region's bounding box spans more resolution
+        1 cells.
+    max_resolution: The finest resolution of the cells in the covering.
+    resolutions: An optional sorted sequence of the only resolutions the
+        cells in the covering may have. Boundary cells are then split into
+        their descendants at the next of these resolutions.
+
+  Returns:
+    A tuple (interior_cells, boundary_cells) of sorted tuples of integer
+    geocells. Interior cells lie entirely inside the region, so entities in
+    them need no further checks; entities in boundary cells must be checked
+    with region.contains().
+  """
+  if resolutions is None:
+    resolutions = range(1, max_resolution + 1)
+  else:
+    resolutions = tuple([res for res in resolutions if res <= max_resolution])
+
+  key = (region, max_cells, tuple(resolutions))
+  covering = COVERING_CACHE.get(key)
+  if covering is None:
+    covering = _cover(region, max_cells, resolutions)
+    COVERING_CACHE.put(key, covering)
+  return covering
+
+
+def _cover(region, max_cells, resolutions):
+  bbox = region.bounding_box
+
+  # Start from the finest resolution at which the bounding box spans no more
+  # than a few cells, leaving room in the budget to refine them.
+  max_start_cells = min(max_cells, _MAX_START_CELLS)
+  start_cells = None
+  for res in resolutions:
+    cell_ne = intcell.compute(bbox.north_east, res)
+    cell_sw = intcell.compute(bbox.south_west, res)
+    if start_cells is not None and (
+        intcell.interpolation_count(cell_ne, cell_sw) > max_start_cells):
+      break
+    start_cells = intcell.interpolate(cell_ne, cell_sw)
+
+  interior = []
+  boundary = []  # a heap, coarsest cells first
+  for cell in start_cells:
+    _add_cell(region, cell, interior, boundary)
+
+  # Split the coarsest boundary cells for as long as the covering stays
+  # within max_cells. Cells whose children don't fit are kept as they are.
+  unsplittable = []
+  while boundary:
+    res, cell = heapq.heappop(boundary)
+    if res >= resolutions[-1]:
+      unsplittable.append((res, cell))
+      break
+
+    child_res = [r for r in resolutions if r > res][0]
+    children = []
+    for child in intcell.descendants(cell, child_res):
+      relation = region.classify_box(intcell.compute_box(child))
+      if relation != OUTSIDE:
+        children.append((relation, child))
+
+    num_cells = len(interior) + len(boundary) + len(unsplittable)
+    if num_cells + len(children) > max_cells:
+      unsplittable.append((res, cell))
+      continue
+
+    for relation, child in children:
+      if relation == INSIDE:
+        interior.append(child)
+      else:
+        heapq.heappush(boundary, (child_res, child))
+
+  boundary_cells = [cell for res, cell in boundary + unsplittable]
+  return tuple(sorted(interior)), tuple(sorted(boundary_cells))
+
+
+def _add_cell(region, cell, interior, boundary):
+  relation = region.classify_box(intcell.compute_box(cell))
+  if relation == INSIDE:
+    interior.append(cell)
+  elif relation == BOUNDARY:
+    heapq.heappush(boundary, (intcell.resolution(cell), cell))
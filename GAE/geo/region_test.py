@@ -0,0 +1,106 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for region.py."""
+
+import unittest
+
+import geocell
+import geotypes
+import intcell
+import region
+
+
+def _square(north, east, south, west):
+  return [geotypes.Point(south, west), geotypes.Point(north, west),
+          geotypes.Point(north, east), geotypes.Point(south, east)]
+
+
+class PolygonTests(unittest.TestCase):
+  def setUp(self):
+    self.polygon = region.Polygon(_square(38, -121, 37, -123),
+                                  holes=[_square(37.6, -121.8, 37.4, -122.2)])
+
+  def test_contains(self):
+    self.assertTrue(self.polygon.contains(geotypes.Point(37.2, -122.5)))
+    self.assertFalse(self.polygon.contains(geotypes.Point(37.5, -122)))
+    self.assertFalse(self.polygon.contains(geotypes.Point(36.5, -122)))
+    self.assertFalse(self.polygon.contains(geotypes.Point(37.5, -120)))
+
+  def test_closed_ring(self):
+    ring = _square(38, -121, 37, -123)
+    self.assertEquals(region.Polygon(ring), region.Polygon(ring + ring[:1]))
+    self.assertRaises(ValueError, region.Polygon, ring[:2])
+
+  def test_classify_box(self):
+    self.assertEquals(region.INSIDE, self.polygon.classify_box(
+        geotypes.Box(37.9, -122.6, 37.7, -122.8)))
+    self.assertEquals(region.OUTSIDE, self.polygon.classify_box(
+        geotypes.Box(37.55, -121.9, 37.45, -122.1)))
+    self.assertEquals(region.OUTSIDE, self.polygon.classify_box(
+        geotypes.Box(40, 10, 39, 9)))
+    self.assertEquals(region.BOUNDARY, self.polygon.classify_box(
+        geotypes.Box(37.5, -121.5, 37.3, -122)))
+
+  def test_multi_polygon(self):
+    multi = region.MultiPolygon([region.Polygon(_square(1, 1, 0, 0)),
+                                 region.Polygon(_square(1, 11, 0, 10))])
+    self.assertTrue(multi.contains(geotypes.Point(0.5, 10.5)))
+    self.assertFalse(multi.contains(geotypes.Point(0.5, 5)))
+    self.assertEquals(geotypes.Box(1, 11, 0, 0), multi.bounding_box)
+
+
+class CoverTests(unittest.TestCase):
+  def test_cover(self):
+    polygon = region.Polygon(
+        [geotypes.Point(37.0, -122.5), geotypes.Point(37.9, -122.3),
+         geotypes.Point(37.8, -121.8), geotypes.Point(37.1, -122.0)],
+        holes=[_square(37.6, -122.1, 37.4, -122.2)])
+    interior, boundary = region.cover(polygon, max_cells=20)
+    self.assertTrue(len(interior) + len(boundary) <= 20)
+    self.assertTrue(interior)
+    covering = set(interior + boundary)
+
+    for i in range(41):
+      for j in range(41):
+        point = geotypes.Point(36.9 + i * 0.025, -122.6 + j * 0.025)
+        cell = intcell.compute(point)
+        ancestors = set([intcell.ancestor(cell, res) for res in
+                         range(1, geocell.MAX_GEOCELL_RESOLUTION + 1)])
+        if polygon.contains(point):
+          self.assertTrue(ancestors & covering)
+        if ancestors & set(interior):
+          self.assertTrue(polygon.contains(point))
+
+  def test_cover_resolutions(self):
+    polygon = region.Polygon(_square(37.9, -121.8, 37.1, -122.4))
+    interior, boundary = region.cover(polygon, max_cells=30,
+                                      resolutions=(1, 3, 5, 7))
+    self.assertTrue(interior)
+    for cell in interior + boundary:
+      self.assertTrue(intcell.resolution(cell) in (1, 3, 5, 7))
+
+  def test_cover_cache(self):
+    region.COVERING_CACHE.clear()
+    polygon = region.Polygon(_square(38, -121, 37, -123))
+    covering = region.cover(polygon)
+    self.assertEquals(covering,
+                      region.cover(region.Polygon(_square(38, -121, 37, -123))))
+    self.assertEquals(1, region.COVERING_CACHE.hits)
+
+
+if __name__ == '__main__':
+  unittest.main()
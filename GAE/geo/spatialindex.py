@@ -0,0 +1,140 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines an in-memory spatial index for nearest neighbor and radius queries.
+
+The index buckets points by the geocell containing them at a fixed
+resolution. A radius query only looks at the buckets of the cells covering
+the bounding box of its circle, computes the distances to all of their
+points in one geomath.distances() call and keeps the nearest ones in a
+util.NearestResults accumulator. Points can be added, moved and removed one
+at a time, which makes the index cheap to keep current incrementally.
+"""
+
+import geomath
+import intcell
+import util
+
+# The resolution of the cells points are bucketed by; a resolution 6 cell is
+# roughly 40 x 20 kilometers near the equator.
+DEFAULT_RESOLUTION = 6
+
+
+class SpatialIndex(object):
+  """An in-memory index of keyed points.
+
+  Attributes:
+    resolution: The resolution of the geocells points are bucketed by.
+  """
+
+  def __init__(self, resolution=DEFAULT_RESOLUTION):
+    self.resolution = resolution
+
+    # Integer geocell -> {key: (point, value)}.
+    self._buckets = {}
+
+    # Key -> integer geocell of the bucket holding it.
+    self._cells = {}
+
+  def __len__(self):
+    return len(self._cells)
+
+  def __contains__(self, key):
+    return key in self._cells
+
+  def add(self, key, point, value):
+    """Adds a point to the index, replacing any point with the same key.
+
+    Args:
+      key: A hashable uniquely identifying the point, e.g. an entity key.
+      point: A geotypes.Point or db.GeoPt.
+      value: The value returned by queries matching the point.
+    """
+    self.remove(key)
+    cell = intcell.compute(point, self.resolution)
+    self._buckets.setdefault(cell, {})[key] = (point, value)
+    self._cells[key] = cell
+
+  def remove(self, key):
+    """Removes the point with the given key, if there is one.
+
+    Returns:
+      True if a point was removed.
+    """
+    cell = self._cells.pop(key, None)
+    if cell is None:
+      return False
+
+    bucket = self._buckets[cell]
+    del bucket[key]
+    if not bucket:
+      del self._buckets[cell]
+    return True
+
+  def clear(self):
+    """Removes all points from the index."""
+    self._buckets.clear()
+    self._cells.clear()
+
+  def nearest(self, center, max_results, max_distance=None):
+    """Finds the points nearest to a center point.
+
+    Args:
+      center: A geotypes.Point or db.GeoPt indicating the search center.
+      max_results: The maximum number of results to return.
+      max_distance: An optional maximum distance to search, in meters.
+          Points exactly max_distance away are excluded, as they are by
+          GeoModel.proximity_fetch().
+
+    Returns:
+      A list of (value, distance) tuples, sorted by ascending distance.
+    """
+    results = util.NearestResults(max_results)
+
+    for bucket in self._candidate_buckets(center, max_distance):
+      keys = bucket.keys()
+      dists = geomath.distances(center, [bucket[key][0] for key in keys],
+                                max_distance=max_distance)
+      for key, dist in zip(keys, dists):
+        if dist is not None and (max_distance is None or dist < max_distance):
+          results.add(bucket[key][1], dist, key=key)
+
+    return results.sorted_results()
+
+  def within(self, center, radius):
+    """Finds all points within a radius of a center point.
+
+    Returns:
+      A list of (value, distance) tuples, sorted by ascending distance.
+    """
+    return self.nearest(center, len(self), max_distance=radius)
+
+  def _candidate_buckets(self, center, max_distance):
+    """Returns the buckets that may hold points within max_distance."""
+    if max_distance is None:
+      return self._buckets.values()
+
+    bbox = geomath.radius_box(center, max_distance)
+    cell_ne = intcell.compute(bbox.north_east, self.resolution)
+    cell_sw = intcell.compute(bbox.south_west, self.resolution)
+
+    # Scanning every bucket is cheaper than looking up more cells than there
+    # are buckets.
+    if intcell.interpolation_count(cell_ne, cell_sw) > len(self._buckets):
+      return self._buckets.values()
+
+    return [self._buckets[cell] for cell in intcell.interpolate(cell_ne, cell_sw)
+            if cell in self._buckets]
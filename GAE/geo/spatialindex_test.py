@@ -0,0 +1,92 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2009 Roman Nurik
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for spatialindex.py."""
+
+import random
+import unittest
+
+import geomath
+import geotypes
+import spatialindex
+
+
+class SpatialIndexTests(unittest.TestCase):
+  def setUp(self):
+    rand = random.Random(7)
+    self.points = {}
+    for i in range(500):
+      self.points[i] = geotypes.Point(rand.uniform(36, 38),
+                                      rand.uniform(-123, -121))
+    self.index = spatialindex.SpatialIndex()
+    for key, point in self.points.items():
+      self.index.add(key, point, 'value %d' % key)
+
+  def _brute_force(self, center, max_results, max_distance):
+    dists = sorted([(geomath.distance(center, point), key)
+                    for key, point in self.points.items()])
+    return [('value %d' % key, dist) for dist, key in dists
+            if dist < max_distance][:max_results]
+
+  def test_nearest(self):
+    center = geotypes.Point(37, -122)
+    for max_results, max_distance in [(1, 1e6), (10, 20000), (600, 50000)]:
+      expected = self._brute_force(center, max_results, max_distance)
+      actual = self.index.nearest(center, max_results, max_distance)
+      self.assertEquals([value for value, dist in expected],
+                        [value for value, dist in actual])
+
+    self.assertEquals(10, len(self.index.nearest(center, 10)))
+
+    within = self.index.within(center, 10000)
+    self.assertEquals(len(self._brute_force(center, 500, 10000)), len(within))
+
+  def test_boundary_is_exclusive(self):
+    center = geotypes.Point(37, -122)
+    dist = geomath.distance(center, self.points[7])
+    inside = self.index.within(center, dist * 1.01)
+    self.assertTrue('value 7' in [value for value, d in inside])
+    boundary = self.index.within(center, dist)
+    self.assertFalse('value 7' in [value for value, d in boundary])
+
+  def test_incremental_updates(self):
+    center = geotypes.Point(37, -122)
+    self.assertEquals(500, len(self.index))
+
+    # moving a point onto the center makes it the nearest one
+    self.index.add(42, center, 'moved')
+    self.assertEquals(500, len(self.index))
+    self.assertEquals([('moved', 0)], self.index.nearest(center, 1, 1000))
+
+    self.assertTrue(self.index.remove(42))
+    self.assertFalse(self.index.remove(42))
+    self.assertFalse(42 in self.index)
+    self.assertNotEquals('moved', self.index.nearest(center, 1)[0][0])
+
+    self.index.clear()
+    self.assertEquals([], self.index.nearest(center, 10))
+
+  def test_antimeridian(self):
+    index = spatialindex.SpatialIndex()
+    index.add('east', geotypes.Point(0, 179.99), 'east')
+    index.add('far', geotypes.Point(0, 0), 'far')
+
+    results = index.nearest(geotypes.Point(0, -179.99), 10, 10000)
+    self.assertEquals(['east'], [value for value, dist in results])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -6,5 +6,12 @@ coverage -x geomath_test.py
 coverage -x geotypes_test.py
 coverage -x util_test.py
 coverage -x geocell_test.py
+coverage -x intcell_test.py
+coverage -x lru_test.py
+coverage -x planner_test.py
+coverage -x spatialindex_test.py
+coverage -x region_test.py
+coverage -x geomodel_test.py
 
-coverage -r -m geomath.py geotypes.py util.py geocell.py
+coverage -r -m geomath.py geotypes.py util.py geocell.py intcell.py lru.py planner.py \
+    spatialindex.py region.py geomodel.py
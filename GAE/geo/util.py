@@ -18,16 +18,92 @@
 
 __author__ = 'api.roman.public@gmail.com (Roman Nurik)'
 
+import heapq
+
 import geocell
 import geomath
 import geotypes
 
 
+class NearestResults(object):
+  """Accumulates the <max_results> results nearest to a search center.
+
+  Candidates are kept in a bounded max-heap keyed by distance, so adding a
+  candidate costs O(log max_results) and the current farthest result is
+  always at the top of the heap. Duplicate candidates are rejected in O(1)
+  by remembering the keys of every candidate seen so far.
+
+  Attributes:
+    max_results: The maximum number of results to keep.
+  """
+
+  def __init__(self, max_results):
+    self.max_results = max_results
+
+    # Heap of (-distance, sequence, entity) tuples; the sequence number keeps
+    # entities themselves from ever being compared.
+    self._heap = []
+    self._seen_keys = set()
+    self._sequence = 0
+
+  def __len__(self):
+    return len(self._heap)
+
+  def add(self, entity, dist, key=None):
+    """Offers a candidate result.
+
+    Args:
+      entity: The candidate entity.
+      dist: The candidate's distance from the search center.
+      key: An optional hashable identifying the entity, used to reject
+          duplicates; defaults to entity.key().
+
+    Returns:
+      True if the candidate is now one of the nearest results.
+    """
+    if key is None:
+      key = entity.key()
+    if key in self._seen_keys:
+      return False
+    self._seen_keys.add(key)
+
+    if self.max_results <= 0:
+      return False
+
+    self._sequence += 1
+    item = (-dist, self._sequence, entity)
+    if len(self._heap) < self.max_results:
+      heapq.heappush(self._heap, item)
+    elif dist < -self._heap[0][0]:
+      heapq.heapreplace(self._heap, item)
+    else:
+      return False
+    return True
+
+  def is_full(self):
+    """Returns whether max_results results have been accumulated."""
+    return len(self._heap) >= self.max_results
+
+  def farthest_distance(self):
+    """Returns the distance of the farthest kept result, or None if empty."""
+    if not self._heap:
+      return None
+    return -self._heap[0][0]
+
+  def sorted_results(self):
+    """Returns a list of (entity, distance) tuples sorted by distance."""
+    return [(entity, -neg_dist) for neg_dist, sequence, entity in
+            sorted(self._heap, key=lambda item: (-item[0], item[1]))]
+
+
 def merge_in_place(*lists, **kwargs):
   """Merges an arbitrary number of pre-sorted lists in-place, into the first
   list, possibly pruning out duplicates. Source lists must not have
   duplicates.
 
+  The lists are merged with a heap of their heads, in O(n log k) time for n
+  values across k lists.
+
   Args:
     list1: The first, sorted list into which the other lists should be merged.
     list2: A subsequent, sorted list to merge into the first.
@@ -37,7 +113,8 @@ def merge_in_place(*lists, **kwargs):
         lists and determines the merged list's sort order.
     dup_fn: An optional binary comparison function that should return True if
         the given objects are equivalent and one of them can be pruned from the
-        resulting merged list.
+        resulting merged list. Equivalent objects must compare equal with
+        cmp_fn.
 
   Returns:
     list1, in-placed merged wit the other lists, or an empty list if no lists
@@ -49,36 +126,47 @@ def merge_in_place(*lists, **kwargs):
   if not lists:
     return []
 
-  reverse_indices = [len(arr) for arr in lists]
-  aggregate_reverse_index = sum(reverse_indices)
-
-  while aggregate_reverse_index > 0:
-    pull_arr_index = None
-    pull_val = None
-
-    for i in range(len(lists)):
-      if reverse_indices[i] == 0:
-        # Reached the end of this list.
-        pass
-      elif (pull_arr_index is not None and
-            dup_fn and dup_fn(lists[i][-reverse_indices[i]], pull_val)):
-        # Found a duplicate, advance the index of the list in which the
-        # duplicate was found.
-        reverse_indices[i] -= 1
-        aggregate_reverse_index -= 1
-      elif (pull_arr_index is None or
-            cmp_fn(lists[i][-reverse_indices[i]], pull_val) < 0):
-        # Found a lower value.
-        pull_arr_index = i
-        pull_val = lists[i][-reverse_indices[i]]
-
-    if pull_arr_index != 0:
-      # Add the lowest found value in place into the first array.
-      lists[0].insert(len(lists[0]) - reverse_indices[0], pull_val)
-
-    aggregate_reverse_index -= 1
-    reverse_indices[pull_arr_index] -= 1
+  class _Head(object):
+    """A list head, ordered by cmp_fn and then by list index."""
+    def __init__(self, val, list_index, index):
+      self.val = val
+      self.list_index = list_index
+      self.index = index
+
+    def __lt__(self, other):
+      c = cmp_fn(self.val, other.val)
+      return c < 0 or (c == 0 and self.list_index < other.list_index)
+
+    def __le__(self, other):
+      return not other < self
+
+  heap = [_Head(arr[0], i, 0) for i, arr in enumerate(lists) if arr]
+  heapq.heapify(heap)
+
+  merged = []
+
+  # The merged values comparing equal to the last merged value; only these
+  # can be duplicates of the next value.
+  equal_run = []
 
+  while heap:
+    head = heap[0]
+    val = head.val
+
+    if equal_run and cmp_fn(val, equal_run[0]) != 0:
+      equal_run = []
+    if not (dup_fn and [v for v in equal_run if dup_fn(val, v)]):
+      merged.append(val)
+      equal_run.append(val)
+
+    arr = lists[head.list_index]
+    if head.index + 1 < len(arr):
+      heapq.heapreplace(heap, _Head(arr[head.index + 1], head.list_index,
+                                    head.index + 1))
+    else:
+      heapq.heappop(heap)
+
+  lists[0][:] = merged
   return lists[0]
 
 
@@ -89,29 +177,88 @@ def distance_sorted_edges(cells, point):
 
   Args:
     cells: The cells (should be adjacent) defining the rectangular region
-        whose edge distances are requested.
+        whose edge distances are requested. The region may wrap around the
+        antimeridian.
     point: The point that should determine the edge sort order.
 
   Returns:
     A list of (direction, distance) tuples, where direction is the edge
     and distance is the distance from the point to that edge. A direction
     value of (0,-1), for example, corresponds to the South edge of the
-    rectangular region containing all of the given geocells.
+    rectangular region containing all of the given geocells. Edges on the
+    poles, beyond which there is nothing to search, are left out.
   """
   # TODO(romannurik): Assert that lat,lon are actually inside the geocell.
   boxes = [geocell.compute_box(cell) for cell in cells]
 
+  west, east = circular_span([box.west for box in boxes],
+                             boxes[0].east - boxes[0].west, 360.0)
   max_box = geotypes.Box(max([box.north for box in boxes]),
-                         max([box.east for box in boxes]),
+                         east if east <= 180 else east - 360,
                          min([box.south for box in boxes]),
-                         min([box.west for box in boxes]))
-  return zip(*sorted([
-      ((0,-1), geomath.distance(geotypes.Point(max_box.south, point.lon),
-                                point)),
-      ((0,1),  geomath.distance(geotypes.Point(max_box.north, point.lon),
-                                point)),
-      ((-1,0), geomath.distance(geotypes.Point(point.lat, max_box.west),
-                                point)),
-      ((1,0),  geomath.distance(geotypes.Point(point.lat, max_box.east),
-                                point))],
-      lambda x, y: cmp(x[1], y[1])))
+                         west)
+  return box_distance_sorted_edges(max_box, point)
+
+
+def box_distance_sorted_edges(max_box, point):
+  """Returns the edges of the given box sorted by distance from the given
+  point, along with the actual distances from the point to these edges.
+
+  The distance to the East or West edge is the distance to the nearest point
+  of its whole meridian, so that it bounds the distance to anything beyond
+  the edge even near the poles.
+
+  Args:
+    max_box: A geotypes.Box indicating the rectangular region whose edge
+        distances are requested. Its east longitude is west of its west
+        longitude if it crosses the antimeridian.
+    point: The point that should determine the edge sort order.
+
+  Returns:
+    A list of (direction, distance) tuples; see distance_sorted_edges().
+  """
+  edges = []
+  if max_box.south > -90:
+    edges.append(((0,-1), geomath.distance(
+        geotypes.Point(max_box.south, point.lon), point)))
+  if max_box.north < 90:
+    edges.append(((0,1), geomath.distance(
+        geotypes.Point(max_box.north, point.lon), point)))
+  if max_box.east - max_box.west != 360:
+    edges.append(((-1,0), geomath.meridian_distance(point, max_box.west)))
+    edges.append(((1,0), geomath.meridian_distance(point, max_box.east)))
+
+  return zip(*sorted(edges, lambda x, y: cmp(x[1], y[1])))
+
+
+def circular_span(starts, width, period):
+  """Returns the shortest circular interval covering a set of intervals.
+
+  Used to find the longitude (or grid column) range of a set of adjacent
+  geocells that may wrap around the antimeridian.
+
+  Args:
+    starts: The starts of the intervals, all in [0, period) or all in
+        [-period / 2, period / 2).
+    width: The width of each interval.
+    period: The period of the circle, e.g. 360 for longitudes.
+
+  Returns:
+    A (start, end) tuple. If the interval wraps around, end is one period
+    past its actual end, so end - start is always the interval's length.
+  """
+  starts = sorted(set(starts))
+
+  # The interval starts right after the largest gap between two consecutive
+  # starts, going around the circle.
+  best_gap = starts[0] + period - starts[-1]
+  best_index = 0
+  for i in range(1, len(starts)):
+    if starts[i] - starts[i - 1] > best_gap:
+      best_gap = starts[i] - starts[i - 1]
+      best_index = i
+
+  end = starts[best_index - 1] + width
+  if best_index:
+    end += period
+  return starts[best_index], end
@@ -20,6 +20,8 @@ __author__ = 'api.roman.public@gmail.com (Roman Nurik)'
 
 import unittest
 
+import geocell
+import geotypes
 import util
 
 
@@ -42,6 +44,59 @@ class MergeInPlaceTests(unittest.TestCase):
         [-1, 0, 1, 2, 3, 4, 5, 6, 8, 9, 10, 11, 15, 16, 17, 19, 20],
         list1)
 
+    # duplicates that compare equal to other values are still pruned
+    list1 = [(0, 'a'), (1, 'b'), (1, 'c')]
+    list2 = [(1, 'c'), (1, 'a'), (2, 'd')]
+    util.merge_in_place(list1, list2,
+        cmp_fn=lambda x, y: cmp(x[0], y[0]),
+        dup_fn=lambda x, y: x[1] == y[1])
+    self.assertEquals([(0, 'a'), (1, 'b'), (1, 'c'), (1, 'a'), (2, 'd')],
+                      list1)
+
+
+class NearestResultsTests(unittest.TestCase):
+  def test_nearest_results(self):
+    results = util.NearestResults(3)
+    self.assertEquals(None, results.farthest_distance())
+
+    for dist, key in [(5, 'e'), (1, 'a'), (4, 'd'), (2, 'b')]:
+      results.add(key.upper(), dist, key=key)
+
+    self.assertTrue(results.is_full())
+    self.assertEquals(4, results.farthest_distance())
+
+    # farther candidates and duplicates are rejected
+    self.assertFalse(results.add('F', 6, key='f'))
+    self.assertFalse(results.add('B', 2, key='b'))
+    self.assertTrue(results.add('C', 3, key='c'))
+
+    self.assertEquals([('A', 1), ('B', 2), ('C', 3)],
+                      results.sorted_results())
+    self.assertEquals(3, results.farthest_distance())
+
+
+class DistanceSortedEdgesTests(unittest.TestCase):
+  def test_circular_span(self):
+    self.assertEquals((-180, 0), util.circular_span([-90, -180], 90, 360))
+    self.assertEquals((90, 270), util.circular_span([90, -180], 90, 360))
+    self.assertEquals((15, 17), util.circular_span([0, 15], 1, 16))
+
+  def test_distance_sorted_edges(self):
+    # cells on either side of the antimeridian form one narrow region, so
+    # the nearest edge is to the North or South, not across the world
+    point = geotypes.Point(0.1, 179.99)
+    cells = [geocell.compute(point, 3),
+             geocell.compute(geotypes.Point(0.1, -179.99), 3)]
+    edges, dists = util.distance_sorted_edges(cells, point)
+    self.assertEquals(4, len(edges))
+    self.assertTrue(edges[0] in [(0, 1), (0, -1)])
+    self.assertTrue(dists[-1] < 1000000)
+
+    # there's no edge on a pole
+    edges, dists = util.distance_sorted_edges(
+        [geocell.compute(geotypes.Point(90, 0), 3)], geotypes.Point(89, 0))
+    self.assertFalse((0, 1) in edges)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,54 @@
+##
+# middleware.py
+#
+# Django middleware used by the web application. See the
+# MIDDLEWARE_CLASSES setting in settings.py.
+##
+
+# For handling user sessions
+from appengine_utilities.sessions import Session
+
+# For writing buffered cache entries
+from appengine_utilities import cache
+
+class LazySession(object):
+    """
+    Descriptor that builds the Session for a request the first time
+    request.session is used and returns that same Session afterwards.
+    Requests that never touch their session never build one.
+    """
+    def __get__(self, request, obj_type=None):
+        if not hasattr(request, "_cached_session"):
+            request._cached_session = Session()
+        return request._cached_session
+
+class SessionMiddleware(object):
+    """
+    Attaches the user's session to each request as request.session, so
+    that it is resolved (cookie parsing, memcache lookup and any token
+    refresh) at most once per request no matter how many decorators and
+    views use it.
+
+    Once the response is ready the session is saved, which writes blob
+    writer sessions (see the WRITER session setting) that changed during
+    the request.
+    """
+    def process_request(self, request):
+        request.__class__.session = LazySession()
+        return None
+
+    def process_response(self, request, response):
+        session = request.__dict__.get("_cached_session")
+        if session is not None:
+            session.save()
+        return response
+
+class CacheFlushMiddleware(object):
+    """
+    Writes the cache entries buffered during the request in write behind
+    mode (see the WRITE_BEHIND cache setting) to the datastore with one
+    batch put once the response is ready.
+    """
+    def process_response(self, request, response):
+        cache.flush()
+        return response
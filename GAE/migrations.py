@@ -0,0 +1,68 @@
+##
+# migrations.py
+#
+# Data migrations that touch every entity of a kind. Each one processes a
+# batch of entities per deferred task and then defers the next batch, so it
+# runs in the background and stays well within the request deadline.
+##
+
+# Runs the batches of a migration as task queue tasks
+from google.appengine.ext import deferred
+
+# Our datastore models
+from model import Question, User, UserEmail, normalize_email, reference_key
+
+import logging
+
+##
+# CONSTANTS
+##
+
+"""
+The number of entities each task of a migration processes.
+"""
+BATCH_SIZE = 100
+
+def rewrite_question_geocells(cursor=None):
+    """
+    Rewrites the stored geocells of every question to match the geocell
+    resolutions of the Question model, one batch per task.
+
+    @param cursor: datastore cursor to continue from, None to start over
+    """
+    rewritten, cursor = Question.rewrite_geocells(cursor, BATCH_SIZE)
+    logging.info("rewrote the geocells of %d questions" % rewritten)
+
+    if cursor is not None:
+        deferred.defer(rewrite_question_geocells, cursor)
+
+def index_user_emails(cursor=None):
+    """
+    Creates the UserEmail entities of users registered before email
+    addresses were indexed, one batch per task. Users whose address is
+    already indexed for another user, e.g. one registered with the same
+    address in a different case, are logged as collisions and must be
+    resolved by hand. Once it has finished, model.LEGACY_EMAIL_LOOKUP
+    can be set to False.
+
+    @param cursor: datastore cursor to continue from, None to start over
+    """
+    query = User.all()
+    if cursor is not None:
+        query.with_cursor(cursor)
+    users = query.fetch(BATCH_SIZE)
+
+    collisions = 0
+    for user in users:
+        email = normalize_email(user.email)
+        index = UserEmail.get_or_insert(email, user=user)
+        if reference_key(index, "user") != user.key():
+            collisions += 1
+            logging.warning("email address %s of user %s is indexed for "
+                            "user %s" % (email, user.key().id(),
+                                         reference_key(index, "user").id()))
+    logging.info("indexed the email addresses of %d users, %d collisions" %
+                 (len(users) - collisions, collisions))
+
+    if len(users) == BATCH_SIZE:
+        deferred.defer(index_user_emails, query.cursor())
@@ -11,11 +11,180 @@
 # http://code.google.com/p/geomodel/
 ##
 
+import logging
+import random
+import time
+
 # Provides standard set of app engine models and properties
 from google.appengine.ext import db
 
+# Caches the karma totals
+from google.appengine.api import memcache
+
+# Writes the effects of accepting an answer outside of its transaction
+from google.appengine.ext import deferred
+
 # Provides proxmity and bounding box searching
-from geo.geomodel import GeoModel
+from geo.geomodel import GeoModel, COMPACT_GEOCELL_RESOLUTIONS
+
+# Caches user keys by email address on the instance
+from geo import lru
+
+def reference_key(entity, name):
+    """
+    Returns the key of the entity referenced by a ReferenceProperty
+    without fetching that entity, or None if the property is not set.
+
+    @param entity - the entity holding the reference
+    @param name - name of the ReferenceProperty
+    """
+    return getattr(entity.__class__, name).get_value_for_datastore(entity)
+
+def reference_id(entity, name):
+    """
+    Returns the id of the entity referenced by a ReferenceProperty
+    without fetching that entity, or None if the property is not set.
+    """
+    key = reference_key(entity, name)
+    if key is None:
+        return None
+    return key.id()
+
+def prefetch_references(entities, *names):
+    """
+    Fetches the entities referenced by the named ReferenceProperties of
+    all of the given entities with a single batch get, so that reading
+    those properties afterwards doesn't fetch them one at a time.
+
+    @param entities - list of entities holding the references
+    @param names - names of the ReferenceProperties to prefetch
+    """
+    keys = set()
+    for entity in entities:
+        for name in names:
+            key = reference_key(entity, name)
+            if key is not None:
+                keys.add(key)
+    if not keys:
+        return
+
+    keys = list(keys)
+    referenced = dict(zip(keys, db.get(keys)))
+    for entity in entities:
+        for name in names:
+            key = reference_key(entity, name)
+            if referenced.get(key) is not None:
+                setattr(entity, name, referenced[key])
+
+def to_json_list(entities, prefetch=()):
+    """
+    Generates the JSON structures of a list of entities in one pass.
+
+    @param entities - list of entities with a to_json method
+    @param prefetch - names of ReferenceProperties whose entities to_json
+    reads, which are fetched for all of the entities with a single batch
+    get first
+    @returns list of JSON structures
+    """
+    entities = list(entities)
+    if prefetch:
+        prefetch_references(entities, *prefetch)
+    return [entity.to_json() for entity in entities]
+
+"""
+Whether users registered before email addresses were indexed by
+UserEmail entities are looked up with a query when their address has no
+UserEmail. Set this to False once migrations.index_user_emails has run.
+"""
+LEGACY_EMAIL_LOOKUP = True
+
+"""
+The number of seconds, and the maximum number of email addresses, for
+which the keys of users are cached by email address on each instance.
+"""
+EMAIL_CACHE_SECONDS = 300
+EMAIL_CACHE_SIZE = 1000
+
+# normalized email -> (expiry time, user key)
+_email_cache = lru.LRUCache(EMAIL_CACHE_SIZE)
+
+def normalize_email(email):
+    """
+    Returns the form of an email address users are looked up by.
+    """
+    return email.strip().lower()
+
+def _email_variants(email):
+    """
+    Returns the ways users registered before email addresses were
+    normalized are likely to have written an address: each combination
+    of the lower, upper, capitalized and title case forms of its local
+    part and of its domain. The datastore can't compare strings case
+    insensitively, so legacy users are queried for these variants only;
+    an address stored in any other mix of cases, e.g. fOO@bar.com, is not
+    found until migrations.index_user_emails has indexed it.
+    """
+    local, at, domain = email.strip().rpartition("@")
+    if not at:
+        local, domain = domain, ""
+    variants = set([email, email.strip()])
+    for l in (local, local.lower(), local.upper(), local.capitalize(),
+              local.title()):
+        for d in (domain, domain.lower(), domain.upper(), domain.capitalize(),
+                  domain.title()):
+            variants.add(l + at + d)
+    return sorted(variants)
+
+"""
+The number of shards each user's karma counter is split into, so that
+concurrent accepts of a user's answers rarely update the same entity.
+"""
+KARMA_SHARDS = 10
+
+"""
+The number of seconds a user's karma total is cached in memcache. A
+total cached while karma is being added can miss the new points, so it
+is only cached briefly.
+"""
+KARMA_CACHE_SECONDS = 10
+
+def _karma_shard_key_names(user_key):
+    return ["%s-%d" % (user_key.id_or_name(), shard)
+            for shard in range(KARMA_SHARDS)]
+
+def _karma_cache_key(user_key):
+    return "karma-%s" % user_key.id_or_name()
+
+def add_karma(user_key, points=1):
+    """
+    Gives a user karma points by incrementing one of the shards of the
+    user's karma counter, chosen at random, in a transaction. The User
+    entity itself is not read or written.
+
+    @param user_key - key of the user
+    @param points - number of points to add
+    """
+    key_name = random.choice(_karma_shard_key_names(user_key))
+
+    def txn():
+        shard = KarmaShard.get_by_key_name(key_name)
+        if shard is None:
+            shard = KarmaShard(key_name=key_name)
+        shard.count += points
+        shard.put()
+    db.run_in_transaction(txn)
+
+    # drop the cached total, which no longer counts every point
+    memcache.delete(_karma_cache_key(user_key))
+
+class KarmaShard(db.Model):
+    """
+    The KarmaShard object models one shard of a user's karma counter. Its
+    key name is the user's id and the shard number; see add_karma().
+    """
+
+    # number of karma points counted by this shard
+    count = db.IntegerProperty(default=0)
 
 class User(db.Model):
     """
@@ -28,17 +197,133 @@ class User(db.Model):
     # password of the user (NOTE: application logic is responsible for hashing the password)
     password = db.StringProperty(required=True)
 
-    # total number of karma points the user has
+    # number of karma points the user had before karma was counted by
+    # sharded counters; use total_karma() for the user's karma
     karma = db.IntegerProperty(default=0)
 
+    def total_karma(self):
+        """
+        Returns the total number of karma points the user has, summing
+        the shards of the user's karma counter with a single batch get
+        unless the total is cached.
+        """
+        cache_key = _karma_cache_key(self.key())
+        total = memcache.get(cache_key)
+        if total is None:
+            shards = KarmaShard.get_by_key_name(
+                _karma_shard_key_names(self.key()))
+            total = self.karma + sum([shard.count for shard in shards
+                                      if shard is not None])
+            memcache.add(cache_key, total, KARMA_CACHE_SECONDS)
+        return total
+
     # helper method to generate a JSON structure representing a User object 
     def to_json(self):
         return {
             "user_id": self.key().id(),
             "email": self.email,
-            "karma": self.karma,
+            "karma": self.total_karma(),
         }
 
+    @classmethod
+    def get_by_email(cls, email):
+        """
+        Looks up the user registered with an email address. Once the
+        user's key is cached on the instance this is a single get.
+
+        @param email - email address of the user, in any case
+        @returns the User, or None if there is none
+        """
+        normalized = normalize_email(email)
+        expires, key = _email_cache.get(normalized, (0, None))
+        if expires < time.time():
+            key = None
+            index = UserEmail.get_by_key_name(normalized)
+            if index is not None:
+                key = reference_key(index, "user")
+            elif LEGACY_EMAIL_LOOKUP:
+                key = cls._index_legacy_email(email)
+            if key is None:
+                return None
+            _email_cache.put(normalized, (time.time() + EMAIL_CACHE_SECONDS,
+                                          key))
+
+        user = cls.get(key)
+        if user is None:
+            _email_cache.put(normalized, (0, None))
+        return user
+
+    @classmethod
+    def _index_legacy_email(cls, email):
+        """
+        Finds a user registered before email addresses were indexed, with
+        the address in one of the cases listed by _email_variants(), and
+        creates the UserEmail for it. Addresses registered by more than one legacy user in
+        different cases are logged, and the one with the lowest id is
+        indexed.
+
+        @returns the key of the indexed user, or None if there is none
+        """
+        normalized = normalize_email(email)
+        query = cls.all(keys_only=True)
+        query.filter("email IN", _email_variants(email))
+        keys = sorted(query.fetch(10))
+        if not keys:
+            return None
+        if len(keys) > 1:
+            logging.warning("email address %s is registered by users %s" %
+                            (normalized, [key.id() for key in keys]))
+
+        index = UserEmail.get_or_insert(normalized, user=keys[0])
+        return reference_key(index, "user")
+
+    @classmethod
+    def register(cls, email, password):
+        """
+        Creates a user, unless a user is already registered with the email
+        address. The address is claimed by a UserEmail entity created in a
+        transaction, so concurrent registrations can't both succeed. The
+        claim also succeeds if a concurrent legacy lookup has already
+        indexed the new user under the address.
+
+        @param email - email address of the user
+        @param password - hashed password of the user
+        @returns the new User, or None if the address is taken
+        """
+        normalized = normalize_email(email)
+        if LEGACY_EMAIL_LOOKUP and \
+                UserEmail.get_by_key_name(normalized) is None and \
+                cls._index_legacy_email(email) is not None:
+            return None
+
+        user = cls(email=normalized, password=password)
+        user.put()
+
+        def txn():
+            index = UserEmail.get_by_key_name(normalized)
+            if index is not None:
+                return reference_key(index, "user") == user.key()
+            UserEmail(key_name=normalized, user=user).put()
+            return True
+
+        if not db.run_in_transaction(txn):
+            user.delete()
+            return None
+
+        _email_cache.put(normalized, (time.time() + EMAIL_CACHE_SECONDS,
+                                      user.key()))
+        return user
+
+class UserEmail(db.Model):
+    """
+    The UserEmail object maps a normalized email address, its key name,
+    to the User registered with it, which makes email addresses unique
+    and lets users be looked up by address with a get instead of a query.
+    """
+
+    # the user registered with the email address
+    user = db.ReferenceProperty(User)
+
 class Question(GeoModel):
     """
     The Question object models an Inquire question. It has a relationship
@@ -55,10 +340,19 @@ class Question(GeoModel):
     # which means a user has accepted some answer to this question
     closed = db.BooleanProperty(default=False)
 
+    # maintain per-geocell question counts so searches can pick
+    # geocell resolutions suited to how dense an area is
+    track_density = True
+
+    # only index every other geocell resolution to cut the size of
+    # the location_geocells index; see migrations.py for rewriting
+    # questions stored before this was set
+    geocell_resolutions = COMPACT_GEOCELL_RESOLUTIONS
+
     # helper method to generate a JSON structure representing a Question object 
     def to_json(self):
         return {
-            "user_id": self.user.key().id(),
+            "user_id": reference_id(self, "user"),
             "question_id": self.key().id(),
             "question": self.question,
             "latitude": self.location.lat,
@@ -85,12 +379,79 @@ class Answer(db.Model):
     # indicates the accepted answer to a question
     accepted_answer = db.BooleanProperty(default=False)
 
+    def accept(self):
+        """
+        Accepts the answer, closing its question and giving the owner of
+        the answer one karma point.
+
+        Only the question is read and written in the transaction, so the
+        check that it is still open and its closing are atomic, and an
+        answer can't be accepted twice. Setting the answer's accepted
+        flag and adding the karma point are tasks enqueued in that same
+        transaction: they run if and only if it commits, but shortly
+        after, and not atomically with each other.
+
+        @returns the closed question, or None if the question was
+        already closed
+        """
+        question_key = reference_key(self, "question")
+        answer_key = self.key()
+        user_key = reference_key(self, "user")
+
+        def txn():
+            question = db.get(question_key)
+            if question.closed:
+                return None
+            question.closed = True
+            question.put()
+            deferred.defer(_set_accepted, answer_key, _transactional=True)
+            deferred.defer(add_karma, user_key, _transactional=True)
+            return question
+        return db.run_in_transaction(txn)
+
     # helper method to generate a JSON structure representing an Answer object 
     def to_json(self):
         return {
-            "user_id": self.user.key().id(),
+            "user_id": reference_id(self, "user"),
             "answer_id": self.key().id(),
-            "question_id": self.question.key().id(),
+            "question_id": reference_id(self, "question"),
             "answer": self.answer,
             "accepted_answer": self.accepted_answer,
         }
+
+def _set_accepted(answer_key):
+    """
+    Task that sets the accepted flag of an answer; see Answer.accept().
+    """
+    answer = db.get(answer_key)
+    answer.accepted_answer = True
+    answer.put()
+
+class Notification(db.Model):
+    """
+    The Notification object models an email notification waiting to be
+    delivered to a user. See notifications.py. The notifications of a
+    recipient are stored in one entity group, under recipient_key(), so
+    that their delivery can find them with a consistent ancestor query.
+    """
+
+    # email address of the user to notify
+    recipient = db.StringProperty(required=True)
+
+    # kind of notification, see notifications.TEMPLATES
+    kind = db.StringProperty(required=True)
+
+    # text of the question and answer the notification is about
+    question = db.TextProperty()
+    answer = db.TextProperty()
+
+    # time the notification was created
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def recipient_key(cls, recipient):
+        """
+        Returns the key of the entity group of a recipient's notifications.
+        No entity is stored under it.
+        """
+        return db.Key.from_path("NotificationRecipient", recipient)
@@ -0,0 +1,308 @@
+##
+# notifications.py
+#
+# Email notifications sent to users when their questions are answered
+# and when their answers are accepted.
+#
+# API methods don't send mail or write to the datastore themselves. They
+# enqueue notification events, which a task stores and which are delivered
+# from the task queue a little later. All of
+# the events a recipient receives within COALESCE_SECONDS are delivered
+# together, one email per kind of event (e.g. "3 new answers to your
+# questions"). A delivery that fails is retried by the task queue, so a
+# mail failure never fails an API call.
+#
+# Tests can replace the task queue with a LocalQueue, which keeps events
+# in memory and stores and delivers them when run() is called:
+#
+#     queue = notifications.LocalQueue()
+#     notifications.set_queue(queue)
+#     ...
+#     messages = queue.run()
+##
+
+import hashlib
+import logging
+import time
+
+# for sending mail
+from google.appengine.api import mail
+
+# Runs deliveries as task queue tasks
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    from google.appengine.api.labs import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+# Our datastore models
+from model import Notification
+
+##
+# CONSTANTS
+##
+
+"""
+The email address to send from. See the Notes section of the README
+for more information on what to set this to.
+"""
+SENDER_EMAIL_ADDRESS = "VALID@APPENGINE_ADDRESS.COM"
+
+"""
+The number of seconds during which the notifications to a recipient
+are collected into a single delivery.
+"""
+COALESCE_SECONDS = 60
+
+"""
+The number of seconds a delivery task waits after the end of its
+COALESCE_SECONDS window, so that events stored by instances whose clocks
+are slightly behind are still delivered by it.
+"""
+DELIVERY_DELAY = 5
+
+"""
+The maximum number of notifications delivered to a recipient at once.
+Any more are delivered by a following task.
+"""
+MAX_BATCH_SIZE = 100
+
+"""
+The kinds of notification events.
+"""
+NEW_ANSWER = "new_answer"
+ANSWER_ACCEPTED = "answer_accepted"
+
+"""
+The subjects and bodies of the emails for each kind of notification,
+for a single event and for a number of events. Bodies are followed by
+one ITEM_TEMPLATE per event and the SIGNATURE.
+"""
+TEMPLATES = {
+    NEW_ANSWER: (
+        "Your question has a new answer!",
+        "Your questions have %d new answers!",
+        """
+This is to inform you of new answers to your questions.
+"""),
+    ANSWER_ACCEPTED: (
+        "Your answer was accepted!",
+        "%d of your answers were accepted!",
+        """
+This is to inform you that your answers have been accepted!
+You have been given one karma point for each accepted answer.
+"""),
+}
+
+ITEM_TEMPLATE = """
+The question:
+%s
+
+The answer:
+%s
+"""
+
+SIGNATURE = """
+Regards,
+
+Inquire Application
+"""
+
+##
+# QUEUES
+##
+
+class TaskQueue(object):
+    """
+    Stores notification events in the datastore and delivers them from
+    task queue tasks, with retries.
+    """
+
+    def enqueue(self, events):
+        """
+        Defers the storing of the events to a task, see store_events().
+
+        @param events - list of Notification entities
+        """
+        deferred.defer(store_events, events)
+
+class LocalQueue(object):
+    """
+    In-process stand-in for the TaskQueue, for tests. Events are kept in
+    memory until run() stores and delivers them the way the tasks of the
+    TaskQueue do.
+    """
+
+    def __init__(self, send=None):
+        """
+        @param send - function called with the sender, to, subject and
+        body keyword arguments of each email, mail.send_mail by default
+        """
+        self.events = []
+        self.send = send or mail.send_mail
+        # recipients with stored events left by a failed delivery
+        self.pending = set()
+
+    def enqueue(self, events):
+        self.events.extend(events)
+
+    def run(self):
+        """
+        Stores the queued events and delivers all of the stored events of
+        their recipients. Events whose delivery fails stay stored for the
+        next run.
+
+        @returns list of (recipient, subject, body) tuples of the emails
+        sent
+        """
+        db.put(self.events)
+        recipients = self.pending.union([event.recipient
+                                         for event in self.events])
+
+        sent = []
+        self.events = []
+        self.pending = set()
+        for recipient in recipients:
+            for subject, body, kind_events in compose(_stored(recipient)):
+                try:
+                    self.send(sender=SENDER_EMAIL_ADDRESS, to=recipient,
+                              subject=subject, body=body)
+                except Exception, e:
+                    logging.warning("notification delivery failed: %s" % e)
+                    self.pending.add(recipient)
+                    continue
+                db.delete(kind_events)
+                sent.append((recipient, subject, body))
+        return sent
+
+# the queue notifications are enqueued on; see set_queue()
+_queue = TaskQueue()
+
+def set_queue(queue):
+    """
+    Replaces the queue notifications are enqueued on, e.g. with a
+    LocalQueue in tests.
+
+    @returns the previous queue
+    """
+    global _queue
+    previous, _queue = _queue, queue
+    return previous
+
+##
+# NOTIFICATIONS
+##
+
+def notify_new_answer(question, answer):
+    """
+    Notifies the owner of a question that it has a new answer.
+    """
+    notify(question.user.email, NEW_ANSWER, question.question, answer.answer)
+
+def notify_answer_accepted(question, answer):
+    """
+    Notifies the owner of an answer that it has been accepted.
+    """
+    notify(answer.user.email, ANSWER_ACCEPTED, question.question,
+           answer.answer)
+
+def notify(recipient, kind, question, answer):
+    """
+    Enqueues a notification event for delivery.
+
+    @param recipient - email address of the user to notify
+    @param kind - NEW_ANSWER or ANSWER_ACCEPTED
+    @param question - text of the question
+    @param answer - text of the answer
+    """
+    _queue.enqueue([Notification(parent=Notification.recipient_key(recipient),
+                                 recipient=recipient, kind=kind,
+                                 question=question, answer=answer)])
+
+def compose(events):
+    """
+    Composes the emails delivering a recipient's notification events,
+    one per kind of event.
+
+    @returns list of (subject, body, events) tuples, where events are
+    the events delivered by the email
+    """
+    by_kind = {}
+    for event in events:
+        by_kind.setdefault(event.kind, []).append(event)
+
+    emails = []
+    for kind, kind_events in sorted(by_kind.items()):
+        subject, subject_many, intro = TEMPLATES[kind]
+        if len(kind_events) > 1:
+            subject = subject_many % len(kind_events)
+        body = intro + "".join([ITEM_TEMPLATE % (event.question, event.answer)
+                                for event in kind_events]) + SIGNATURE
+        emails.append((subject, body, kind_events))
+    return emails
+
+##
+# DELIVERY
+##
+
+def store_events(events):
+    """
+    Task that stores notification events and schedules one delivery task
+    per recipient. The delivery task is named after the recipient and the
+    COALESCE_SECONDS window it runs DELIVERY_DELAY seconds after the end
+    of, so later events in the same window are delivered by the task
+    already scheduled.
+
+    @param events - list of Notification entities
+    """
+    db.put(events)
+
+    now = time.time()
+    window = int(now / COALESCE_SECONDS)
+    countdown = (window + 1) * COALESCE_SECONDS - now + DELIVERY_DELAY
+    for recipient in set([event.recipient for event in events]):
+        _schedule(recipient, window, countdown)
+
+def _task_name(recipient, window):
+    digest = hashlib.sha1(recipient.encode("utf-8")).hexdigest()
+    return "notify-%s-%d" % (digest, window)
+
+def _schedule(recipient, window, countdown):
+    try:
+        deferred.defer(deliver, recipient, _name=_task_name(recipient, window),
+                       _countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # a delivery is already scheduled for this window
+        pass
+
+def _stored(recipient):
+    """
+    Returns up to MAX_BATCH_SIZE of the stored notifications of a
+    recipient, oldest first. The notifications are found with an
+    ancestor query, which sees every notification stored before it ran.
+    """
+    query = Notification.all().ancestor(Notification.recipient_key(recipient))
+    return query.order("created").fetch(MAX_BATCH_SIZE)
+
+def deliver(recipient):
+    """
+    Task that delivers the stored notifications of a recipient. If
+    sending fails the task is retried; notifications are deleted as soon
+    as their email has been sent, so a retry doesn't send them again.
+    """
+    events = _stored(recipient)
+    if not events:
+        return
+
+    for subject, body, kind_events in compose(events):
+        try:
+            mail.send_mail(sender=SENDER_EMAIL_ADDRESS, to=recipient,
+                           subject=subject, body=body)
+        except mail.InvalidEmailError, e:
+            # retrying won't help, drop the notifications
+            logging.error("dropping notifications to %s: %s" % (recipient, e))
+        db.delete(kind_events)
+
+    if len(events) == MAX_BATCH_SIZE:
+        deferred.defer(deliver, recipient)
@@ -0,0 +1,83 @@
+##
+# notifications_test.py
+#
+# Unit tests for notifications.py. Requires the App Engine SDK on the
+# path; run from this directory with:
+#
+#     python notifications_test.py
+##
+
+import os
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+
+import notifications
+from model import Notification
+
+class NotificationsTests(unittest.TestCase):
+
+    def setUp(self):
+        os.environ["APPLICATION_ID"] = "inquire"
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub("datastore_v3",
+            datastore_file_stub.DatastoreFileStub("inquire", None, None))
+
+        self.sent = []
+        self.fail = False
+        self.queue = notifications.LocalQueue(send=self.send)
+        self.previous = notifications.set_queue(self.queue)
+
+    def tearDown(self):
+        notifications.set_queue(self.previous)
+
+    def send(self, sender, to, subject, body):
+        if self.fail:
+            raise Exception("mail service unavailable")
+        self.sent.append((to, subject))
+
+    def stored(self, recipient):
+        query = Notification.all().ancestor(
+            Notification.recipient_key(recipient))
+        return [(event.kind, event.question, event.answer)
+                for event in query.fetch(10)]
+
+    def test_notify_through_local_queue(self):
+        notifications.notify("owner@example.com", notifications.NEW_ANSWER,
+                             "Where is the library?", "On Main St.")
+
+        # nothing is stored until the queue runs its tasks
+        self.assertEquals([], self.stored("owner@example.com"))
+
+        # a failed delivery leaves the notification stored
+        self.fail = True
+        self.assertEquals([], self.queue.run())
+        self.assertEquals([(notifications.NEW_ANSWER, "Where is the library?",
+                            "On Main St.")],
+                          self.stored("owner@example.com"))
+        self.assertEquals([], self.stored("other@example.com"))
+
+        self.fail = False
+        sent = self.queue.run()
+        self.assertEquals([("owner@example.com",
+                            "Your question has a new answer!")], self.sent)
+        self.assertEquals(1, len(sent))
+        self.assertEquals([], self.stored("owner@example.com"))
+
+    def test_notifications_are_coalesced(self):
+        for answer in ("One", "Two"):
+            notifications.notify("owner@example.com",
+                                 notifications.NEW_ANSWER, "Question", answer)
+        notifications.notify("owner@example.com",
+                             notifications.ANSWER_ACCEPTED, "Question", "One")
+
+        self.queue.run()
+        # one email per kind of event
+        self.assertEquals(
+            [("owner@example.com", "Your answer was accepted!"),
+             ("owner@example.com", "Your questions have 2 new answers!")],
+            self.sent)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,221 @@
+##
+# question_index.py
+#
+# An optional in-process spatial index of the open questions. The set of
+# open questions is small enough to hold in memory on each instance, so
+# rather than running a geocell proximity search against the datastore for
+# every /api/questions call we can answer nearest neighbor queries from
+# memory.
+#
+# The index is never built on the request path. A deferred task fetches
+# the open questions and stores a snapshot of them in memcache, and each
+# instance loads the latest snapshot into its index. Once an instance's
+# index is older than MAX_AGE seconds it loads a newer snapshot if there
+# is one, or schedules the task to build one; until then the questions
+# API method searches the datastore. The ask and accept API methods keep
+# the index current between snapshots, but only for changes made on the
+# same instance.
+#
+# If there are more than MAX_SIZE open questions the task records that
+# in the snapshot instead, and the index is not used or rebuilt for
+# OVERSIZE_BACKOFF seconds.
+##
+
+import logging
+import time
+
+# Snapshots are shared between instances through memcache
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+# Snapshots are built by a task queue task
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    from google.appengine.api.labs import taskqueue
+from google.appengine.ext import deferred
+
+# In-memory spatial index from the geo library
+from geo.spatialindex import SpatialIndex
+
+# Our datastore models
+from model import Question
+
+##
+# CONSTANTS
+##
+
+"""
+Whether the questions API method may serve results from the index.
+"""
+ENABLED = True
+
+"""
+The number of seconds after which an index or snapshot is considered
+stale and is no longer used.
+"""
+MAX_AGE = 300
+
+"""
+The maximum number of open questions to hold in memory. If there are more
+open questions than this the index is not used.
+"""
+MAX_SIZE = 5000
+
+"""
+The number of seconds to wait before trying to build the index again
+after finding more than MAX_SIZE open questions.
+"""
+OVERSIZE_BACKOFF = 3600
+
+"""
+The minimum number of seconds between two checks of a stale index for a
+newer snapshot.
+"""
+CHECK_INTERVAL = 10
+
+"""
+The number of questions stored in each memcache entry of a snapshot.
+"""
+CHUNK_SIZE = 500
+
+# memcache keys of the snapshot header and of its chunks
+_SNAPSHOT_KEY = "question_index-snapshot"
+_CHUNK_KEY = "question_index-chunk-%r-%d"
+
+# the index itself and the time its snapshot was built, or None if it
+# has never been loaded, and the time a stale index last checked for a
+# newer snapshot
+_index = SpatialIndex()
+_built_at = None
+_checked_at = 0
+
+def _is_fresh(now):
+    return _built_at is not None and now - _built_at < MAX_AGE
+
+def is_warm():
+    """
+    Returns True if the index is fresh enough to serve queries. A stale
+    index is replaced by a newer snapshot if there is one; otherwise the
+    building of a snapshot is scheduled.
+    """
+    global _checked_at
+
+    if not ENABLED:
+        return False
+    now = time.time()
+    if _is_fresh(now):
+        return True
+    if now - _checked_at < CHECK_INTERVAL:
+        return False
+
+    _checked_at = now
+    _refresh(now)
+    return _is_fresh(now)
+
+def _refresh(now):
+    """
+    Loads the latest snapshot if it is fresh, and schedules the building
+    of a new one otherwise, unless the last one was too large.
+    """
+    header = memcache.get(_SNAPSHOT_KEY)
+    if header is not None:
+        built_at, num_chunks = header
+        if num_chunks is None:
+            if now - built_at < OVERSIZE_BACKOFF:
+                return
+        elif now - built_at < MAX_AGE and _load(built_at, num_chunks):
+            return
+    _schedule(now)
+
+def _load(built_at, num_chunks):
+    """
+    Replaces the contents of the index with a snapshot from memcache.
+
+    @returns False if part of the snapshot has been evicted
+    """
+    global _built_at
+
+    keys = [_CHUNK_KEY % (built_at, i) for i in range(num_chunks)]
+    chunks = memcache.get_multi(keys)
+    if len(chunks) != num_chunks:
+        return False
+
+    _index.clear()
+    for key in keys:
+        for encoded in chunks[key]:
+            question = db.model_from_protobuf(encoded)
+            _index.add(question.key(), question.location, question)
+    _built_at = built_at
+    return True
+
+def _schedule(now):
+    """
+    Schedules the task building a snapshot, at most once per MAX_AGE.
+    """
+    try:
+        deferred.defer(rebuild, _name="question-index-%d" % int(now / MAX_AGE))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def rebuild():
+    """
+    Task that builds a snapshot of all of the open questions in the
+    datastore, stores it in memcache and loads it into this instance's
+    index.
+
+    @returns True if the snapshot was built, or False if there are more
+    than MAX_SIZE open questions.
+    """
+    global _built_at
+
+    built_at = time.time()
+    questions = Question.all().filter("closed =", False).fetch(MAX_SIZE + 1)
+    if len(questions) > MAX_SIZE:
+        logging.info("not indexing more than %d open questions" % MAX_SIZE)
+        memcache.set(_SNAPSHOT_KEY, (built_at, None), OVERSIZE_BACKOFF)
+        _index.clear()
+        _built_at = None
+        return False
+
+    encoded = [db.model_to_protobuf(question).Encode()
+               for question in questions]
+    chunks = {}
+    for i in range(0, len(encoded), CHUNK_SIZE):
+        chunks[_CHUNK_KEY % (built_at, i / CHUNK_SIZE)] = \
+            encoded[i:i + CHUNK_SIZE]
+    memcache.set_multi(chunks, 2 * MAX_AGE)
+    memcache.set(_SNAPSHOT_KEY, (built_at, len(chunks)), 2 * MAX_AGE)
+
+    _index.clear()
+    for question in questions:
+        _index.add(question.key(), question.location, question)
+    _built_at = built_at
+    return True
+
+def add(question):
+    """
+    Adds a new or updated question to the index, or removes it if the
+    question is closed. Does nothing until the index has been loaded.
+    """
+    if _built_at is None:
+        return
+    if question.closed:
+        _index.remove(question.key())
+    else:
+        _index.add(question.key(), question.location, question)
+
+def remove(question):
+    """
+    Removes a question from the index.
+    """
+    _index.remove(question.key())
+
+def nearest(center, max_results, max_distance):
+    """
+    Returns up to max_results open questions within max_distance meters
+    of the given center point, nearest first. A max_distance of 0 means
+    no limit, as it does for Question.proximity_fetch().
+    """
+    return [question for (question, distance) in
+            _index.nearest(center, max_results, max_distance or None)]
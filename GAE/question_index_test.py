@@ -0,0 +1,59 @@
+##
+# question_index_test.py
+#
+# Unit tests for question_index.py. Requires the App Engine SDK on the
+# path; run from this directory with:
+#
+#     python question_index_test.py
+##
+
+import unittest
+
+from geo import geotypes
+
+import question_index
+
+class _Question(object):
+    """
+    A stand-in for an open Question entity.
+    """
+
+    def __init__(self, key, latitude, longitude):
+        self._key = key
+        self.location = geotypes.Point(latitude, longitude)
+        self.closed = False
+
+    def key(self):
+        return self._key
+
+class QuestionIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        question_index._index.clear()
+        question_index._built_at = 0
+        self.near = _Question("near", 37.33, -122.03)
+        self.far = _Question("far", 38.03, -122.03)   # about 78 km north
+        question_index.add(self.near)
+        question_index.add(self.far)
+
+    def tearDown(self):
+        question_index._index.clear()
+        question_index._built_at = None
+
+    def test_nearest(self):
+        center = geotypes.Point(37.33, -122.03)
+        self.assertEquals([self.near, self.far],
+                          question_index.nearest(center, 10, 100000))
+        self.assertEquals([self.near],
+                          question_index.nearest(center, 10, 50000))
+        self.assertEquals([self.near],
+                          question_index.nearest(center, 1, 100000))
+
+    def test_zero_max_distance_is_unlimited(self):
+        # like Question.proximity_fetch, a max_distance of 0 means no limit
+        center = geotypes.Point(37.33, -122.03)
+        self.assertEquals([self.near, self.far],
+                          question_index.nearest(center, 10, 0))
+
+if __name__ == "__main__":
+    unittest.main()
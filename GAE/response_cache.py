@@ -0,0 +1,183 @@
+##
+# response_cache.py
+#
+# A memcache cache of the JSON responses of the questions API method.
+# Many clients poll for the questions near them and many of them are
+# close to each other, so responses are cached by the RESOLUTION geocell
+# containing the search center, along with max_results and max_distance.
+# A client is served the response computed for another client in the
+# same geocell, a few hundred meters away at most.
+#
+# A cached response is invalidated as soon as a question inside the
+# region it covers is asked or closed. The region is covered by a few
+# geocells, and each geocell has a generation counter in memcache that
+# invalidate() increments. A response is stored with the generations of
+# its region's geocells and is only served while they are unchanged.
+# Looking up a response and the generations of its region takes a single
+# memcache call.
+#
+# Counters are created with random values, so that a counter which was
+# evicted and recreated can't return to a generation a cached response
+# was stored with. Responses are neither served nor stored while any of
+# their region's counters is missing.
+##
+
+import random
+
+# Shared cache of the responses and generation counters
+from google.appengine.api import memcache
+
+# Geocell math from the geo library
+from geo import geomath
+from geo import geotypes
+from geo import intcell
+from geo import lru
+from geo.geomodel import default_cost_function
+
+##
+# CONSTANTS
+##
+
+"""
+Whether the questions API method may serve cached responses.
+"""
+ENABLED = True
+
+"""
+The resolution of the geocells search centers are quantized to. A
+resolution 8 geocell is roughly 600 x 300 meters near the equator.
+"""
+RESOLUTION = 8
+
+"""
+The resolutions of the geocells whose generation counters cover the
+regions of cached responses.
+"""
+INVALIDATION_RESOLUTIONS = range(1, RESOLUTION + 1)
+
+"""
+The number of seconds a response is cached for, at most.
+"""
+CACHE_SECONDS = 60
+
+# memcache key prefixes of responses and generation counters
+_RESPONSE_PREFIX = "questions-response-"
+_GENERATION_PREFIX = "questions-generation-"
+
+# the generation counter of regions that cross the antimeridian, which
+# every invalidation increments
+_WORLD = "world"
+
+# (geocell, max_distance) -> the geocells covering the region of the
+# responses cached for them
+_regions = lru.LRUCache(1000)
+
+# this instance's counters; see stats()
+_counters = {"hits": 0, "misses": 0, "stale": 0, "invalidations": 0}
+
+def _region_cells(cell, max_distance):
+    """
+    Returns the geocells covering every point within max_distance meters
+    of the given geocell, or [_WORLD] if that region crosses the
+    antimeridian.
+    """
+    cells = _regions.get((cell, max_distance))
+    if cells is None:
+        box = intcell.compute_box(cell)
+        center = geotypes.Point((box.north + box.south) / 2,
+                                (box.east + box.west) / 2)
+        radius = max_distance + geomath.distance(center, box.north_east)
+        region = geomath.radius_box(center, radius)
+
+        cells = None
+        if region.west <= region.east:
+            cells = intcell.best_bbox_search_cells(
+                region, default_cost_function, INVALIDATION_RESOLUTIONS)
+        if not cells:
+            cells = [_WORLD]
+        _regions.put((cell, max_distance), cells)
+    return cells
+
+def lookup(center, max_results, max_distance):
+    """
+    Looks up the cached response for a questions search.
+
+    @param center - the search center, a geotypes.Point
+    @param max_results - the maximum number of questions returned
+    @param max_distance - the search radius, in meters
+    @returns a tuple (content, token). content is the cached JSON of the
+    response, or None if there is no valid cached response, in which case
+    token must be passed to store() along with the computed response.
+    token is None if the response can't be cached yet.
+    """
+    if not ENABLED:
+        return None, None
+
+    cell = intcell.compute(center, RESOLUTION)
+    max_distance = int(round(max_distance))
+    response_key = "%s%d-%d-%d" % (_RESPONSE_PREFIX, cell, max_results,
+                                   max_distance)
+    generation_keys = [_GENERATION_PREFIX + str(region_cell)
+                       for region_cell in _region_cells(cell, max_distance)]
+
+    values = memcache.get_multi([response_key] + generation_keys)
+    generations = tuple([values.get(key) for key in generation_keys])
+    if None in generations:
+        _counters["misses"] += 1
+        _seed([key for key in generation_keys if key not in values])
+        return None, None
+
+    cached = values.get(response_key)
+    if cached is None:
+        _counters["misses"] += 1
+    elif cached[0] != generations:
+        _counters["stale"] += 1
+    else:
+        _counters["hits"] += 1
+        return cached[1], None
+    return None, (response_key, generations)
+
+def store(token, content):
+    """
+    Caches the response of a questions search.
+
+    @param token - the token returned by lookup() before the search
+    @param content - the JSON of the response
+    """
+    if token is None:
+        return
+    response_key, generations = token
+    memcache.set(response_key, (generations, content), CACHE_SECONDS)
+
+def invalidate(*points):
+    """
+    Invalidates the cached responses whose regions contain any of the
+    given points, the locations of questions that were asked or closed.
+    """
+    keys = set([_GENERATION_PREFIX + _WORLD])
+    for point in points:
+        cell = intcell.compute(point, RESOLUTION)
+        for res in INVALIDATION_RESOLUTIONS:
+            keys.add(_GENERATION_PREFIX + str(intcell.ancestor(cell, res)))
+
+    _seed(keys)
+    memcache.offset_multi(dict([(key, 1) for key in keys]))
+    _counters["invalidations"] += 1
+
+def _seed(keys):
+    """
+    Creates the missing generation counters among the given keys, each
+    with a random value.
+    """
+    memcache.add_multi(dict([(key, random.randint(0, 2 ** 31))
+                             for key in keys]))
+
+def stats():
+    """
+    Returns this instance's counters of cache hits, misses, stale cached
+    responses and invalidations, along with the hit rate.
+    """
+    counters = dict(_counters)
+    lookups = counters["hits"] + counters["misses"] + counters["stale"]
+    counters["hit_rate"] = lookups and float(counters["hits"]) / lookups
+    return counters
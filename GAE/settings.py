@@ -65,6 +65,8 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'middleware.SessionMiddleware',
+    'middleware.CacheFlushMiddleware',
 )
 
 ROOT_URLCONF = 'urls'
@@ -80,6 +82,15 @@ INSTALLED_APPS = (
     'django.contrib.contenttypes',
 )
 
-# for Session management
-session = appengine_utilities.settings_default.session
+# for Session management; expired sessions and cache entries are
+# deleted by the background sweeper (see cron.yaml) rather than by
+# randomly chosen requests. Session data is kept in a single blob on
+# the session entity, and changed sessions and cache entries are
+# written to the datastore once at the end of each request (see
+# middleware.py). Sessions written by the datastore writer are copied
+# into the blob the first time they are used.
+session = dict(appengine_utilities.settings_default.session,
+               CLEAN_IN_BACKGROUND=True, WRITER="blob")
+cache = dict(appengine_utilities.settings_default.cache,
+             CLEAN_IN_BACKGROUND=True, WRITE_BEHIND=True)
 flash = appengine_utilities.settings_default.flash
@@ -20,9 +20,22 @@ urlpatterns = patterns('api',
     # GET REQUESTS
     (r'^api/questions$', 'questions'),
     (r'^api/answers$', 'answers'),
+    (r'^api/viewport$', 'viewport'),
 
     # Utility mapping for creating random questions
     # and should probably be removed from a "live"
     # application
     (r'^api/randomize$', 'randomize'),
+
+    # Starts the background migration of question geocells
+    (r'^api/migrate_geocells$', 'migrate_geocells'),
+
+    # Starts the background migration indexing user email addresses
+    (r'^api/migrate_user_emails$', 'migrate_user_emails'),
+
+    # Reports the hit rate of the questions response cache
+    (r'^api/response_cache_stats$', 'response_cache_stats'),
+
+    # Starts a background sweep of expired sessions and cache entries
+    (r'^api/sweep_expired$', 'sweep_expired'),
 )